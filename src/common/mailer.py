@@ -1,16 +1,39 @@
-''' Methods to send emails to users and administrators '''
+''' Methods to send emails to users and administrators
+
+Emails are sent by task queue tasks (on the 'mail' queue, see queue.yaml),
+so requests don't wait for the mail API.  A task that fails, e.g. with
+OverQuotaError, is retried with backoff.  The tasks' handlers are
+send_mail_task() and send_digest_task() below, routed in the top urls.py,
+so this module does not depend on an app's views.
+
+Notifications to the admins are coalesced when there are many: after
+DIGEST_THRESHOLD notifications to the same addresses in DIGEST_SECONDS,
+the rest are stored as PendingNotifications and sent as one digest at the
+end of the period.  The notifications to the same addresses share a parent
+key, so the digest task reads them with a (strongly consistent) ancestor
+query.
+'''
 
 # python imports
 import logging
+import hashlib
+import time
 
 # google imports
-#from google.appengine.ext import deferred
-
+from google.appengine.api import memcache
 from google.appengine.api.mail import EmailMessage as GoogleEmailMessage
+from google.appengine.ext import db
+try:
+  from google.appengine.api import taskqueue
+except ImportError:
+  from google.appengine.api.labs import taskqueue
 
 # django imports
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
 from django.template.loader import render_to_string
 from django.core import mail
+from django.utils import simplejson as json
 from django.utils.safestring import mark_safe
 
 # AEP imports
@@ -19,6 +42,26 @@ from appenginepatcher import on_production_server
 # local imports
 import settings
 
+MAIL_QUEUE = 'mail'
+# Notifications to the same addresses sent one by one in a period
+DIGEST_THRESHOLD = 5
+DIGEST_SECONDS = 300
+# Notifications read at once for a digest
+DIGEST_BATCH_SIZE = 100
+MEMCACHE_PREFIX = 'mailer:'
+
+
+class PendingNotification(db.Model):
+  """A notification waiting to be sent in a digest.
+
+  Its parent is the _pending_parent() of its recipients."""
+  # See _recipients_key()
+  recipients_key = db.StringProperty(required=True, indexed=False)
+  to = db.StringListProperty(indexed=False)
+  subject = db.StringProperty(required=True, indexed=False)
+  body = db.TextProperty(required=True)
+  created_date = db.DateTimeProperty(auto_now_add=True)
+
 def send_mail(subject, body, addresslist, 
               sender = settings.DEFAULT_FROM_EMAIL,
               doAppendSig=True, bcclist = None, reply_to = None):
@@ -35,25 +78,114 @@ def send_mail(subject, body, addresslist,
   logging.debug("mailer.send_mail: addresslist %s bcclist %s body:\n%s" %
                 (addresslist, bcclist, body))
 
-  email = GoogleEmailMessage(subject  = subject, 
-                             body     = body, 
-                             sender   = sender,
-                             to       = addresslist)
+  message = {'subject': subject, 'body': body, 'sender': sender,
+             'to': addresslist}
   if bcclist is not None and len(bcclist) > 0:
-    email.bcc = bcclist
+    message['bcc'] = bcclist
   if reply_to is not None:
-    email.reply_to = reply_to
+    message['reply_to'] = reply_to
 
-  from tasks import deliver_email_task
-  # Note: For some reason synchronous works, asynchronous isn't working.
-  # I'm not going to worry about that for now.
-  # TODO(dan): Fix deferred.defer.
-  deliver_email_task(email)
-  #deferred.defer(deliver_email_task, email)
+  taskqueue.Task(url=reverse('mailer.send_mail_task'), method='POST',
+                 params={'message': json.dumps(message)}).add(MAIL_QUEUE)
 
   # for testing, appengine patch keeps a list of mails
   if hasattr(mail, 'outbox') and not on_production_server:
-    mail.outbox.append(email) #@UndefinedVariable (ignore py checker warnings)
+    mail.outbox.append(_make_email(message)) #@UndefinedVariable (ignore py checker warnings)
+
+def _make_email(message):
+  email = GoogleEmailMessage(subject  = message['subject'],
+                             body     = message['body'],
+                             sender   = message['sender'],
+                             to       = message['to'])
+  if message.get('bcc'):
+    email.bcc = message['bcc']
+  if message.get('reply_to'):
+    email.reply_to = message['reply_to']
+  return email
+
+def deliver_queued_mail(message_json):
+  '''Send a message queued by send_mail().  Called from the task's view.'''
+  from tasks import deliver_email_task
+  # Raises on transient failures, so the task is retried
+  deliver_email_task(_make_email(json.loads(message_json)))
+
+def send_mail_task(request):
+  """Task queue handler sending an email queued by send_mail()."""
+  deliver_queued_mail(request.POST['message'])
+  return HttpResponse('')
+
+def _recipients_key(addresslist):
+  return hashlib.md5('|'.join(sorted(addresslist)).encode('utf-8')).hexdigest()
+
+def _pending_parent(recipients_key):
+  '''Parent key (of no entity) of the PendingNotifications to the same
+  addresses.'''
+  return db.Key.from_path('PendingNotifications', recipients_key)
+
+def _queue_digest(recipients_key, period):
+  '''Queue the digest task of period, at its end, unless it is queued.'''
+  taskqueue.Task(url=reverse('mailer.send_digest_task'),
+                 method='POST', params={'recipients': recipients_key},
+                 name='mail-digest-%s-%d' % (recipients_key, period),
+                 countdown=max((period + 1) * DIGEST_SECONDS - time.time() + 1,
+                               0)
+                 ).add(MAIL_QUEUE)
+
+def send_notification(subject, body, addresslist):
+  '''Send a notification, or if many were sent to addresslist lately,
+  hold it for a digest.'''
+  recipients_key = _recipients_key(addresslist)
+  period = int(time.time() / DIGEST_SECONDS)
+  count_key = '%s%s:%d' % (MEMCACHE_PREFIX, recipients_key, period)
+  memcache.add(count_key, 0, time=DIGEST_SECONDS * 2)
+  count = memcache.incr(count_key)
+  if count is None or count <= DIGEST_THRESHOLD:
+    send_mail(subject, body, addresslist, doAppendSig=False)
+    return
+
+  PendingNotification(parent=_pending_parent(recipients_key),
+                      recipients_key=recipients_key, to=addresslist,
+                      subject=subject, body=body).put()
+  # One digest task per period, at its end
+  try:
+    _queue_digest(recipients_key, period)
+  except taskqueue.TombstonedTaskError:
+    # This period's task already ran (clocks differ), so the next one
+    # sends this notification
+    try:
+      _queue_digest(recipients_key, period + 1)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+  except taskqueue.TaskAlreadyExistsError:
+    pass
+
+def send_digest(recipients_key):
+  '''Send the pending notifications to the same addresses as one email.
+
+  Called from the digest task's view.  Those sent are deleted.'''
+  while True:
+    pending = PendingNotification.all().ancestor(
+      _pending_parent(recipients_key)).order('created_date').fetch(
+      DIGEST_BATCH_SIZE)
+    if not pending:
+      return
+    body = '\n\n'.join(['%s\n%s' % (notification.subject, notification.body)
+                         for notification in pending])
+    message = {'subject': '%s %d notifications' % (settings.EMAIL_SUBJECT_PREFIX,
+                                                   len(pending)),
+               'body': body, 'sender': settings.DEFAULT_FROM_EMAIL,
+               'to': pending[0].to}
+    from tasks import deliver_email_task
+    # Raises on transient failures, e.g. OverQuotaError, so the task is
+    # retried later
+    deliver_email_task(_make_email(message))
+    db.delete(pending)
+
+def send_digest_task(request):
+  """Task queue handler sending a digest of notifications, see
+  send_notification()."""
+  send_digest(request.POST['recipients'])
+  return HttpResponse('')
 
 def render_to_string_assume_safe(template, attrs):
   """Mark all attrs string values safe before rendering to disable quoting
@@ -78,14 +210,20 @@ def _admin_address_list():
   '''
   return ["%s <%s>" % (admin[0], admin[1]) for admin in settings.ADMINS]
 
-def send_email_to_admins(subject, body):
-  """ convenience method to send simple notifications to admins """
-  send_mail(subject, body, _admin_address_list(), doAppendSig=False)
+def send_email_to_admins(subject, body, digest=True):
+  """ convenience method to send simple notifications to admins
+
+  With digest, they may be coalesced with others, see send_notification().
+  """
+  if digest:
+    send_notification(subject, body, _admin_address_list())
+  else:
+    send_mail(subject, body, _admin_address_list(), doAppendSig=False)
 
 def email_contact_us(contacter, text):
   # TODO(dan): contact email has no sig.  Why?
   send_email_to_admins(subject='Contact Us: response from %s' % contacter,
-                       body=text)
+                       body=text, digest=False)
 
 
 def email_new_patient(patient):
@@ -1,14 +1,38 @@
 # Based on http://henritersteeg.wordpress.com/2009/03/30/generic-db-caching-in-google-app-engine 
 
+"""A request-scoped identity map for datastore entities.
+
+patch_db_get() wraps db.get, db.put, db.delete, Model.put, Model.delete and
+query fetches.  Between start_request() and end_request() (see
+DbCacheMiddleware), each entity read or written is kept by key:
+
+- get serves the keys it has and fetches only the misses, in one batch.
+- put stores the written entities, delete evicts them.
+- fetch records the entities a query returns.
+
+Inside db.run_in_transaction, gets go to the datastore and writes evict,
+since the transaction may be retried or fail.  Entities read by iterating
+over a query are not recorded.  Outside a request (e.g. in management
+commands) nothing is cached.
+"""
+
 import logging
-import weakref
 
 # AppEngine imports
 from google.appengine.ext import db
 from google.appengine.api import datastore
 
-# define a global, weakly referenced CACHE...
-_cache = weakref.WeakValueDictionary({})
+# key -> entity, for the current request
+_cache = {}
+
+# True between start_request() and end_request()
+_active = False
+
+# Depth of db.run_in_transaction calls
+_transaction_depth = 0
+
+# Counts for the current request
+_stats = {}
 
 # True iff patch_db_get() is called
 _patch_called = False
@@ -16,23 +40,129 @@ _patch_called = False
 def get_cache_size():
   return len(_cache)
 
+def _clear():
+  global _cache, _stats
+  _cache = {}
+  _stats = {'hits': 0, 'misses': 0, 'puts': 0, 'deletes': 0, 'recorded': 0}
+
+_clear()
+
+def start_request():
+  global _active, _transaction_depth
+  _clear()
+  _active = True
+  _transaction_depth = 0
+
+def end_request():
+  '''Log this request's hit rate and empty the cache.'''
+  global _active
+  if _active:
+    logging.info('db_cache: %s' % format_stats())
+  _active = False
+  _clear()
+
+def get_stats():
+  '''Counts for the current request: hits and misses are keys got.'''
+  stats = dict(_stats)
+  stats['size'] = len(_cache)
+  return stats
+
+def format_stats():
+  stats = get_stats()
+  gets = stats['hits'] + stats['misses']
+  percent = 0
+  if gets:
+    percent = stats['hits'] * 100 / gets
+  return ('%d of %d keys got from cache (%d%%), %d puts, %d deletes, '
+          '%d recorded from queries, %d cached'
+          % (stats['hits'], gets, percent, stats['puts'], stats['deletes'],
+             stats['recorded'], stats['size']))
+
+def _caching():
+  return _active and _transaction_depth == 0
+
+def _store(models):
+  for model in models:
+    if isinstance(model, db.Model) and model.is_saved():
+      _cache[model.key()] = model
+
+def _evict(keys):
+  for key in keys:
+    _cache.pop(key, None)
+
+def _keys_of(models):
+  '''Keys of a model, key or key string, or a list of them.'''
+  if not isinstance(models, (list, tuple)):
+    models = [models]
+  keys = []
+  for model in models:
+    if isinstance(model, db.Model):
+      if model.is_saved():
+        keys.append(model.key())
+    elif isinstance(model, basestring):
+      keys.append(db.Key(model))
+    else:
+      keys.append(model)
+  return keys
+
 def getCached(real_func, keys, **kwargs):
-  real_keys, multiple = datastore.NormalizeAndTypeCheckKeys(keys)
-  if multiple: # give up for now
+  if not _caching():
     return real_func(keys, **kwargs)
 
-  real_key = real_keys[0]
-  instance = _cache.get(real_key, None)
-  if instance:
-    #logging.debug('request_db_cache: Got cached instance of %s (cache size %d)'
-    #              % (real_key, len(_cache)))
-    return instance  
-  model = real_func(keys, **kwargs)
-  if model:  
-    _cache[real_key] = model  
-  #logging.debug('request_db_cache: Cache miss for %s (cache size %d)'
-  #              % (real_key, len(_cache)))
-  return model
+  real_keys, multiple = datastore.NormalizeAndTypeCheckKeys(keys)
+  missing = [key for key in real_keys if key not in _cache]
+  _stats['hits'] += len(real_keys) - len(missing)
+  _stats['misses'] += len(missing)
+  if missing:
+    for model in real_func(missing, **kwargs):
+      if model:
+        _cache[model.key()] = model
+
+  models = [_cache.get(key) for key in real_keys]
+  if multiple:
+    return models
+  return models[0]
+
+def _put(real_func, models, **kwargs):
+  keys = real_func(models, **kwargs)
+  if _active:
+    if not isinstance(models, (list, tuple)):
+      models = [models]
+    _stats['puts'] += len(models)
+    if _transaction_depth:
+      _evict(_keys_of(models))
+    else:
+      _store(models)
+  return keys
+
+def _delete(real_func, models, **kwargs):
+  if _active:
+    keys = _keys_of(models)
+    _stats['deletes'] += len(keys)
+    _evict(keys)
+  return real_func(models, **kwargs)
+
+def _fetch(real_func, self, *args, **kwargs):
+  results = real_func(self, *args, **kwargs)
+  if _caching():
+    models = [model for model in results if isinstance(model, db.Model)]
+    _stats['recorded'] += len(models)
+    _store(models)
+  return results
+
+def _run_in_transaction(real_func, *args, **kwargs):
+  global _transaction_depth
+  _transaction_depth += 1
+  try:
+    return real_func(*args, **kwargs)
+  finally:
+    _transaction_depth -= 1
+
+def _method(func, real_func):
+  '''func bound to real_func, usable as a method.'''
+  def method(self, *args, **kwargs):
+    return func(real_func, self, *args, **kwargs)
+  return method
 
 def patch_db_get():
   """Put a request-local cache on db calls"""
@@ -43,9 +173,26 @@ def patch_db_get():
     _patch_called = True
     from functools import partial
     logging.info("called patch_db_get: patched")
-    # This patch only works in production?  I don't see the same Gets in development.
+    # Model.get and get_by_key_name call the module's get, so this covers them
     db.get = partial(getCached, db.get)
-    # TODO(dan): I think we should also patch db.put to clear the cache for the
-    # given object so we protect ourselves against get+put+get.
+    db.put = partial(_put, db.put)
+    db.delete = partial(_delete, db.delete)
+    db.run_in_transaction = partial(_run_in_transaction,
+                                    db.run_in_transaction)
+    # Model.put and delete call the datastore API directly
+    db.Model.put = _method(_put, db.Model.put)
+    db.Model.delete = _method(_delete, db.Model.delete)
+    for query_class in (db.Query, db.GqlQuery):
+      query_class.fetch = _method(_fetch, query_class.fetch)
   else:
     logging.info("called patch_db_get: skipped")
+
+
+class DbCacheMiddleware(object):
+  """Scopes the cache to each request."""
+  def process_request(self, request):
+    start_request()
+
+  def process_response(self, request, response):
+    end_request()
+    return response
@@ -14,115 +14,269 @@
 
 # Based on http://appengine-cookbook.appspot.com/recipe/collect-profiling-data-for-any-datastore-operation
 
+"""Per-request profiling of datastore calls.
+
+patch_appengine() hooks every datastore RPC.  For a sampled fraction of
+requests (DB_PROFILE_SAMPLE_RATE in settings.py), between start_request()
+and end_request() (see DbProfileMiddleware) it records the count, total and
+maximum latency of each (call, kind), e.g. ('RunQuery', 'Visit').
+
+At the end of a sampled request:
+- The profile is logged.
+- A warning is logged for each query (or Get, Put...) shape repeated more
+  than DB_PROFILE_REPEAT_THRESHOLD times, the sign of an N+1 loop that
+  should be one batch.
+- The profile is added to the current window's totals in memcache, with a
+  latency histogram per (call, kind).  get_recent_stats() merges the last
+  NUM_WINDOWS windows, see the datastore_profile view.
+
+Windows are updated with get and set, so concurrent requests may lose an
+update now and then, which is fine for sampled numbers.
+"""
+
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import memcache
-from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
 import logging
-import operator
-import datetime
+import random
+import time
+
+# Defaults for the settings
+SAMPLE_RATE = 0.1
+REPEAT_THRESHOLD = 10
 
-_requestmap = {}
-_call_num = 0
-_post_call_num = 0
-_callmap = {}
+WINDOW_SECONDS = 600
+NUM_WINDOWS = 6
+MEMCACHE_PREFIX = 'db_profile:'
+# Upper bounds of the histogram buckets, the last bucket has no bound
+HISTOGRAM_BOUNDS_MS = [10, 30, 100, 300, 1000, 3000]
+# Repeated shapes kept per window
+MAX_REPEATED = 20
+
+_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN: '<',
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: '<=',
+  datastore_pb.Query_Filter.GREATER_THAN: '>',
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+  datastore_pb.Query_Filter.EQUAL: '=',
+}
+
+# The RequestProfile of the current request, if it is sampled
+_profile = None
+
+# id(request protobuf) -> (start time, call, kind, shape) of calls in flight
+_in_flight = {}
 
 # True iff patch_appengine() is called
 _patch_called = False
 
-def log_callmap():
-  global _callmap
-  for call in _callmap:
-    logging.debug('DB_LOG: Got %s %d times' % (call, _callmap[call]))
-
-def clear_callmap():
-  global _callmap
-  _callmap = {}
-
-def clear_requestmap():
-  global _requestmap
-  _requestmap = {}
-
-def db_log(model, call, details=''):
-  """Call this method whenever the database is invoked.
-  
-  Args:
-    model: the model name (aka kind) that the operation is on
-    call: the kind of operation (Get/Put/...)
-    details: any text that should be added to the detailed log entry.
-  """
-  
-  # First, let's update memcache
-#  if model:
-#    stats = memcache.get('DB_TMP_STATS')
-#    if stats is None: stats = {}
-#    key = '%s_%s' % (call, model)
-#    stats[key] = stats.get(key, 0) + 1
-#    memcache.set('DB_TMP_STATS', stats)
-  
-  # Next, let's log for some more detailed analysis
-  logging.debug('DB_LOG: %s @ %s (%s)', call, model, details)
 
+def _setting(name, default):
+  from django.conf import settings
+  return getattr(settings, name, default)
 
-def patch_appengine():
-  def name_from_elem(elem):
-    return "%s:%s" % (elem.type(), elem.id()) 
+def histogram_labels():
+  labels = ['< %d ms' % bound for bound in HISTOGRAM_BOUNDS_MS]
+  labels.append('>= %d ms' % HISTOGRAM_BOUNDS_MS[-1])
+  return labels
 
-  """Apply a hook to app engine that logs db statistics."""
-  def model_name_from_key(key):
-    elem_list = key.path().element_list()
-    a_name = name_from_elem(elem_list[0])
-    if len(elem_list) > 1:
-      a_name += " " + name_from_elem(elem_list[1])
-    return a_name
+def _bucket(ms):
+  for index, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+    if ms < bound:
+      return index
+  return len(HISTOGRAM_BOUNDS_MS)
 
-  def prehook(service, call, request, response):
-    global _call_num, _callmap, _requestmap
 
-    a_key = "%s:%s" % (call, request)
-    _requestmap[a_key] = (datetime.datetime.now(), _call_num)
-    _call_num += 1
+class CallStats(object):
+  """Count, latency and histogram of one (call, kind)."""
+  def __init__(self):
+    self.count = 0
+    self.total_ms = 0.0
+    self.max_ms = 0.0
+    self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+
+  def add(self, ms):
+    self.count += 1
+    self.total_ms += ms
+    self.max_ms = max(self.max_ms, ms)
+    self.histogram[_bucket(ms)] += 1
+
+  def merge(self, other):
+    self.count += other.count
+    self.total_ms += other.total_ms
+    self.max_ms = max(self.max_ms, other.max_ms)
+    self.histogram = [mine + theirs for mine, theirs
+                      in zip(self.histogram, other.histogram)]
+
+  def mean_ms(self):
+    if not self.count:
+      return 0.0
+    return self.total_ms / self.count
+
+
+class RequestProfile(object):
+  """The datastore calls of one request."""
+  def __init__(self, path):
+    self.path = path
+    # (call, kind) -> CallStats
+    self.calls = {}
+    # shape -> count
+    self.shapes = {}
+
+  def add(self, call, kind, shape, ms):
+    self.calls.setdefault((call, kind), CallStats()).add(ms)
+    self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+  def repeated(self, threshold):
+    '''(shape, count) for shapes called more than threshold times.'''
+    return [(shape, count) for shape, count in self.shapes.items()
+            if count > threshold]
+
+  def log(self):
+    for (call, kind), stats in sorted(self.calls.items()):
+      logging.info('DB_LOG: %s %s @ %s: %d calls, %d ms total, %d ms max'
+                   % (self.path, call, kind, stats.count, stats.total_ms,
+                      stats.max_ms))
 
-    if call not in _callmap:
-      _callmap[call]  = 0
-    _callmap[call] += 1
-    loghook(service, call, request, response)
 
-  def delta_to_ms(delta):
-    return (delta.microseconds / 1000.0 + delta.seconds * 1000
-      + delta.days * 24 * 60 * 60 * 1000)
+def _kinds_of_keys(keys):
+  kinds = {}
+  for key in keys:
+    kinds[key.path().element_list()[-1].type()] = 1
+  return ','.join(sorted(kinds.keys()))
+
+def _query_shape(query):
+  '''The query without its values, e.g.
+  "Visit ancestor organization= visit_date>= order -visit_date".'''
+  parts = [query.kind()]
+  if query.has_ancestor():
+    parts.append('ancestor')
+  for a_filter in query.filter_list():
+    for prop in a_filter.property_list():
+      parts.append('%s%s' % (prop.name(), _OPERATORS.get(a_filter.op(), '?')))
+  for order in query.order_list():
+    direction = ''
+    if order.direction() == datastore_pb.Query_Order.DESCENDING:
+      direction = '-'
+    parts.append('order %s%s' % (direction, order.property()))
+  return ' '.join(parts)
+
+def _describe(call, request):
+  '''Return (kind, shape) of a call.'''
+  kind = ''
+  shape = ''
+  if call == 'Put':
+    kind = _kinds_of_keys([entity.key() for entity in request.entity_list()])
+  elif call in ('Get', 'Delete'):
+    kind = _kinds_of_keys(request.key_list())
+  elif call in ('RunQuery', 'Count'):
+    kind = request.kind()
+    shape = _query_shape(request)
+  return (kind, '%s %s' % (call, shape or kind))
+
+def start_request(path):
+  '''Decide whether to profile this request, and start if so.'''
+  global _profile, _in_flight
+  _in_flight = {}
+  _profile = None
+  if random.random() < _setting('DB_PROFILE_SAMPLE_RATE', SAMPLE_RATE):
+    _profile = RequestProfile(path)
+
+def end_request():
+  '''Log and record the profile of this request, if sampled.'''
+  global _profile, _in_flight
+  profile = _profile
+  _profile = None
+  _in_flight = {}
+  if not profile or not profile.calls:
+    return
+
+  profile.log()
+  repeated = profile.repeated(_setting('DB_PROFILE_REPEAT_THRESHOLD',
+                                       REPEAT_THRESHOLD))
+  for shape, count in repeated:
+    logging.warning('DB_LOG: %s repeated %d times in %s, batch it?'
+                    % (shape, count, profile.path))
+  _add_to_window(profile, repeated)
+
+def _window_key(window):
+  return '%s%d' % (MEMCACHE_PREFIX, window)
+
+def _add_to_window(profile, repeated):
+  key = _window_key(int(time.time() / WINDOW_SECONDS))
+  stats = memcache.get(key)
+  if stats is None:
+    stats = {'requests': 0, 'calls': {}, 'repeated': []}
+  stats['requests'] += 1
+  for call_kind, call_stats in profile.calls.items():
+    stats['calls'].setdefault(call_kind, CallStats()).merge(call_stats)
+  stats['repeated'].extend([(profile.path, shape, count)
+                            for shape, count in repeated])
+  stats['repeated'] = stats['repeated'][-MAX_REPEATED:]
+  memcache.set(key, stats, time=WINDOW_SECONDS * NUM_WINDOWS)
+
+def get_recent_stats():
+  '''Merge the last NUM_WINDOWS windows.
+
+  Returns a dict with the number of profiled 'requests', 'calls': a list
+  of (call, kind, CallStats) sorted by total time, most first, and
+  'repeated': a list of (path, shape, count).'''
+  now = int(time.time() / WINDOW_SECONDS)
+  keys = [_window_key(window) for window in range(now - NUM_WINDOWS + 1,
+                                                  now + 1)]
+  windows = memcache.get_multi(keys)
+  requests = 0
+  calls = {}
+  repeated = []
+  for key in keys:
+    stats = windows.get(key)
+    if not stats:
+      continue
+    requests += stats['requests']
+    for call_kind, call_stats in stats['calls'].items():
+      calls.setdefault(call_kind, CallStats()).merge(call_stats)
+    repeated.extend(stats['repeated'])
+
+  calls = [(call, kind, call_stats)
+           for (call, kind), call_stats in calls.items()]
+  calls.sort(key=lambda row: -row[2].total_ms)
+  return {'requests': requests, 'calls': calls, 'repeated': repeated}
+
+
+def patch_appengine():
+  """Apply a hook to app engine that profiles datastore calls."""
+  def prehook(service, call, request, response):
+    if _profile is None:
+      return
+    kind, shape = _describe(call, request)
+    _in_flight[id(request)] = (time.time(), call, kind, shape)
 
   def posthook(service, call, request, response):
-    global _post_call_num
-
-    a_key = "%s:%s" % (call, request)
-    (time1, _call_num) = _requestmap[a_key]
-    delta = datetime.datetime.now() - time1
-    a_key_no_newlines = a_key.replace("\n", " ")
-    logging.debug("DB_LOG: call %4d time %6d ms, request %s" %
-                  (_call_num, delta_to_ms(delta), a_key_no_newlines))
-    _post_call_num += 1
-
-  def loghook(service, call, request, response):
-#    logging.debug("service %s, call %s, request %s, response %s"
-#                 % (service, call, request, response))
-    assert service == 'datastore_v3'
-    if call == 'Put':
-      for entity in request.entity_list():
-        db_log(model_name_from_key(entity.key()), call)
-    elif call in ('Get', 'Delete'):
-      for key in request.key_list():
-        db_log(model_name_from_key(key), call)
-    elif call == 'RunQuery':
-      kind = datastore_index.CompositeIndexForQuery(request)[1]
-      db_log(kind, call)
-    else:
-      db_log(None, call)
+    if _profile is None:
+      return
+    started = _in_flight.pop(id(request), None)
+    if started:
+      start_time, call, kind, shape = started
+      _profile.add(call, kind, shape, (time.time() - start_time) * 1000)
 
   global _patch_called
-  assert not _patch_called
+  # Like db_cache.patch_db_get(), this may be called again in production
+  if _patch_called:
+    logging.info("called patch_appengine: skipped")
+    return
   logging.info("called patch_appengine")
   _patch_called = True
   apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
       'db_log', prehook, 'datastore_v3')
   apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
       'db_log', posthook, 'datastore_v3')
+
+
+class DbProfileMiddleware(object):
+  """Scopes the profile to each request."""
+  def process_request(self, request):
+    start_request(request.path)
+
+  def process_response(self, request, response):
+    end_request()
+    return response
@@ -7,6 +7,7 @@ Created on Sep 18, 2011
 import logging
 import healthdb.util
 import math
+import array
 
 from xml.dom import minidom
 import time
@@ -20,6 +21,13 @@ import urllib
 from xml.parsers.expat import ExpatError
 import csv
 
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import new as md5
+
+from scorecache import ScoreCache
+
 # Boundaries for input values from WHO's AnthroComputation.cs.
 
 # The min weight for a child, in kg.
@@ -97,7 +105,11 @@ def calculate_scores(pmap, visit=None):
       Arm circumference-for-age : acanthro.csv
       Triceps skinfold-for-age : tsanthro.csv
       Subscapular skinfold-for-age: ssanthro.csv """
-      
+  return healthdb.models.VisitStatistics(parent=visit,
+                                         **calculate_attrmap(pmap))
+
+def calculate_attrmap(pmap):
+  """The attributes of the VisitStatistics that calculate_scores returns."""
   attrmap = {}
   attrmap['generated_date'] = datetime.now()
  
@@ -140,8 +152,128 @@ def calculate_scores(pmap, visit=None):
       percentile = zscoreToPercentile(zscore)
       attrmap[str(att)] = ZscoreAndPercentile(zscore, percentile)
 
+  return attrmap
+
+# Calculated scores, keyed by their inputs.  Set use_memcache=True to share
+# them between instances; a memcache get costs about as much as the
+# calculation itself with the reference tables in memory, so it is off.
+score_cache = ScoreCache(max_size=2000, ttl=24*60*60, use_memcache=False)
+
+def calculate_scores_cached(pmap, visit=None):
+  """Like calculate_scores, but reuses scores calculated for the same inputs.
+
+  See score_cache.counters() for hits and misses.  The cache holds the
+  scores without generated_date, which is set to now on each call.
+  """
+  key = ScoreCache.make_key(reference_data_version(), pmap)
+  cached = score_cache.get(key)
+  if cached is None:
+    cached = calculate_attrmap(pmap)
+    del cached['generated_date']
+    score_cache.set(key, cached)
+  attrmap = {'generated_date': datetime.now()}
+  for name, value in cached.items():
+    # Each VisitStatistics gets its own ZscoreAndPercentiles
+    if isinstance(value, ZscoreAndPercentile):
+      value = ZscoreAndPercentile(value.zscore, value.percentile)
+    attrmap[name] = value
   return healthdb.models.VisitStatistics(parent=visit, **attrmap)
 
+def calculate_scores_batch(pmaps):
+  """Calculate the anthropometric values for many visits at once.
+
+  pmaps holds the same keys as the pmap of calculate_scores, but each value
+  is a column: a list with one entry per visit.  The keys are
+  'date_of_birth', 'date_of_visit', 'sex', 'weight', 'length', 'measured',
+  'hasOedema' and, optionally, 'head_circumference' (an entry of None means
+  the visit has no head circumference).
+
+  The work is done one column at a time against the in-memory reference
+  tables, using the same arithmetic as calculate_scores, so every value is
+  identical to what calculate_scores returns for the same visit.
+
+  Returns a map of columns, each as long as the input: 'age_in_days',
+  'weight', 'height', 'head_circumference', 'body_mass_index', and one
+  column of ZscoreAndPercentile per name in VisitStatistics.INDICATORS.
+  An indicator entry is None where calculate_scores would not set it.
+  """
+  load_reference_tables()
+  anthro = Anthro()
+  NaN = healthdb.util.NaN
+
+  num = len(pmaps['weight'])
+  weights = pmaps['weight']
+  oedemas = pmaps['hasOedema']
+  hcs = pmaps.get('head_circumference') or [None] * num
+  sexes = [Sex.map[sex] for sex in pmaps['sex']]
+
+  ages = []
+  for birth_date, visit_date in zip(pmaps['date_of_birth'],
+                                    pmaps['date_of_visit']):
+    if visit_date != None and birth_date != None:
+      ages.append((visit_date - birth_date).days)
+    else:
+      ages.append(-1)
+
+  lohs = map(NormalizedLengthOrHeight, ages, pmaps['length'],
+             pmaps['measured'])
+  heights = [loh.lengthOrHeight for loh in lohs]
+
+  bmis = []
+  for idx in range(num):
+    if oedemas[idx]:
+      bmis.append(NaN)
+    else:
+      bmis.append(heightAndWeightToBmi(heights[idx], weights[idx]))
+
+  zscores = {}
+  zscores['body_mass_index_for_age'] = []
+  zscores['weight_for_length_or_height'] = []
+  zscores['weight_for_age'] = []
+  for idx in range(num):
+    if oedemas[idx]:
+      zscores['body_mass_index_for_age'].append(NaN)
+      zscores['weight_for_length_or_height'].append(NaN)
+      zscores['weight_for_age'].append(NaN)
+    else:
+      zscores['body_mass_index_for_age'].append(
+        anthro.getBodyMassIndexZscoreConfigForAge(
+          sexes[idx], ages[idx], bmis[idx], weights[idx], heights[idx]))
+      zscores['weight_for_length_or_height'].append(
+        anthro.getWeightZscoreConfigForLengthOrHeight(
+          sexes[idx], lohs[idx], weights[idx], ages[idx]))
+      zscores['weight_for_age'].append(
+        anthro.getWeightZscoreConfigForAge(
+          sexes[idx], ages[idx], weights[idx]))
+
+  zscores['length_or_height_for_age'] = map(
+    anthro.getLengthOrHeightZscoreConfigForAge,
+    sexes, ages, heights, pmaps['measured'])
+
+  zscores['head_circumference_for_age'] = []
+  for idx in range(num):
+    if hcs[idx] is None:
+      zscores['head_circumference_for_age'].append(None)
+    else:
+      zscores['head_circumference_for_age'].append(
+        anthro.getHeadCircumferenceZscoreConfigForAge(
+          sexes[idx], ages[idx], hcs[idx]))
+
+  columns = {'age_in_days': ages,
+             'weight': list(weights),
+             'height': heights,
+             'head_circumference': list(hcs),
+             'body_mass_index': bmis}
+  for att in VisitStatistics.INDICATORS:
+    column = []
+    for zscore in zscores[att]:
+      if zscore is None:
+        column.append(None)
+      else:
+        column.append(ZscoreAndPercentile(zscore, zscoreToPercentile(zscore)))
+    columns[att] = column
+  return columns
+
 class Anthro():
   """Anthro contains all the parameters for the Box-Cox score computations. """
     
@@ -162,9 +294,9 @@ class Anthro():
       ret = healthdb.util.NaN
     else:
       if loh.measured == Measured.STANDING:
-        config = AnthroConfig('growthcalc/wfhanthro.csv', weight, sex, loh.lengthOrHeight)
+        config = AnthroConfig('growthcalc/wfhanthro.csv', weight, sex, loh.lengthOrHeight, interpolate=True)
       elif loh.measured == Measured.RECUMBENT:
-        config = AnthroConfig('growthcalc/wflanthro.csv', weight, sex, loh.lengthOrHeight)
+        config = AnthroConfig('growthcalc/wflanthro.csv', weight, sex, loh.lengthOrHeight, interpolate=True)
       ret = zscoreFromAttribute(config)
     return ret
   
@@ -212,16 +344,152 @@ def zscoreFromAttribute(anthroConfig):
   m: median, and 
   s: variation coefficient as used in calculating zscore
   loh: 'L' for length, 'H' for height """
-  for row in csv.DictReader(open(anthroConfig.fileName)):
-    if 'age' in row:
-      dataAgeHeightOrLength = row['age']
-    elif 'length' in row:
-      dataAgeHeightOrLength = row['length']
-    elif 'height' in row:
-      dataAgeHeightOrLength = row['height']
-    if int(row['sex']) == anthroConfig.sex and float(dataAgeHeightOrLength) == anthroConfig.ageHeightOrLength:
-      return zscoreOtherRestricted(anthroConfig.measureKey, float(row['l']), float(row['m']), float(row['s']), True)    
-  return healthdb.util.NaN
+  lms = get_reference_table(anthroConfig.fileName).lookup(
+                               anthroConfig.sex, anthroConfig.ageHeightOrLength,
+                               anthroConfig.interpolate)
+  if lms is None:
+    return healthdb.util.NaN
+  power, median, variationCoefficient = lms
+  return zscoreOtherRestricted(anthroConfig.measureKey, power, median,
+                               variationCoefficient, True)
+
+class ReferenceTable():
+  """The L, M and S columns of one WHO data file, held in memory.
+
+  The file is read once per process, on first use (or from
+  load_reference_tables()).  Rows are stored per sex in compact arrays
+  indexed by their offset on the file's grid: 1 day for age files,
+  0.1 cm for length and height files.  A lookup is then O(1) instead of a
+  scan of the file."""
+
+  # Grid steps per unit of the file's second column
+  SCALES = {'age': 1, 'length': 10, 'height': 10}
+
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.column = None
+    self.scale = None
+    # sex -> (first grid key, l array, m array, s array)
+    self._rows = None
+
+  def is_loaded(self):
+    return self._rows is not None
+
+  def load(self):
+    if self.is_loaded():
+      return
+    keyed = {}
+    for row in csv.DictReader(open(self.fileName)):
+      if self.scale is None:
+        for column in ReferenceTable.SCALES:
+          if column in row:
+            self.column = column
+            self.scale = ReferenceTable.SCALES[column]
+      key = int(round(float(row[self.column]) * self.scale))
+      keyed.setdefault(int(row['sex']), {})[key] = (
+        float(row['l']), float(row['m']), float(row['s']))
+
+    rows = {}
+    for sex, values in keyed.items():
+      first = min(values)
+      size = max(values) - first + 1
+      # Grid points missing from the file stay NaN
+      lcol = array.array('d', [healthdb.util.NaN] * size)
+      mcol = array.array('d', [healthdb.util.NaN] * size)
+      scol = array.array('d', [healthdb.util.NaN] * size)
+      for key, (power, median, variationCoefficient) in values.items():
+        lcol[key - first] = power
+        mcol[key - first] = median
+        scol[key - first] = variationCoefficient
+      rows[sex] = (first, lcol, mcol, scol)
+    self._rows = rows
+    logging.info("Loaded WHO reference table %s" % self.fileName)
+
+  def lookup(self, sex, ageHeightOrLength, interpolate=False):
+    """Return (l, m, s) for sex at ageHeightOrLength, or None.
+
+    A value exactly on the grid returns that row.  Otherwise, if
+    interpolate is True, L, M and S are linearly interpolated between the
+    neighbouring grid points, as WHO Anthro does for weight-for-length and
+    weight-for-height; if it is False there is no match.
+    """
+    self.load()
+    if sex not in self._rows:
+      return None
+    try:
+      scaled = ageHeightOrLength * self.scale
+      key = int(round(scaled))
+    except (TypeError, ValueError, OverflowError):
+      # NaN, infinite or missing measurement
+      return None
+    if key / float(self.scale) == ageHeightOrLength:
+      return self._row(sex, key)
+    if not interpolate:
+      return None
+
+    lowKey = int(math.floor(scaled))
+    low = self._row(sex, lowKey)
+    high = self._row(sex, lowKey + 1)
+    if low is None or high is None:
+      return None
+    fraction = scaled - lowKey
+    return tuple([lowVal + fraction * (highVal - lowVal)
+                  for lowVal, highVal in zip(low, high)])
+
+  def _row(self, sex, key):
+    """Return (l, m, s) at grid key, or None if the file has no such row."""
+    first, lcol, mcol, scol = self._rows[sex]
+    idx = key - first
+    if idx < 0 or idx >= len(lcol) or healthdb.util.isNaN(lcol[idx]):
+      return None
+    return (lcol[idx], mcol[idx], scol[idx])
+
+# WHO data files used by Anthro
+ANTHRO_FILES = ['growthcalc/weianthro.csv', 'growthcalc/lenanthro.csv',
+                'growthcalc/wflanthro.csv', 'growthcalc/wfhanthro.csv',
+                'growthcalc/bmianthro.csv', 'growthcalc/hcanthro.csv']
+
+# Increment when the calculation changes in a way that changes scores, so
+# cached scores (see score_cache) are recalculated.
+CALCULATION_VERSION = 2
+
+# fileName -> ReferenceTable, shared by all requests in this process
+_reference_tables = {}
+
+# See reference_data_version()
+_reference_data_version = None
+
+def get_reference_table(fileName):
+  table = _reference_tables.get(fileName)
+  if table is None:
+    table = ReferenceTable(fileName)
+    _reference_tables[fileName] = table
+  return table
+
+def load_reference_tables():
+  """Read all the WHO data files into memory.
+
+  This is the warm-up hook: it is called by the /_ah/warmup handler
+  (the 'warmup' inbound service in app.yaml) so a new instance has its
+  tables loaded before it serves user requests.  It is safe to call more
+  than once."""
+  for fileName in ANTHRO_FILES:
+    get_reference_table(fileName).load()
+
+def reference_data_version():
+  """A string that changes whenever the WHO data files or the calculation do.
+
+  It is a digest of the files' contents plus CALCULATION_VERSION, computed
+  once per process.
+  """
+  global _reference_data_version
+  if _reference_data_version is None:
+    digest = md5()
+    for fileName in ANTHRO_FILES:
+      digest.update(open(fileName, 'rb').read())
+    _reference_data_version = '%d-%s' % (CALCULATION_VERSION,
+                                         digest.hexdigest())
+  return _reference_data_version
 
 def zscoreOtherRestricted(measure, power, median, variationCoefficient, computeFinalZScore):
   """Return a restricted zscore.
@@ -338,11 +606,14 @@ class ZscoreAndPercentile():
     return healthdb.util.isNaN(self.percentile)
 
 class AnthroConfig:
-  def __init__(self, fileName, measureKey, sex, ageHeightOrLength):
+  def __init__(self, fileName, measureKey, sex, ageHeightOrLength,
+               interpolate=False):
     self.fileName = fileName
     self.measureKey = measureKey
     self.sex = sex
     self.ageHeightOrLength = ageHeightOrLength
+    # Interpolate between grid points of fileName (see ReferenceTable.lookup)
+    self.interpolate = interpolate
 
 class ZscoreAndPercentileProperty(db.Property):
   """A ZscoreAndPercentile property class."""
@@ -552,6 +823,47 @@ class VisitStatistics(db.Model):
                                      hasOedema,
                                      visit)
 
+  @staticmethod
+  def get_stats_for_visits(visits):
+    """Like get_stats_for_visit, for many visits at once.
+
+    Patients are read with one batch get, and the scores come from
+    calculate_scores_batch.  Returns a list of (unsaved) VisitStatistics,
+    one per visit, each with its visit as parent.
+    """
+    patients = db.get([visit.parent_key() for visit in visits])
+    pmaps = {'date_of_birth': [], 'date_of_visit': [], 'sex': [],
+             'weight': [], 'length': [], 'measured': [],
+             'head_circumference': [], 'hasOedema': []}
+    for visit, patient in zip(visits, patients):
+      pmaps['date_of_birth'].append(patient.birth_date)
+      pmaps['date_of_visit'].append(visit.visit_date)
+      pmaps['sex'].append(VisitStatistics.SEX_MAP[patient.sex])
+      pmaps['weight'].append(visit.weight)
+      pmaps['length'].append(visit.height)
+      pmaps['measured'].append(
+        VisitStatistics.HEIGHT_POSITION_MAP[visit.height_position])
+      # head_circumference is optional, as in get_stats
+      pmaps['head_circumference'].append(visit.head_circumference or None)
+      # TODO(dan): Add oedema as an attribute in future
+      pmaps['hasOedema'].append(False)
+
+    columns = calculate_scores_batch(pmaps)
+    generated_date = datetime.now()
+    visit_stats = []
+    for idx in range(len(visits)):
+      attrmap = {'generated_date': generated_date}
+      for att in ['age_in_days', 'weight', 'height', 'body_mass_index']:
+        attrmap[att] = columns[att][idx]
+      if columns['head_circumference'][idx] is not None:
+        attrmap['head_circumference'] = columns['head_circumference'][idx]
+      for att in VisitStatistics.INDICATORS:
+        if columns[att][idx] is not None:
+          # map key is str(att) because **attrmap requires string keys
+          attrmap[str(att)] = columns[att][idx]
+      visit_stats.append(VisitStatistics(parent=visits[idx], **attrmap))
+    return visit_stats
+
   @staticmethod
   def get_stats(birth_date, visit_date, sex, weight, head_circumference, height,
                 height_position, hasOedema, visit = None):
@@ -591,8 +903,85 @@ class VisitStatistics(db.Model):
         logging.error("get_stats_for_visit: %s" % e)
         visit_stats = None
     else:
-      visit_stats = calculate_scores(pmap, visit)
+      visit_stats = calculate_scores_cached(pmap, visit)
 
     return visit_stats
   
   
+
+
+class PackedVisitStatisticsProperty(db.Property):
+  """A VisitStatistics packed into one unindexed string on its Visit.
+
+  Reading it needs no datastore get, unlike a reference to a separate
+  VisitStatistics entity.  The value is an unsaved VisitStatistics.
+
+  Packed format, fields separated by '|':
+    version|generated_date|age_in_days|body_mass_index|<indicators>
+  with one zscore:percentile field per VisitStatistics.INDICATORS, in order,
+  empty for an indicator that is not set.
+  """
+  data_type = VisitStatistics
+
+  PACK_VERSION = '1'
+  DATE_FORMAT = '%Y%m%d%H%M%S'
+
+  @staticmethod
+  def pack(visit_stats):
+    fields = [PackedVisitStatisticsProperty.PACK_VERSION,
+              visit_stats.generated_date.strftime(
+                PackedVisitStatisticsProperty.DATE_FORMAT),
+              str(visit_stats.age_in_days),
+              repr(visit_stats.body_mass_index)]
+    for indicator in VisitStatistics.INDICATORS:
+      zandp = getattr(visit_stats, indicator, None)
+      if zandp:
+        fields.append('%r:%r' % (zandp.zscore, zandp.percentile))
+      else:
+        fields.append('')
+    return '|'.join(fields)
+
+  @staticmethod
+  def unpack(value):
+    fields = value.split('|')
+    assert fields[0] == PackedVisitStatisticsProperty.PACK_VERSION, (
+      'unknown packed statistics: %s' % value)
+    stime = time.strptime(fields[1], PackedVisitStatisticsProperty.DATE_FORMAT)
+    attrmap = {'generated_date': datetime(*stime[:6]),
+               'age_in_days': int(fields[2]),
+               'body_mass_index': _parse_float(fields[3])}
+    for indicator, field in zip(VisitStatistics.INDICATORS, fields[4:]):
+      if field:
+        zscore, percentile = field.split(':')
+        # map key is str(att) because **attrmap requires string keys
+        attrmap[str(indicator)] = ZscoreAndPercentile(_parse_float(zscore),
+                                                      _parse_float(percentile))
+    return VisitStatistics(**attrmap)
+
+  def get_value_for_datastore(self, model_instance):
+    visit_stats = super(PackedVisitStatisticsProperty, self
+                       ).get_value_for_datastore(model_instance)
+    if visit_stats:
+      # db.Text is not indexed
+      visit_stats = db.Text(PackedVisitStatisticsProperty.pack(visit_stats))
+    return visit_stats
+
+  def make_value_from_datastore(self, value):
+    if value:
+      return PackedVisitStatisticsProperty.unpack(value)
+    return None
+
+  def validate(self, value):
+    if value is not None and not isinstance(value, VisitStatistics):
+      raise db.BadValueError(
+        "Property %s must be a VisitStatistics." % self.name)
+    return super(PackedVisitStatisticsProperty, self).validate(value)
+
+def _parse_float(numstr):
+  """float(numstr), or NaN for any spelling of NaN."""
+  try:
+    return float(numstr)
+  except ValueError, dummy:
+    # On some platforms, float('NaN') doesn't work
+    assert healthdb.util.isNaNString(numstr), 'value is %s' % numstr
+    return healthdb.util.NaN
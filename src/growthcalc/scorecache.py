@@ -0,0 +1,112 @@
+'''
+A bounded cache for calculated growth scores.
+
+Usage:
+
+cache = ScoreCache(max_size=1000, ttl=24*60*60)
+key = cache.make_key(version, pmap)
+attrmap = cache.get(key)
+if attrmap is None:
+  attrmap = ...calculate...
+  cache.set(key, attrmap)
+
+The first tier is a per-process dict, evicted least-recently-used when it
+grows past max_size.  If use_memcache is True, misses there fall through to
+memcache, so instances share what they have calculated.
+
+Entries expire after ttl seconds.  The key includes a version string, so
+when the reference data (or the calculation) changes, old entries are
+simply never found again and age out.
+'''
+
+import logging
+import time
+
+from google.appengine.api import memcache
+
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import new as md5
+
+class ScoreCache():
+  # memcache namespace for this cache's keys
+  MEMCACHE_PREFIX = 'growthcalc:scores:'
+
+  def __init__(self, max_size=1000, ttl=24*60*60, use_memcache=False):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.use_memcache = use_memcache
+    # key -> [expires, last_used, value]
+    self._entries = {}
+    self._clock = 0
+    self.clear_counters()
+
+  def clear_counters(self):
+    self.hits = 0
+    self.memcache_hits = 0
+    self.misses = 0
+
+  def clear(self):
+    self._entries = {}
+
+  def counters(self):
+    '''Return hit and miss counts since the last clear_counters().'''
+    return {'hits': self.hits,
+            'memcache_hits': self.memcache_hits,
+            'misses': self.misses,
+            'size': len(self._entries)}
+
+  @staticmethod
+  def make_key(version, pmap):
+    '''Key for the inputs in pmap, ignoring output-only entries like format.
+
+    repr() keeps full float precision, so different inputs never share a key.
+    '''
+    names = sorted([name for name in pmap if name != 'format'])
+    parts = ['%s=%r' % (name, pmap[name]) for name in names]
+    return md5('%s|%s' % (version, '|'.join(parts))).hexdigest()
+
+  def get(self, key):
+    '''Return the value for key, or None.'''
+    now = time.time()
+    entry = self._entries.get(key)
+    if entry is not None:
+      if entry[0] > now:
+        self._clock += 1
+        entry[1] = self._clock
+        self.hits += 1
+        return entry[2]
+      del self._entries[key]
+
+    if self.use_memcache:
+      value = memcache.get(ScoreCache.MEMCACHE_PREFIX + key)
+      if value is not None:
+        self.memcache_hits += 1
+        self._set_local(key, value, now)
+        return value
+
+    self.misses += 1
+    return None
+
+  def set(self, key, value):
+    self._set_local(key, value, time.time())
+    if self.use_memcache:
+      if not memcache.set(ScoreCache.MEMCACHE_PREFIX + key, value,
+                          time=self.ttl):
+        logging.warning('ScoreCache: memcache set failed')
+
+  def _set_local(self, key, value, now):
+    if key not in self._entries and len(self._entries) >= self.max_size:
+      self._evict()
+    self._clock += 1
+    self._entries[key] = [now + self.ttl, self._clock, value]
+
+  def _evict(self):
+    '''Drop the least recently used quarter of the entries.
+
+    Evicting in bulk keeps the bookkeeping to one counter per entry.
+    '''
+    by_age = sorted(self._entries.items(), key=lambda item: item[1][1])
+    for key, dummy in by_age[:max(1, len(by_age) / 4)]:
+      del self._entries[key]
@@ -5,14 +5,31 @@ Usage:
 increment('counter1')
 count = get_count('counter')
 
+Counts are cached in memcache for CACHE_TIME seconds, and writes update the
+cached count with incr/decr, so reading a counter usually costs no datastore
+RPCs.  On a cache miss, the shards are read by key in one batch get.
+
+Each process remembers the number of shards of the counters it writes.  A
+stale number only spreads increments over fewer shards; reads always get
+the current number.
+
 Modified from http://code.google.com/appengine/articles/sharding_counters.html
 
 Original is Apache license,
 see http://code.google.com/p/google-app-engine-samples.
 '''
+from google.appengine.api import memcache
 from google.appengine.ext import db
 import random
 
+# memcache namespace for counts
+MEMCACHE_PREFIX = 'counter:'
+# Seconds a cached count lives, bounding how long a lost update can persist
+CACHE_TIME = 10 * 60
+
+# counter name -> GeneralCounterShardConfig, for writers
+_configs = {}
+
 class GeneralCounterShardConfig(db.Model):
     """Tracks the number of shards for each named counter."""
     name = db.StringProperty(required=True)
@@ -25,23 +42,54 @@ class GeneralCounterShard(db.Model):
     count = db.IntegerProperty(required=True, default=0)
 
 
+def _memcache_key(name):
+    return MEMCACHE_PREFIX + name
+
+
+def _shard_key_name(name, index):
+    return name + str(index)
+
+
+def _get_config(name):
+    """The counter's config, read once per process."""
+    config = _configs.get(name)
+    if config is None:
+        config = GeneralCounterShardConfig.get_or_insert(name, name=name)
+        _configs[name] = config
+    return config
+
+
+def _get_count_from_shards(name):
+    config = GeneralCounterShardConfig.get_by_key_name(name)
+    if config is None:
+        return 0
+    keys = [db.Key.from_path('GeneralCounterShard', _shard_key_name(name, index))
+            for index in range(config.num_shards)]
+    total = 0
+    for counter in db.get(keys):
+        if counter is not None:
+            total += counter.count
+    return total
+
+
 def get_count(name):
     """Retrieve the value for a given sharded counter.
 
     Parameters:
       name - The name of the counter
     """
-    total = 0
-    for counter in GeneralCounterShard.all().filter('name = ', name):
-        total += counter.count
+    total = memcache.get(_memcache_key(name))
+    if total is None:
+        total = _get_count_from_shards(name)
+        memcache.add(_memcache_key(name), total, time=CACHE_TIME)
     return total
 
 
 def set_value(name, value):
-    config = GeneralCounterShardConfig.get_or_insert(name, name=name)
+    config = _get_config(name)
     def txn():
         for index in range(config.num_shards):
-            shard_name = name + str(index)
+            shard_name = _shard_key_name(name, index)
             counter = GeneralCounterShard.get_by_key_name(shard_name)
             if counter is None:
                 counter = GeneralCounterShard(key_name=shard_name, name=name)
@@ -51,6 +99,7 @@ def set_value(name, value):
                 counter.count = 0
             counter.put()
     db.run_in_transaction(txn)
+    memcache.set(_memcache_key(name), value, time=CACHE_TIME)
 
 
 def increment(name, delta=1):
@@ -62,16 +111,21 @@ def increment(name, delta=1):
 
     If the counter doesn't exist, its value after this function is delta.
     """
-    config = GeneralCounterShardConfig.get_or_insert(name, name=name)
+    config = _get_config(name)
     def txn():
         index = random.randint(0, config.num_shards - 1)
-        shard_name = name + str(index)
+        shard_name = _shard_key_name(name, index)
         counter = GeneralCounterShard.get_by_key_name(shard_name)
         if counter is None:
             counter = GeneralCounterShard(key_name=shard_name, name=name)
         counter.count += delta
         counter.put()
     db.run_in_transaction(txn)
+    # If the count is not cached, the next get_count() reads the shards
+    if delta >= 0:
+        memcache.incr(_memcache_key(name), delta)
+    else:
+        memcache.decr(_memcache_key(name), -delta)
 
 
 def increase_shards(name, num):
@@ -83,9 +137,12 @@ def increase_shards(name, num):
       num - How many shards to use
 
     """
-    config = GeneralCounterShardConfig.get_or_insert(name, name=name)
     def txn():
+        config = GeneralCounterShardConfig.get_by_key_name(name)
+        if config is None:
+            config = GeneralCounterShardConfig(key_name=name, name=name)
         if config.num_shards < num:
             config.num_shards = num
             config.put()
-    db.run_in_transaction(txn)
+        return config
+    _configs[name] = db.run_in_transaction(txn)
@@ -0,0 +1,172 @@
+'''CSV export of an organization's visits.
+
+Visits are read in pages of PAGE_SIZE by key, filtered by organization in
+the query, with each page's patients and statistics read in batches.  Rows
+go to one csv.writer as they are read, so nothing holds the whole export.
+
+Usage:
+
+write_visits_csv(out, org)            # all at once, e.g. to a file
+
+export = start_export(org)            # as task queue jobs, see below
+...
+for data in export.get_shard_data():  # once export.done
+  response.write(data)
+
+A task queue export writes up to PAGES_PER_SHARD pages per task into a
+VisitExportShard, child of its VisitExport, then queues the next task.  The
+shard and the export's cursor are stored in one transaction, so a retried
+task resumes where the last successful one stopped.
+'''
+
+import csv
+import logging
+from StringIO import StringIO
+
+from google.appengine.ext import db
+try:
+  from google.appengine.api.taskqueue import Task
+except ImportError:
+  from google.appengine.api.labs.taskqueue import Task
+
+from django.core.urlresolvers import reverse
+from ragendja.dbutils import prefetch_references
+
+import models
+
+PAGE_SIZE = 100
+# About 500 bytes a visit, keeping a shard well below 1MB
+PAGES_PER_SHARD = 10
+
+
+def get_visit_pages(org, cursor=None):
+  '''Yield (visits, patient_cache, cursor) for each page of org's visits.
+
+  cursor is where the next page starts.  Pass it back in to resume.
+  '''
+  query = models.Visit.all().filter('organization =', org).order('__key__')
+  if cursor:
+    query.with_cursor(cursor)
+  visits = query.fetch(PAGE_SIZE)
+  while visits:
+    patient_cache = models.PatientCache(
+      [visit.parent_key() for visit in visits])
+    prefetch_references(visits, 'visit_statistics')
+    cursor = query.cursor()
+    yield (visits, patient_cache, cursor)
+    if len(visits) < PAGE_SIZE:
+      break
+    query.with_cursor(cursor)
+    visits = query.fetch(PAGE_SIZE)
+
+def write_visits_csv(out, org, cursor=None, max_pages=None):
+  '''Write org's visits to out (e.g. a file) as CSV.
+
+  The header is written only when starting, i.e. when cursor is None.
+  Returns (number of visits written, cursor to resume from), where the
+  cursor is None when all visits are written.
+  '''
+  writer = csv.writer(out)
+  if cursor is None:
+    writer.writerow(models.Visit.export_csv_header_names())
+
+  num = 0
+  pages = 0
+  for visits, patient_cache, next_cursor in get_visit_pages(org, cursor):
+    for visit in visits:
+      patient = patient_cache.get_patient(visit.parent_key())
+      if not patient:
+        logging.warning("Visit %s has no patient, skipping" % visit.key())
+        continue
+      writer.writerow(visit.export_csv_values(patient))
+      num += 1
+    pages += 1
+    if (pages % 10) == 0: logging.info("wrote %d visits" % num)
+    if max_pages and pages >= max_pages and len(visits) == PAGE_SIZE:
+      return (num, next_cursor)
+  return (num, None)
+
+
+class VisitExport(db.Model):
+  """A CSV export of an organization's visits, built by tasks."""
+  organization = db.StringProperty(required=True)
+  created_date = db.DateTimeProperty(required=True, auto_now_add=True)
+  # Where the next shard starts
+  cursor = db.TextProperty(required=False)
+  num_shards = db.IntegerProperty(required=True, default=0)
+  num_visits = db.IntegerProperty(required=True, default=0)
+  done = db.BooleanProperty(required=True, default=False)
+
+  def get_shard_data(self):
+    '''Yield the CSV data of each shard, in order.'''
+    BATCH_SIZE = 20
+    for start in range(0, self.num_shards, BATCH_SIZE):
+      names = [VisitExportShard.key_name_for(number) for number in
+               range(start, min(start + BATCH_SIZE, self.num_shards))]
+      for shard in VisitExportShard.get_by_key_name(names, parent=self):
+        yield shard.data
+
+  @staticmethod
+  def get_for_org(org):
+    '''Exports of org, newest first.'''
+    return VisitExport.all().filter('organization =', org).order(
+      '-created_date')
+
+
+class VisitExportShard(db.Model):
+  """Part of a VisitExport, its parent."""
+  number = db.IntegerProperty(required=True)
+  data = db.BlobProperty(required=True)
+
+  @staticmethod
+  def key_name_for(number):
+    return 'shard%d' % number
+
+
+def start_export(org):
+  '''Store a new VisitExport of org and queue its first task.'''
+  export = VisitExport(organization=org)
+  export.put()
+  queue_export_task(export)
+  return export
+
+def queue_export_task(export):
+  Task(url=reverse('healthdb.views.export_visits_task'), method='POST',
+       params={'export': str(export.key()),
+               'shard': export.num_shards}).add()
+
+def run_export_task(export_key, shard_number):
+  '''Write the next shard of an export.  Called from the task's view.'''
+  export = VisitExport.get(export_key)
+  if not export or export.done or export.num_shards != shard_number:
+    # Deleted, or a retry of a task that already succeeded
+    logging.info("Skipping export %s shard %s" % (export_key, shard_number))
+    if export and not export.done and export.num_shards == shard_number + 1:
+      # Queueing the next task may have been what failed
+      queue_export_task(export)
+    return
+
+  out = StringIO()
+  cursor = export.cursor and str(export.cursor)
+  num, cursor = write_visits_csv(out, export.organization, cursor,
+                                 PAGES_PER_SHARD)
+
+  def txn():
+    stored = VisitExport.get(export.key())
+    if stored.num_shards != shard_number:
+      return None
+    shard = VisitExportShard(
+      parent=stored, key_name=VisitExportShard.key_name_for(shard_number),
+      number=shard_number, data=db.Blob(out.getvalue()))
+    stored.num_shards += 1
+    stored.num_visits += num
+    stored.cursor = cursor
+    stored.done = (cursor is None)
+    db.put([shard, stored])
+    return stored
+  stored = db.run_in_transaction(txn)
+
+  if stored and not stored.done:
+    queue_export_task(stored)
+  elif stored:
+    logging.info("Export %s done, %d visits" % (export_key, stored.num_visits))
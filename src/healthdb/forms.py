@@ -101,6 +101,7 @@ class PatientForm(djangoforms.ModelForm):
     model = models.Patient
     exclude = ['created_date', 'last_edited', 'short_string',
                'name_index', 'birth_date_index', 'search_index',
+               'search_index_version',
                'latest_visit_date', 'latest_visit_short_string',
                'latest_visit_worst_zscore_rounded', 'created_by_user']
 
@@ -171,7 +172,8 @@ class VisitForm(djangoforms.ModelForm):
   class Meta:
     model = models.Visit
     exclude = ['created_date', 'last_edited', 'short_string',
-               'visit_statistics', 'created_by_user']
+               'visit_statistics', 'packed_statistics', 'created_by_user',
+               'residence_key', 'country']
 
 
 class ContactForm(forms.Form):
@@ -10,74 +10,27 @@ To run on localhost:
 To run on production:
 > python manage.py addlatestshortstring --remote
 """
-import getpass
-import logging
-import settings
-import datetime
 
-from django.core.management.base import BaseCommand, CommandError
-from google.appengine.ext.remote_api import remote_api_stub
-from google.appengine.ext import db
-from optparse import make_option
 from healthdb import models
+from healthdb.mapper import Mapper
 
+from healthdb.management.commands.commandutil import MapperCommand
 
-def auth_func():
-  """Get username and password (for access to localhost)"""
-  return raw_input('Username:'), getpass.getpass('Password:')
 
-ROWS_PER_BATCH = 50
+class AddLatestShortStringMapper(Mapper):
+  model_class = models.Patient
+  batch_size = 50
 
-def run():
-  count = 0
-  patients = models.Patient.all().order('__key__').fetch(ROWS_PER_BATCH)
-  while patients:
-    patients_to_save = []
-    for patient in patients: 
-      if not patient.latest_visit_short_string: 
-        latest_visit = patient.get_latest_visit()
-        if latest_visit:
-          patient.latest_visit_short_string = latest_visit.short_string
-          patients_to_save.append(patient)
-    db.put(patients_to_save)
-    patients_to_save = [] 
-    count += len(patients)    
-    logging.info('Updated %d patients' % count)  
-    patients = models.Patient.all().order('__key__').filter('__key__ >', patients[-1].key()).fetch(ROWS_PER_BATCH)
+  def map(self, patient, pool):
+    if not patient.latest_visit_short_string: 
+      latest_visit = patient.get_latest_visit()
+      if latest_visit:
+        patient.latest_visit_short_string = latest_visit.short_string
+        pool.put(patient)
 
 
-class Command(BaseCommand):
-  option_list = BaseCommand.option_list + (
-    make_option('--app-id', dest='app_id', help='The app id'),
-    make_option('--host', dest='host', default='localhost:8080',
-      help='Specifies the URL of the local application.  Use -- remote '
-           'to modify the production site.'),
-  )
-  help = 'Adds multiple visits to a patient'
-  args = ''
-    
-class Command(BaseCommand):
-  option_list = BaseCommand.option_list + (
-    make_option('--app-id', dest='app_id', help='The app id'),
-    make_option('--host', dest='host', default='localhost:8080',
-      help='Specifies the URL of the local application.  Use -- remote '
-           'to modify the production site.'),
-  )
-  help = 'add multiple visits to a patient'
-  args = ''
-  
-  def handle(self, *app_labels, **options):
-    logging.getLogger().setLevel(logging.INFO)
-    if len(app_labels) != 0:
-      raise CommandError("This command doesn't take a list of parameters"
-                         "...it only runs against the 'childdb' app.")
+class Command(MapperCommand):
+  help = 'add latest visit short strings to patients'
 
-    app_id = options.get('app_id')
-    remote = options.get('remote')
-    if not remote:
-      remote_api_url = settings.DATABASE_OPTIONS['remote_url']
-      host = options.get('host')
-      remote_api_stub.ConfigureRemoteDatastore(
-        app_id, remote_api_url, auth_func, host)
-
-    run()
+  def get_mappers(self, options):
+    return [AddLatestShortStringMapper()]
@@ -0,0 +1,39 @@
+""" A script for adding short string mappings for existing patients and visits.
+
+Patient and visit URLs are resolved through ShortStringMap entities (see
+healthdb/shortstring.py).  New entities get one when they are stored; this
+adds them for the rest.  Without it, lookups still work, by a query that
+also adds the mapping.
+
+This is a manage.py command.  Run with --help for documentation.
+
+Example usage:
+
+To run on localhost:
+> manage.py addshortstringmap
+
+To run on production:
+> manage.py addshortstringmap --remote
+"""
+
+from healthdb import models
+from healthdb import shortstring
+from healthdb.mapper import Mapper
+
+from healthdb.management.commands.commandutil import MapperCommand
+
+class ShortStringMapMapper(Mapper):
+  def __init__(self, kind):
+    Mapper.__init__(self, kind=kind)
+    self.model_class = getattr(models, kind)
+
+  def map_batch(self, entities, pool):
+    shortstring.register([entity for entity in entities
+                          if entity.short_string])
+
+
+class Command(MapperCommand):
+  help = 'add short string mappings for patients and visits'
+
+  def get_mappers(self, options):
+    return [ShortStringMapMapper('Patient'), ShortStringMapMapper('Visit')]
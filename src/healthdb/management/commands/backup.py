@@ -9,108 +9,347 @@ $ manage.py backup --app_id childdb
 
 To run on production:
 $ manage.py backup --app-id childdb --host childdb.appspot.com
+
+To back up only what changed since an earlier backup:
+$ manage.py backup --app-id childdb --incremental-from backup.1234
+
+To restore (an incremental backup restores its earlier backups first):
+$ manage.py backup --app-id childdb --restore -d backup.1234
+
+To resume an interrupted restore into the same app:
+$ manage.py backup --app-id childdb --restore --resume -d backup.1234
+
+A backup directory holds a manifest (MANIFEST_NAME) and segment files.
+Each segment is a zlib-compressed series of entity protobufs, each preceded
+by its length as 4 bytes, big-endian.  A full backup splits each kind into
+key ranges of about --segment-size entities, and dumps the ranges on
+--threads threads.
+
+An incremental backup dumps the entities of kinds with a last_edited
+property that were edited since the earlier backup started (less
+SINCE_MARGIN for clock differences), and all entities of other kinds.
+Deleted entities are not recorded, so a restore brings them back.
+
+A restore puts the segments on --threads threads, and notes each segment
+it finished in RESTORED_NAME (one file per app id), so running it again
+with --resume skips them.  The notes are removed when a restore completes,
+and a restore without --resume starts over.
+Old backups (*.backup.txt files, no manifest) are restored serially.
 """
 
-import getpass
+import datetime
 import logging
 import os
 import re
 import settings
+import struct
 import sys
+import threading
 import time
+import zlib
 
 from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson as json
 
 from google.appengine.ext.remote_api import remote_api_stub
 from google.appengine.ext import db
 
 from optparse import make_option
 
-def auth_func():
-  """Get username and password (for access to localhost)"""
-  return raw_input('Username:'), getpass.getpass('Password:')
-
-
-
-def backup(models_to_back_up, restore, rows_per_batch):
-  # Dump or restore a backup
-
-  # For each class..
-  class_counts = {}
-  for model_tuple in models_to_back_up:
-    #print "model_tuple: %s %s" % model_tuple
-    (model_module_name, model_classes) = model_tuple
-    #print "name %s classes %s" % (model_module_name, model_classes)
-    for entityclass in model_classes:
-      class_counts[entityclass] = 0
-      print "entityclass %s" % entityclass
-      imports = __import__(model_module_name, globals(), locals(),
-                           [entityclass])
-      MyModel = getattr(imports, entityclass)
-
-      filename = entityclass + '.backup.txt'
-
-      if restore:
-        outfile = open(filename, 'rb')
-        readmore = True
-        modelobj_list = []
-        while readmore:
-          # Restore a backup
-          line = outfile.readline()
-          if not line:
-            print "done reading %s" % filename
-            readmore = False
-          else:
-            m = re.match('protobuf length: ([0-9]+)$', line)
-            assert m
-            protobuf_length = int(m.group(1))
-            #print "%s protobuf_length %d" % (
-            #  entityclass, protobuf_length)
-            protobuf_str = outfile.read(protobuf_length)
-            # We put a newline on the end of the protobuf
-            dummy = outfile.readline()
-            assert isinstance(protobuf_str, str), 'not str!'
-            #print "protobuf_str: '%s'" % protobuf_str
-            modelobj = db.model_from_protobuf(protobuf_str)
-            # TODO(dan): warn if the object already exists
-            # TODO(dan): put the object somewhere special if it can't be saved
-            modelobj_list.append(modelobj)
-            if len(modelobj_list) >= rows_per_batch:
-              print >>sys.stderr, "Put %d %s objects" % (
-                len(modelobj_list), entityclass)
-              db.put(modelobj_list)
-              class_counts[entityclass] += len(modelobj_list)
-              modelobj_list = []
-
-        if modelobj_list:
-          print >>sys.stderr, "Put %d %s objects" % (
-            len(modelobj_list), entityclass)
-          db.put(modelobj_list)
-          class_counts[entityclass] += len(modelobj_list)
-          modelobj_list = []
+from healthdb import mapper
+from healthdb.management.commands.commandutil import auth_func, run_parallel
+
+MANIFEST_NAME = 'manifest.json'
+# Per app id
+RESTORED_NAME = 'restored.%s.txt'
+SINCE_MARGIN = datetime.timedelta(minutes=10)
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def write_segment(filename, entities):
+  '''Write entities to a new segment file.'''
+  records = []
+  for entity in entities:
+    protostr = db.model_to_protobuf(entity).Encode()
+    records.append(struct.pack('>I', len(protostr)))
+    records.append(protostr)
+  # Rename when done, so a segment file is never partly written
+  outfile = open(filename + '.tmp', 'wb')
+  outfile.write(zlib.compress(''.join(records)))
+  outfile.close()
+  os.rename(filename + '.tmp', filename)
+
+def read_segment(filename):
+  '''Return the entities in a segment file.'''
+  infile = open(filename, 'rb')
+  data = zlib.decompress(infile.read())
+  infile.close()
+  entities = []
+  pos = 0
+  while pos < len(data):
+    (length,) = struct.unpack('>I', data[pos:pos + 4])
+    pos += 4
+    entities.append(db.model_from_protobuf(data[pos:pos + length]))
+    pos += length
+  return entities
+
+
+def get_model_class(module_name, class_name):
+  imports = __import__(module_name, globals(), locals(), [class_name])
+  return getattr(imports, class_name)
+
+def register_models(models_to_back_up):
+  '''Import the models, so protobufs of their kinds can be read.'''
+  for module_name, class_names in models_to_back_up:
+    for class_name in class_names:
+      get_model_class(module_name, class_name)
+
+def fetch_pages(query, rows_per_batch):
+  '''Yield the results of query, rows_per_batch at a time.'''
+  entities = query.fetch(rows_per_batch)
+  while entities:
+    yield entities
+    if len(entities) < rows_per_batch:
+      break
+    query.with_cursor(query.cursor())
+    entities = query.fetch(rows_per_batch)
+
+
+class Backup(object):
+  """Dumps the given models into segments in the current directory."""
+  def __init__(self, models_to_back_up, rows_per_batch, segment_size,
+               num_threads, since=None):
+    self.models = []
+    for module_name, class_names in models_to_back_up:
+      for class_name in class_names:
+        self.models.append((module_name, class_name))
+    self.rows_per_batch = rows_per_batch
+    self.segment_size = segment_size
+    self.num_threads = num_threads
+    self.since = since
+    self.lock = threading.Lock()
+    # Segments dumped, for the manifest
+    self.segments = []
+    # Segment numbers used, by class name
+    self.numbers = {}
+
+  def new_segment_name(self, class_name):
+    self.lock.acquire()
+    try:
+      number = self.numbers.get(class_name, 0)
+      self.numbers[class_name] = number + 1
+    finally:
+      self.lock.release()
+    return '%s.%05d.seg' % (class_name, number)
+
+  def dump(self, module_name, class_name, entities):
+    if not entities:
+      return
+    filename = self.new_segment_name(class_name)
+    write_segment(filename, entities)
+    self.lock.acquire()
+    try:
+      self.segments.append({'module': module_name, 'class': class_name,
+                            'file': filename, 'count': len(entities)})
+    finally:
+      self.lock.release()
+    print >>sys.stderr, "Wrote %d %s objects to %s" % (
+      len(entities), class_name, filename)
+
+  def dump_range(self, job):
+    '''Dump one key range of a kind into one segment.'''
+    module_name, class_name, start, end = job
+    query = get_model_class(module_name, class_name).all().order('__key__')
+    if start:
+      query.filter('__key__ >=', start)
+    if end:
+      query.filter('__key__ <', end)
+    entities = []
+    for page in fetch_pages(query, self.rows_per_batch):
+      entities.extend(page)
+    self.dump(module_name, class_name, entities)
+
+  def dump_since(self, job):
+    '''Dump the entities of a kind edited since self.since.'''
+    module_name, class_name = job
+    query = get_model_class(module_name, class_name).all().filter(
+      'last_edited >', self.since).order('last_edited')
+    entities = []
+    for page in fetch_pages(query, self.rows_per_batch):
+      entities.extend(page)
+      if len(entities) >= self.segment_size:
+        self.dump(module_name, class_name, entities)
+        entities = []
+    self.dump(module_name, class_name, entities)
+
+  def run(self):
+    '''Dump everything, and return the manifest.'''
+    started = datetime.datetime.utcnow()
+
+    since_jobs = []
+    full_models = []
+    for module_name, class_name in self.models:
+      model_class = get_model_class(module_name, class_name)
+      if self.since and 'last_edited' in model_class.properties():
+        since_jobs.append((module_name, class_name))
       else:
-        # Dump a backup
-        outfile = open(filename, 'wb')
-
-        # TODO(dan): Print the field types somewhere for verification
-        #print >>outfile, yaml.dump(MyModel.properties(),
-        #                           default_flow_style = False)
-
-        entities = MyModel.all().order('__key__').fetch(rows_per_batch)
-        while entities:
-          for modelobj in entities:
-            class_counts[entityclass] += 1
-            # TODO(dan): validate_modelobj(modelobj)
-
-            # Dump the modelobj's key and properties
-            protostr = db.model_to_protobuf(modelobj).Encode()
-            print >>outfile, "protobuf length: %d" % len(protostr)
-            print >>outfile, protostr
-
-          entities = MyModel.all().order('__key__').filter(
-            '__key__ >', entities[-1].key()).fetch(rows_per_batch)
+        full_models.append((module_name, class_name))
+
+    # Kinds are split into ranges in parallel too
+    range_jobs = []
+    def split(model):
+      module_name, class_name = model
+      ranges = mapper.split_key_ranges(
+        get_model_class(module_name, class_name).all(keys_only=True),
+        self.segment_size)
+      self.lock.acquire()
+      try:
+        for start, end in ranges:
+          range_jobs.append((module_name, class_name, start, end))
+      finally:
+        self.lock.release()
+    run_parallel(split, full_models, self.num_threads)
+
+    run_parallel(self.dump_since, since_jobs, self.num_threads)
+    run_parallel(self.dump_range, range_jobs, self.num_threads)
+
+    self.segments.sort(key=lambda segment: segment['file'])
+    return {'started': started.strftime(DATETIME_FORMAT),
+            'since': self.since and self.since.strftime(DATETIME_FORMAT),
+            'segments': self.segments}
+
+
+def read_manifest(backupdir):
+  path = os.path.join(backupdir, MANIFEST_NAME)
+  if not os.path.exists(path):
+    return None
+  infile = open(path, 'r')
+  manifest = json.loads(infile.read())
+  infile.close()
+  return manifest
+
+def write_manifest(manifest):
+  outfile = open(MANIFEST_NAME, 'w')
+  outfile.write(json.dumps(manifest, indent=2))
+  outfile.close()
+
+def get_since(previous_dir):
+  '''When entities must have been edited after to be in an incremental
+  backup following the one in previous_dir.'''
+  manifest = read_manifest(previous_dir)
+  if not manifest:
+    raise CommandError("'%s' has no %s" % (previous_dir, MANIFEST_NAME))
+  started = datetime.datetime.strptime(manifest['started'], DATETIME_FORMAT)
+  return started - SINCE_MARGIN
+
+
+def restore(backupdir, rows_per_batch, num_threads, app_id, resume=False):
+  '''Restore the backup in backupdir, after its previous backups.
+
+  If resume, segments already noted in RESTORED_NAME for app_id are
+  skipped.  The notes are removed once all are restored.'''
+  restored_paths = []
+  _restore_chain(backupdir, rows_per_batch, num_threads,
+                 RESTORED_NAME % app_id, resume, restored_paths)
+  for restored_path in restored_paths:
+    if os.path.exists(restored_path):
+      os.remove(restored_path)
+
+def _restore_chain(backupdir, rows_per_batch, num_threads, restored_name,
+                   resume, restored_paths):
+  manifest = read_manifest(backupdir)
+  if manifest is None:
+    restore_text_backup(backupdir, rows_per_batch)
+    return
+  if manifest.get('previous'):
+    _restore_chain(os.path.join(backupdir, manifest['previous']),
+                   rows_per_batch, num_threads, restored_name, resume,
+                   restored_paths)
+
+  restored_path = os.path.join(backupdir, restored_name)
+  restored_paths.append(restored_path)
+  restored = {}
+  if not resume and os.path.exists(restored_path):
+    os.remove(restored_path)
+  if os.path.exists(restored_path):
+    for line in open(restored_path, 'r'):
+      restored[line.strip()] = 1
+  segments = [segment for segment in manifest['segments']
+              if segment['file'] not in restored]
+  print >>sys.stderr, "Restoring %d of %d segments in %s" % (
+    len(segments), len(manifest['segments']), backupdir)
+
+  # Register the kinds before reading their protobufs
+  for segment in manifest['segments']:
+    get_model_class(segment['module'], segment['class'])
+
+  lock = threading.Lock()
+  restored_file = open(restored_path, 'a')
+  def restore_segment(segment):
+    entities = read_segment(os.path.join(backupdir, segment['file']))
+    for start in range(0, len(entities), rows_per_batch):
+      db.put(entities[start:start + rows_per_batch])
+    lock.acquire()
+    try:
+      print >>restored_file, segment['file']
+      restored_file.flush()
+    finally:
+      lock.release()
+    print >>sys.stderr, "Put %d %s objects from %s" % (
+      len(entities), segment['class'], segment['file'])
+  try:
+    run_parallel(restore_segment, segments, num_threads)
+  finally:
+    restored_file.close()
+
+def restore_text_backup(backupdir, rows_per_batch):
+  '''Restore an old backup, in files of text-framed protobufs.'''
+  for filename in sorted(os.listdir(backupdir)):
+    if not filename.endswith('.backup.txt'):
+      continue
+    infile = open(os.path.join(backupdir, filename), 'rb')
+    modelobj_list = []
+    num = 0
+    while True:
+      line = infile.readline()
+      if not line:
+        break
+      m = re.match('protobuf length: ([0-9]+)$', line)
+      assert m
+      protobuf_str = infile.read(int(m.group(1)))
+      # We put a newline on the end of the protobuf
+      dummy = infile.readline()
+      modelobj_list.append(db.model_from_protobuf(protobuf_str))
+      if len(modelobj_list) >= rows_per_batch:
+        db.put(modelobj_list)
+        num += len(modelobj_list)
+        modelobj_list = []
+    if modelobj_list:
+      db.put(modelobj_list)
+      num += len(modelobj_list)
+    infile.close()
+    print >>sys.stderr, "Put %d objects from %s" % (num, filename)
+
+
+def backup(models_to_back_up, options):
+  '''Dump a backup into the current directory.'''
+  previous_dir = options.get('incremental_from')
+  since = None
+  if previous_dir:
+    since = get_since(previous_dir)
+  the_backup = Backup(models_to_back_up, int(options.get('rows_per_batch')),
+                      int(options.get('segment_size')),
+                      int(options.get('threads')), since)
+  manifest = the_backup.run()
+  if previous_dir:
+    # Relative to this backup's directory, e.g. ../backup.1234
+    manifest['previous'] = os.path.join(os.pardir,
+                                        os.path.basename(previous_dir))
+  write_manifest(manifest)
 
-      outfile.close()
+  class_counts = {}
+  for segment in manifest['segments']:
+    class_counts[segment['class']] = (class_counts.get(segment['class'], 0)
+                                      + segment['count'])
   print >>sys.stderr, "Final counts:"
   for entityclass in class_counts.keys():
     print >>sys.stderr, ' %s: %s' % (entityclass, class_counts[entityclass])
@@ -131,6 +370,16 @@ def check_dirs(options):
                            % options.get('backupdir'))
       sys.exit(1)
 
+  if options.get('incremental_from'):
+    if os.path.dirname(os.path.abspath(options.get('incremental_from'))) != (
+       os.path.dirname(os.path.abspath(options.get('backupdir')))):
+      print >>sys.stderr, ("'%s' must be in the same directory as '%s'"
+                           % (options.get('incremental_from'),
+                              options.get('backupdir')))
+      sys.exit(1)
+    options['incremental_from'] = os.path.abspath(
+      options.get('incremental_from'))
+
   os.chdir(options.get('backupdir'))
 
 
@@ -167,13 +416,28 @@ class Command(BaseCommand):
                          " (otherwise dump a new backup)",
                     action = "store_true",
                     default=False),
+    make_option("--resume", dest="resume",
+                    help="with --restore, skip the segments an interrupted "
+                         "restore into the same app id finished",
+                    action = "store_true",
+                    default=False),
     make_option("-d", "--backup-dir", dest="backupdir",
                     help="directory to which (or from which) to dump "
                          "(or restore) a backup (default '%default')",
                     default="backup.%d" % time.time()),
+    make_option("--incremental-from", dest="incremental_from",
+                    help="dump only what changed since the backup in this "
+                         "directory, which must be next to backup-dir"),
     make_option("--rows-per-batch", dest="rows_per_batch",
-                    help="# rows to fetch at once (default %default)",
+                    help="# rows to fetch (or put) at once (default %default)",
                     default=100),
+    make_option("--segment-size", dest="segment_size",
+                    help="# rows per segment file (default %default)",
+                    default=1000),
+    make_option("--threads", dest="threads",
+                    help="# segments to dump (or restore) at once "
+                         "(default %default)",
+                    default=8),
     make_option("--config-file", dest="config_file",
                     help="File with configuration (default %s)",
                     default = os.path.join(os.getcwd(), 'remote-backup.cfg'))
@@ -214,5 +478,9 @@ class Command(BaseCommand):
 
     models_to_back_up = load_config_file(config_file)
 
-    backup(models_to_back_up, options.get('restore'),
-           options.get('rows_per_batch'))
+    if options.get('restore'):
+      register_models(models_to_back_up)
+      restore(os.curdir, int(options.get('rows_per_batch')),
+              int(options.get('threads')), app_id, options.get('resume'))
+    else:
+      backup(models_to_back_up, options)
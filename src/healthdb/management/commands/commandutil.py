@@ -1,12 +1,19 @@
 import getpass
+import os
+import Queue
 import settings
 import logging
+import threading
 
 from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson as json
 
 from google.appengine.ext.remote_api import remote_api_stub
+from google.appengine.ext import db
 from optparse import make_option
 
+from healthdb import mapper as mapper_lib
+
 
 def auth_func():
   """Get username and password (for access to localhost)"""
@@ -47,3 +54,121 @@ class ManageCommand(BaseCommand):
       host = options.get('host')
       remote_api_stub.ConfigureRemoteDatastore(
         app_id, remote_api_url, auth_func, host)
+
+
+def run_parallel(func, items, num_threads):
+  '''Call func(item) for each of items on num_threads threads.
+
+  After an error, no more items are started, and the first error is raised
+  once the threads finish.'''
+  queue = Queue.Queue()
+  for item in items:
+    queue.put(item)
+  errors = []
+
+  def work():
+    while not errors:
+      try:
+        item = queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        func(item)
+      except Exception, err:
+        logging.exception('Failed on %s' % (item,))
+        errors.append(err)
+
+  threads = [threading.Thread(target=work) for dummy in range(num_threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+
+
+def _key_str(key):
+  return key and str(key) or None
+
+def _str_key(key_str):
+  return key_str and db.Key(key_str) or None
+
+def run_mapper(mapper, num_threads=8, checkpoint=None):
+  '''Map mapper's key ranges on num_threads threads, then call finish().
+
+  If checkpoint is a file name, the ranges and which are done are kept
+  there, so running again after a failure skips the done ranges.  The file
+  is removed when all are done.  A mapper's state, e.g. a count, is not
+  kept, so mappers that have one (in_app = False) cannot use a checkpoint.'''
+  if checkpoint and not mapper.in_app:
+    raise CommandError('%s keeps state across ranges, so it cannot resume '
+                       'from a checkpoint' % mapper.get_name())
+  state = None
+  if checkpoint and os.path.exists(checkpoint):
+    infile = open(checkpoint, 'r')
+    state = json.loads(infile.read())
+    infile.close()
+    if state['mapper'] != mapper.get_name():
+      raise CommandError("Checkpoint '%s' is of %s"
+                         % (checkpoint, state['mapper']))
+    logging.info('Resuming from %s, %d of %d ranges done'
+                 % (checkpoint, len(state['done']), len(state['ranges'])))
+  else:
+    mapper.start()
+    ranges = mapper_lib.split_key_ranges(mapper.query(keys_only=True))
+    state = {'mapper': mapper.get_name(),
+             'ranges': [(_key_str(start), _key_str(end))
+                        for start, end in ranges],
+             'done': []}
+
+  lock = threading.Lock()
+  def save():
+    if checkpoint:
+      outfile = open(checkpoint, 'w')
+      outfile.write(json.dumps(state))
+      outfile.close()
+  save()
+
+  progress = mapper_lib.Progress(mapper.get_name())
+  def map_range(index):
+    start, end = state['ranges'][index]
+    mapper_lib.map_range(mapper, _str_key(start), _str_key(end),
+                         progress=progress)
+    lock.acquire()
+    try:
+      state['done'].append(index)
+      save()
+    finally:
+      lock.release()
+
+  done = dict([(index, 1) for index in state['done']])
+  run_parallel(map_range, [index for index in range(len(state['ranges']))
+                           if index not in done], num_threads)
+  mapper.finish()
+  progress.log()
+  if checkpoint:
+    os.remove(checkpoint)
+
+
+class MapperCommand(ManageCommand):
+  """A command that runs mappers (see healthdb/mapper.py) on threads.
+
+  Subclasses implement get_mappers(options).
+  """
+  option_list = ManageCommand.option_list + (
+    make_option('--threads', dest='threads', type='int', default=8,
+      help='Key ranges to map at once (default %default)'),
+    make_option('--checkpoint', dest='checkpoint',
+      help='File noting the key ranges done, to resume from'),
+  )
+
+  def get_mappers(self, options):
+    raise NotImplementedError
+
+  def handle(self, *app_labels, **options):
+    self.connect(*app_labels, **options)
+    for mapper in self.get_mappers(options):
+      checkpoint = options.get('checkpoint')
+      if checkpoint:
+        checkpoint = '%s.%s' % (checkpoint, mapper.model_class.kind())
+      run_mapper(mapper, options.get('threads'), checkpoint)
@@ -0,0 +1,113 @@
+""" A script for measuring the patient search indexes.
+
+This is a manage.py command.  Run with --help for documentation.
+
+For each of the Patient search index properties, reports the values per
+patient as stored, as built by the old every-prefix indexer, and as built by
+the current (capped) indexer.  Each value is a row in the ascending and the
+descending built-in index, so rows per patient are twice the values.
+The values of search_index also in name_index or birth_date_index are
+counted as shared.
+
+Example usage:
+
+To run on localhost:
+> manage.py measuresearchindex
+
+To run on production:
+> manage.py measuresearchindex --remote
+"""
+
+import logging
+
+from search.core import startswith
+
+from healthdb import models
+from healthdb.mapper import Mapper
+
+from healthdb.management.commands.commandutil import MapperCommand
+
+INDEXES = ('name_index', 'birth_date_index', 'search_index')
+# The values counted for each index
+MEASURES = ('stored', 'old', 'new')
+
+
+def index_values(prop, patient, indexer):
+  '''The values of prop (a SearchIndexProperty) for patient, built with
+  indexer.'''
+  words = []
+  for name in prop.properties:
+    value = getattr(patient, name)
+    if value:
+      words.extend(prop.splitter(value, indexing=True))
+  return set(indexer(words, indexing=True))
+
+
+class MeasureSearchIndexMapper(Mapper):
+  '''Count search index values of all patients.'''
+  model_class = models.Patient
+  # The counts are kept in this process
+  in_app = False
+
+  def __init__(self):
+    Mapper.__init__(self)
+    self.num = 0
+    self.shared = 0
+    # (index, measure) -> total values
+    self.totals = {}
+    # (index, measure) -> most values of a patient
+    self.most = {}
+    for index in INDEXES:
+      for measure in MEASURES:
+        self.totals[(index, measure)] = 0
+        self.most[(index, measure)] = 0
+
+  def map_batch(self, pats, pool):
+    counts = []
+    num_shared = 0
+    for pat in pats:
+      new_values = {}
+      for index in INDEXES:
+        prop = getattr(models.Patient, index)
+        new_values[index] = index_values(prop, pat, prop.indexer)
+        counts.append((index, 'stored', len(getattr(pat, index) or [])))
+        counts.append((index, 'old', len(index_values(prop, pat,
+                                                      startswith))))
+        counts.append((index, 'new', len(new_values[index])))
+      num_shared += len(new_values['search_index']
+                        & (new_values['name_index']
+                           | new_values['birth_date_index']))
+
+    self.lock.acquire()
+    try:
+      self.num += len(pats)
+      self.shared += num_shared
+      for index, measure, num in counts:
+        self.totals[(index, measure)] += num
+        self.most[(index, measure)] = max(self.most[(index, measure)], num)
+    finally:
+      self.lock.release()
+
+  def finish(self):
+    num = max(self.num, 1)
+    logging.info('%d patients' % self.num)
+    for measure in MEASURES:
+      total = 0
+      for index in INDEXES:
+        total += self.totals[(index, measure)]
+        logging.info('%s %s: %.1f values per patient (most %d)'
+                     % (index, measure,
+                        self.totals[(index, measure)] / float(num),
+                        self.most[(index, measure)]))
+      logging.info('All indexes %s: %.1f values, %.1f index rows per patient'
+                   % (measure, total / float(num), 2 * total / float(num)))
+    logging.info('search_index new values shared with name_index or '
+                 'birth_date_index: %.1f per patient'
+                 % (self.shared / float(num)))
+
+
+class Command(MapperCommand):
+  help = 'Reports the number of patient search index values'
+
+  def get_mappers(self, options):
+    return [MeasureSearchIndexMapper()]
@@ -0,0 +1,97 @@
+""" A script for packing visit statistics into their visits.
+
+Visit.packed_statistics holds a visit's statistics on the visit itself, so
+reading them costs no datastore get.  This backfills it for existing
+visits, from their VisitStatistics entity if they have one, otherwise by
+calculating the statistics in a batch.
+
+With --delete-entities, the VisitStatistics entities are deleted and the
+visits' references cleared.  Use that only with
+Visit.STATISTICS_STORAGE = Visit.STATS_PACKED, or new entities will appear.
+
+This is a manage.py command.  Run with --help for documentation.
+
+Example usage:
+
+To run on localhost:
+> manage.py packvisitstats --organization maventy
+
+To run on production:
+> manage.py packvisitstats --organization maventy --remote
+"""
+
+import logging
+from optparse import make_option
+
+from google.appengine.ext import db
+
+from healthdb import models
+from healthdb.mapper import Mapper
+
+from healthdb.management.commands.commandutil import MapperCommand
+
+def pack_visits(visits, delete_entities):
+  '''Set packed_statistics on visits that lack it, in one batch.
+
+  Returns the number of visits packed.'''
+  visits = [visit for visit in visits if not visit.packed_statistics]
+  if not visits:
+    return 0
+
+  stats_keys = [models.Visit.visit_statistics.get_value_for_datastore(visit)
+                for visit in visits]
+  stats_by_key = {}
+  for stats in db.get([key for key in stats_keys if key]):
+    if stats:
+      stats_by_key[stats.key()] = stats
+
+  # Visits whose statistics were never calculated, or whose entity is gone
+  missing = [visit for visit, key in zip(visits, stats_keys)
+             if key not in stats_by_key]
+  calculated = {}
+  if missing:
+    for visit, stats in zip(missing,
+                            models.VisitStatistics.get_stats_for_visits(missing)):
+      calculated[visit.key()] = stats
+
+  for visit, key in zip(visits, stats_keys):
+    if key in stats_by_key:
+      visit.packed_statistics = stats_by_key[key]
+    else:
+      visit.packed_statistics = calculated[visit.key()]
+    if delete_entities:
+      visit.visit_statistics = None
+  db.put(visits)
+
+  if delete_entities and stats_by_key:
+    db.delete(stats_by_key.keys())
+  return len(visits)
+
+class PackVisitStatsMapper(Mapper):
+  model_class = models.Visit
+
+  def query(self, keys_only=False):
+    query = Mapper.query(self, keys_only)
+    if self.params['organization']:
+      query.filter('organization =', self.params['organization'])
+    return query
+
+  def map_batch(self, visits, pool):
+    pack_visits(visits, self.params['delete_entities'])
+
+
+class Command(MapperCommand):
+  option_list = MapperCommand.option_list + (
+    make_option('--organization', dest='organization',
+      help='Organization (default: all)'),
+    make_option('--delete-entities', dest='delete_entities',
+      action='store_true', default=False,
+      help='Delete VisitStatistics entities once packed'),
+  )
+
+  help = 'pack visit statistics into visits'
+
+  def get_mappers(self, options):
+    return [PackVisitStatsMapper(
+      organization=options.get('organization'),
+      delete_entities=options.get('delete_entities'))]
@@ -1,4 +1,7 @@
-""" A script for updating the patient organization of a user.
+""" A script for printing all visits of an organization as CSV.
+
+Visits are read and written a page at a time (see healthdb/export.py), to
+standard output or, with --output, to a file.
 
 This is a manage.py command.  Run with --help for documentation.
 
@@ -8,39 +11,40 @@ To run on localhost:
 > manage.py print_all_visits --org maventy
 
 To run on production:
-> manage.py print_all_visits --org maventy --remote
+> manage.py print_all_visits --org maventy --remote --output visits.csv
 """
 
 import logging
 from optparse import make_option
 import sys
 
-from google.appengine.ext import db
-
-from healthdb import models
+from healthdb import export
 
 from healthdb.management.commands.commandutil import ManageCommand
 
 
-def print_all_visits(org):
-  patient_cache, visits = models.Visit.get_all_visits(org)
-  print "%s" % models.Visit.export_csv_header()
-  num = 0
-  for visit in visits:
-    num += 1
-    if (num % 100) == 0: logging.info("printed %d visits" % num)
-    print(visit.export_csv_line(patient_cache.get_patient(
-          visit.parent_key())))
+def print_all_visits(org, out):
+  num, dummy = export.write_visits_csv(out, org)
   logging.info("printed %d visits" % num)
 
 class Command(ManageCommand):
   option_list = ManageCommand.option_list + (
     make_option('--organization', dest='organization',
       help='Organization'),
+    make_option('--output', dest='output',
+      help='File to write (default: standard output)'),
   )
 
   help = 'print all visits'
 
   def handle(self, *app_labels, **options):
     self.connect(*app_labels, **options)
-    print_all_visits(options.get('organization'))
+    output = options.get('output')
+    if output:
+      out = open(output, 'wb')
+      try:
+        print_all_visits(options.get('organization'), out)
+      finally:
+        out.close()
+    else:
+      print_all_visits(options.get('organization'), sys.stdout)
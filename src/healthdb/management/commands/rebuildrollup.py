@@ -0,0 +1,97 @@
+""" A script for rebuilding the undernutrition rollup of an organization.
+
+The rollup (see healthdb/rollup.py) is kept up to date as visits change,
+but visits stored before it existed must be added by this command.  It
+deletes the organization's rollup (marking it not built, so the report
+reads the visits meanwhile), adds each batch of visits with the same
+transactional updates the views make, then marks it built.
+
+Changes the views make while this runs are kept, since both replace a
+visit by its key in each rollup.  A visit deleted between a batch reading
+it and adding it would come back; the window is one batch.
+
+This is a manage.py command.  Run with --help for documentation.
+
+Example usage:
+
+To run on localhost:
+> manage.py rebuildrollup --organization maventy
+
+To run on production:
+> manage.py rebuildrollup --organization maventy --remote
+"""
+
+import logging
+from optparse import make_option
+
+from google.appengine.ext import db
+
+from healthdb import models
+from healthdb import rollup
+from healthdb.mapper import Mapper
+
+from healthdb.management.commands.commandutil import MapperCommand
+
+ROWS_PER_BATCH=200
+
+def delete_rollup(org):
+  built = rollup.UndernutritionRollupBuilt.get_by_key_name(org)
+  if built:
+    built.delete()
+  num = 0
+  while True:
+    keys = rollup.UndernutritionRollup.all(keys_only=True).filter(
+      'organization =', org).fetch(ROWS_PER_BATCH)
+    if not keys:
+      break
+    db.delete(keys)
+    num += len(keys)
+  logging.info("deleted %d rollups" % num)
+
+class RebuildRollupMapper(Mapper):
+  model_class = models.Visit
+  # Needs start() and finish(), which only run on threads
+  in_app = False
+
+  def __init__(self, organization):
+    Mapper.__init__(self, organization=organization)
+    # Whether adding a batch failed, leaving the rollup not built
+    self.failed = False
+
+  def query(self, keys_only=False):
+    return Mapper.query(self, keys_only).filter(
+      'organization =', self.params['organization'])
+
+  def start(self):
+    delete_rollup(self.params['organization'])
+
+  def map_batch(self, visits, pool):
+    patients = db.get([visit.parent_key() for visit in visits])
+    pairs = []
+    for visit, patient in zip(visits, patients):
+      if not patient:
+        logging.warning("Visit %s has no patient, skipping" % visit.key())
+        continue
+      pairs.append((visit, patient))
+    if rollup.add_visit_pairs(pairs):
+      self.failed = True
+
+  def finish(self):
+    if self.failed:
+      logging.error("rollup of %s not built; run this again"
+                    % self.params['organization'])
+      return
+    rollup.set_built(self.params['organization'])
+    logging.info("rollup of %s built" % self.params['organization'])
+
+
+class Command(MapperCommand):
+  option_list = MapperCommand.option_list + (
+    make_option('--organization', dest='organization',
+      help='Organization'),
+  )
+
+  help = 'rebuild the undernutrition rollup'
+
+  def get_mappers(self, options):
+    return [RebuildRollupMapper(options.get('organization'))]
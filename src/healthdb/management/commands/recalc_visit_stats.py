@@ -1,6 +1,7 @@
 """ A script for recalculating visit statistics (by deleting and re-getting).
 
-It recalculates only those where util.isNaN(stats.body_mass_index) is True.
+It recalculates only those where util.isNaN(stats.body_mass_index) is True,
+a batch at a time with VisitStatistics.get_stats_for_visits().
 
 This is a manage.py command.  Run with --help for documentation.
 
@@ -16,49 +17,71 @@ To run on production:
 import logging
 from optparse import make_option
 
+from google.appengine.ext import db
+
 from healthdb import models
+from healthdb import rollup
 from healthdb import util
-
-from healthdb.management.commands.commandutil import ManageCommand
-
-ROWS_PER_BATCH=200
-
-def recalc_visit_statistics(org):
-  visits = models.Visit.all().filter('organization =', org).order('__key__').fetch(ROWS_PER_BATCH)
-
-  num = 0
-  # Still don't understand why we have to iterate over visits in batches, but
-  # we do, or it gets stuck at ~1000.
-  while visits:
+from healthdb.mapper import Mapper
+
+from healthdb.management.commands.commandutil import MapperCommand
+
+def recalc_visits(visits):
+  '''Replace the statistics of visits, calculated as one batch.
+
+  They are packed into visits that have packed statistics (or all visits,
+  with Visit.STATISTICS_STORAGE = STATS_PACKED), since those are what
+  get_visit_statistics() returns, and otherwise stored as entities.  The
+  visits' undernutrition rollups are updated with the new flags.'''
+  old_stats = [models.Visit.visit_statistics.get_value_for_datastore(visit)
+               for visit in visits]
+  db.delete([key for key in old_stats if key])
+  new_stats = models.VisitStatistics.get_stats_for_visits(visits)
+  to_put = []
+  for visit, stats in zip(visits, new_stats):
+    if (visit.packed_statistics or
+        models.Visit.STATISTICS_STORAGE == models.Visit.STATS_PACKED):
+      visit.packed_statistics = stats
+      visit.visit_statistics = None
+    else:
+      to_put.append(stats)
+      visit.packed_statistics = None
+      visit.visit_statistics = stats
+  db.put(to_put)
+  db.put(visits)
+  rollup.add_visit_pairs(zip(visits,
+                             db.get([visit.parent_key() for visit in visits])))
+
+class RecalcVisitStatsMapper(Mapper):
+  model_class = models.Visit
+
+  def query(self, keys_only=False):
+    return Mapper.query(self, keys_only).filter(
+      'organization =', self.params['organization'])
+
+  def map_batch(self, visits, pool):
+    visits_to_recalc = []
     for visit in visits:
-      num += 1
-      if (num % 100) == 0: logging.info("traversed %d visits" % num)
       stats = visit.get_visit_statistics()
+      if stats is None:
+        # Not enough data to calculate any
+        continue
       if util.isNaN(stats.body_mass_index):
-        # recalculate by deleting and re-getting
-        visit.delete_statistics()
-        stats = visit.get_visit_statistics()
-  
         pat = visit.get_patient()
-        logging.info("Visit %s/%d has NaN BMI, recalculating stats.."
+        logging.info("Visit %s/%s has NaN BMI, recalculating stats.."
                      % (pat.short_string, visit.short_string))
-  
-#      pat = visit.get_patient()
-#      logging.info("Visit %s/%d %s.." % (pat.short_string, visit.short_string, visit.key()))
-    visits = models.Visit.all().filter('organization =', org).order('__key__').filter(
-      '__key__ >', visits[-1].key()).fetch(ROWS_PER_BATCH)
-
-  logging.info("traversed %d visits" % num)
+        visits_to_recalc.append(visit)
+    if visits_to_recalc:
+      recalc_visits(visits_to_recalc)
 
 
-class Command(ManageCommand):
-  option_list = ManageCommand.option_list + (
+class Command(MapperCommand):
+  option_list = MapperCommand.option_list + (
     make_option('--organization', dest='organization',
       help='Organization'),
   )
 
   help = 'recalculate visit statistics'
 
-  def handle(self, *app_labels, **options):
-    self.connect(*app_labels, **options)
-    recalc_visit_statistics(options.get('organization'))
+  def get_mappers(self, options):
+    return [RecalcVisitStatsMapper(organization=options.get('organization'))]
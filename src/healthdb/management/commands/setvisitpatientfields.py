@@ -0,0 +1,48 @@
+""" A script for setting each Visit's residence_key and country from its Patient.
+
+Reports filter visits by these copies of the patient's fields (see
+Visit.set_patient_fields()), so visits stored before they existed must be
+updated by this command.  When it is done, it marks every organization's
+visits as set (models.VisitPatientFieldsSet); until then, reports check
+the patients themselves.
+
+This is a manage.py command.  Run with --help for documentation.
+
+Example usage:
+
+To run on localhost:
+> manage.py setvisitpatientfields
+
+To run on production:
+> manage.py setvisitpatientfields --remote
+"""
+
+import logging
+
+from google.appengine.ext import db
+
+from healthdb import models
+from healthdb.mapper import Mapper
+
+from healthdb.management.commands.commandutil import MapperCommand
+
+class SetVisitPatientFieldsMapper(Mapper):
+  model_class = models.Visit
+
+  def map_batch(self, visits, pool):
+    patients = db.get([visit.parent_key() for visit in visits])
+    pool.put([visit for visit, patient in zip(visits, patients)
+              if patient and visit.set_patient_fields(patient)])
+
+  def finish(self):
+    for org in models.ORGANIZATIONS:
+      models.VisitPatientFieldsSet.mark(org)
+    logging.info("visit patient fields set for %s"
+                 % ', '.join(models.ORGANIZATIONS))
+
+
+class Command(MapperCommand):
+  help = 'set visit residence_key and country from patients'
+
+  def get_mappers(self, options):
+    return [SetVisitPatientFieldsMapper()]
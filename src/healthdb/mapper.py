@@ -0,0 +1,278 @@
+'''Map a function over the entities of a kind, a key range at a time.
+
+A Mapper subclass gives the query (a model class, perhaps with equality
+filters) and what to do with each batch of entities.  Puts and deletes go
+through a MutationPool, which writes them in batches.
+
+class SetVisitOrg(Mapper):
+  model_class = models.Visit
+
+  def map(self, visit, pool):
+    if not visit.organization:
+      visit.organization = visit.get_patient().organization
+      pool.put(visit)
+
+The entities are split into key ranges (split_key_ranges()), which can be
+mapped concurrently:
+
+- From a management command, on threads over remote_api, see
+  commandutil.run_mapper() and MapperCommand.
+- In the app, as chains of task queue tasks, one chain per range, see
+  start_tasks().  Each task maps up to TASK_BATCHES batches and queues the
+  next with its cursor, so a failed task is retried from where it started.
+
+Mappers that keep state across batches (e.g. a count, used by finish())
+can only run on threads; they set in_app = False.  map_batch() may be
+called from several threads at once, so such state needs self.lock.
+'''
+
+import logging
+import threading
+import time
+
+from google.appengine.ext import db
+try:
+  from google.appengine.api.taskqueue import Task
+except ImportError:
+  from google.appengine.api.labs.taskqueue import Task
+
+from django.core.urlresolvers import reverse
+from django.utils import simplejson as json
+
+import search.core
+
+# Keys read at once when splitting a kind into ranges
+KEYS_PER_FETCH = 1000
+# Entities per key range
+RANGE_SIZE = 1000
+# Batches mapped by one task
+TASK_BATCHES = 5
+# Only mappers in these packages can be run by tasks
+TASK_MAPPER_PREFIX = 'healthdb.'
+
+
+class MutationPool(object):
+  """Puts and deletes, written batch_size at a time."""
+  def __init__(self, batch_size, progress=None):
+    self.batch_size = batch_size
+    self.progress = progress
+    self.puts = []
+    self.deletes = []
+
+  def put(self, entities):
+    if not isinstance(entities, (list, tuple)):
+      entities = [entities]
+    self.puts.extend(entities)
+    if len(self.puts) >= self.batch_size:
+      self.flush_puts()
+
+  def delete(self, keys):
+    if not isinstance(keys, (list, tuple)):
+      keys = [keys]
+    self.deletes.extend(keys)
+    if len(self.deletes) >= self.batch_size:
+      self.flush_deletes()
+
+  def flush_puts(self):
+    if self.puts:
+      db.put(self.puts)
+      if self.progress: self.progress.add_puts(len(self.puts))
+      self.puts = []
+
+  def flush_deletes(self):
+    if self.deletes:
+      db.delete(self.deletes)
+      if self.progress: self.progress.add_deletes(len(self.deletes))
+      self.deletes = []
+
+  def flush(self):
+    self.flush_puts()
+    self.flush_deletes()
+
+
+class Progress(object):
+  """Counts of a mapper run, logged every LOG_SECONDS with the rate."""
+  LOG_SECONDS = 10
+
+  def __init__(self, name):
+    self.name = name
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.logged = self.started
+    self.num = 0
+    self.num_put = 0
+    self.num_deleted = 0
+
+  def _add(self, attr, num):
+    self.lock.acquire()
+    try:
+      setattr(self, attr, getattr(self, attr) + num)
+      now = time.time()
+      if now - self.logged >= self.LOG_SECONDS:
+        self.logged = now
+        self.log()
+    finally:
+      self.lock.release()
+
+  def add(self, num):
+    self._add('num', num)
+
+  def add_puts(self, num):
+    self._add('num_put', num)
+
+  def add_deletes(self, num):
+    self._add('num_deleted', num)
+
+  def log(self):
+    seconds = max(time.time() - self.started, 0.001)
+    logging.info('%s: %d entities in %ds (%.1f/s), %d put, %d deleted'
+                 % (self.name, self.num, seconds, self.num / seconds,
+                    self.num_put, self.num_deleted))
+
+
+class Mapper(object):
+  """Base class of mappers, see the module docs."""
+  model_class = None
+  keys_only = False
+  # Entities read, and mutations written, at once
+  batch_size = 200
+  # Whether the mapper can run as tasks
+  in_app = True
+
+  def __init__(self, **params):
+    # Passed to the tasks, so they must be JSON values
+    self.params = params
+    self.lock = threading.Lock()
+
+  def query(self, keys_only=False):
+    '''The entities to map.  Subclasses may add equality filters.'''
+    return self.model_class.all(keys_only=keys_only)
+
+  def start(self):
+    '''Called before mapping, when running on threads (not when resuming).'''
+    pass
+
+  def map_batch(self, entities, pool):
+    for entity in entities:
+      self.map(entity, pool)
+
+  def map(self, entity, pool):
+    pass
+
+  def finish(self):
+    '''Called once all ranges are mapped, when running on threads.'''
+    pass
+
+  def get_name(self):
+    return '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
+
+
+def split_key_ranges(query, range_size=RANGE_SIZE):
+  '''Split the entities of a keys-only query into ranges of range_size.
+
+  Returns a list of (start key, end key), including start and not end.
+  None is the start or end of all keys.'''
+  boundaries = []
+  num = 0
+  query.order('__key__')
+  keys = query.fetch(KEYS_PER_FETCH)
+  while keys:
+    for key in keys:
+      if num and (num % range_size) == 0:
+        boundaries.append(key)
+      num += 1
+    if len(keys) < KEYS_PER_FETCH:
+      break
+    query.with_cursor(query.cursor())
+    keys = query.fetch(KEYS_PER_FETCH)
+  return zip([None] + boundaries, boundaries + [None])
+
+def map_range(mapper, start, end, cursor=None, max_batches=None,
+              progress=None):
+  '''Map the entities from start to end (keys, or None for no bound).
+
+  Starts at cursor, if given.  Stops after max_batches batches, if given.
+  Returns (number of entities mapped, cursor to continue from), where the
+  cursor is None when the range is done.'''
+  query = mapper.query(mapper.keys_only).order('__key__')
+  if start:
+    query.filter('__key__ >=', start)
+  if end:
+    query.filter('__key__ <', end)
+  if cursor:
+    query.with_cursor(cursor)
+
+  pool = MutationPool(mapper.batch_size, progress)
+  num = 0
+  batches = 0
+  # Queue the search index updates of the range's writes together
+  search.core.start_batch()
+  try:
+    entities = query.fetch(mapper.batch_size)
+    while entities:
+      mapper.map_batch(entities, pool)
+      num += len(entities)
+      batches += 1
+      if progress: progress.add(len(entities))
+      if len(entities) < mapper.batch_size:
+        break
+      cursor = query.cursor()
+      if max_batches and batches >= max_batches:
+        pool.flush()
+        return (num, cursor)
+      query.with_cursor(cursor)
+      entities = query.fetch(mapper.batch_size)
+    pool.flush()
+    return (num, None)
+  finally:
+    search.core.flush_batch()
+
+
+def get_mapper(name, params):
+  '''Make the mapper class with the given module and name.'''
+  if not name.startswith(TASK_MAPPER_PREFIX):
+    raise ValueError('Not a mapper: %s' % name)
+  module_name, class_name = name.rsplit('.', 1)
+  module = __import__(module_name, globals(), locals(), [class_name])
+  mapper_class = getattr(module, class_name)
+  if not issubclass(mapper_class, Mapper) or not mapper_class.in_app:
+    raise ValueError('Not a mapper that can run as tasks: %s' % name)
+  # Keyword names must be str
+  return mapper_class(**dict([(str(key), value)
+                              for key, value in params.items()]))
+
+def _queue_task(url_name, params):
+  Task(url=reverse(url_name), method='POST', params=params).add()
+
+def start_tasks(mapper):
+  '''Queue the task that splits mapper's entities into ranges, each then
+  mapped by its own chain of tasks.'''
+  if not mapper.in_app:
+    raise ValueError('%s cannot run as tasks' % mapper.get_name())
+  _queue_task('healthdb.views.mapper_split_task',
+              {'mapper': mapper.get_name(),
+               'params': json.dumps(mapper.params)})
+
+def run_split_task(name, params_json):
+  '''Queue a range task for each key range.'''
+  mapper = get_mapper(name, json.loads(params_json))
+  ranges = split_key_ranges(mapper.query(keys_only=True))
+  for start, end in ranges:
+    _queue_task('healthdb.views.mapper_task',
+                {'mapper': name, 'params': params_json,
+                 'start': start and str(start) or '',
+                 'end': end and str(end) or '', 'cursor': ''})
+  logging.info('%s: queued %d ranges' % (name, len(ranges)))
+
+def run_range_task(name, params_json, start, end, cursor):
+  '''Map up to TASK_BATCHES batches of a range, then queue the rest.'''
+  mapper = get_mapper(name, json.loads(params_json))
+  progress = Progress(name)
+  num, cursor = map_range(mapper, start and db.Key(start) or None,
+                          end and db.Key(end) or None, cursor or None,
+                          TASK_BATCHES, progress)
+  progress.log()
+  if cursor:
+    _queue_task('healthdb.views.mapper_task',
+                {'mapper': name, 'params': params_json,
+                 'start': start, 'end': end, 'cursor': cursor})
@@ -18,21 +18,26 @@ from google.appengine.ext import db
 from django.db import models
 #from django.db.models.signals import post_save
 from django.utils.translation import ugettext_lazy as _
+from ragendja.dbutils import prefetch_references
 
 # Local imports
 import counter
 import util
 import search_util
+import shortstring
 from growthcalc.growthcalc import VisitStatistics
 from growthcalc.growthcalc import ZscoreAndPercentileProperty
+from growthcalc.growthcalc import PackedVisitStatisticsProperty
 
-from search.core import SearchIndexProperty, startswith
+from search.core import SearchIndexProperty, IndexVersionProperty
+
+# TODO(dan): We will want this list in the datastore
+# maventy.org: contact Martin Malachovsky, drm - at - maventy.org
+# RVM: contact Marcela Micelli, miceli.marcela - at - gmail
+ORGANIZATIONS = ['maventy', 'rvm', 'test']
 
 def organization_exists(orgStr):
-  # TODO(dan): We will want this list in the datastore
-  # maventy.org: contact Martin Malachovsky, drm - at - maventy.org
-  # RVM: contact Marcela Micelli, miceli.marcela - at - gmail
-  return orgStr in ['maventy', 'rvm', 'test']
+  return orgStr in ORGANIZATIONS
 
 
 class Vaccination(object):
@@ -130,6 +135,7 @@ class Patient(db.Model):
                           u'created_date', u'latest_visit_worst_zscore_rounded',
                           u'latest_visit_date', u'created_by_user', u'latest_visit_short_string',
                           u'short_string', u'name_index', u'birth_date_index',
+                          u'search_index_version',
                           u'latest_visit_date',
                           u'caregiver_name' ] 
   
@@ -159,25 +165,28 @@ class Patient(db.Model):
   # We want to restrict by several fields using self-merge-joins, so we can't
   # use relation indexes for the individual fields name and birth_date
   name_index = SearchIndexProperty(('name'),
-                                      indexer = startswith,
+                                      indexer = search_util.indexer,
                                       splitter = search_util.splitter,
                                       relation_index = False)
 
   birth_date_index = SearchIndexProperty(('birth_date'),
-                                      indexer = startswith,
+                                      indexer = search_util.date_indexer,
                                       splitter = search_util.splitter,
                                       relation_index = False)
 
   # search_index has all the fields mixed together
   search_index = SearchIndexProperty(('name', 'residence', 'birth_date',
                                       'caregiver_name'),
-                                      indexer = startswith,
+                                      indexer = search_util.indexer,
                                       splitter = search_util.splitter,
                                       # We want to restrict by several fields
                                       # using self-merge-joins, so we can't use
                                       # a relation index
                                       relation_index = False)
 
+  # Version of the code that built the indexes above, see updatesearchindex
+  search_index_version = IndexVersionProperty(search_util.INDEX_VERSION)
+
   # Cached from latest visit, to sort by
   latest_visit_date = db.DateProperty(required=False)
   
@@ -245,7 +254,19 @@ class Patient(db.Model):
     
   @staticmethod
   def get_by_short_string(short_string):
-    return Patient.gql('WHERE short_string = :1', short_string).get()
+    return shortstring.get([(Patient, short_string)])[0]
+
+  @staticmethod
+  def get_patient_and_visit(patient_short_string, visit_short_string):
+    '''Return (patient, visit) from their short strings, in one lookup.
+
+    Either is None if not found, and the visit is None unless it is the
+    patient's.'''
+    patient, visit = shortstring.get([(Patient, patient_short_string),
+                                      (Visit, visit_short_string)])
+    if visit and not (patient and visit.parent_key() == patient.key()):
+      visit = None
+    return (patient, visit)
 
   @staticmethod  
   def get_patient_by_name_birthdate(name, birth_date):   
@@ -358,17 +379,12 @@ class Patient(db.Model):
    
   def assign_short_string(self):
     assert self.short_string is None, "Tried to assign short_string twice"
-    while not self.short_string:
-      # 1 / (31^6) = 1e-9 is the probability two strings collide
-      # in an empty space
-      # TODO(dan): This should be in a transaction
-      astr = util.random_string(6)
-      if not Patient.get_by_short_string(astr):
-        self.short_string = astr
-        #logging.info('assigned short string: %s' % self.short_string)
-        # There are funny race conditions if we don't save
-        # Do we need the whole "sharded counter" business?
-        # self.save
+    self.short_string = shortstring.next_short_string(Patient)
+
+  @staticmethod
+  def allocate_short_strings(num):
+    '''Reserve num short strings, e.g. for a bulk import.'''
+    return shortstring.allocate_short_strings(Patient, num)
 
   def get_visits(self):
     return list(Visit.gql('WHERE ANCESTOR IS :1', self))
@@ -383,25 +399,49 @@ class Patient(db.Model):
         self).get()
     return self._latest_visit
 
+  @staticmethod
+  def prefetch_latest_visits(patients):
+    '''Read the latest visits of patients and their statistics in batches.
+
+    The visits are found by latest_visit_short_string through the short
+    string maps (see shortstring.get()), so when those are cached this is
+    one batch get, and get_latest_visit() on these patients needs no query.
+    Patients whose visit is not found that way are left to
+    get_latest_visit().
+
+    Returns the patients as a list, so it can be a search converter.
+    '''
+    patients = list(patients)
+    wanted = [patient for patient in patients
+              if patient.latest_visit_short_string
+              and not hasattr(patient, '_latest_visit')]
+    found = shortstring.get([(Visit, patient.latest_visit_short_string)
+                             for patient in wanted])
+
+    visits = []
+    for patient, visit in zip(wanted, found):
+      if visit and visit.parent_key() == patient.key():
+        patient._latest_visit = visit
+        visits.append(visit)
+    prefetch_references(visits, 'visit_statistics')
+    return patients
+
   def get_num_visits(self):
     query = db.Query(Visit)
     query.ancestor(self)
     return query.count()
 
   def get_visit_by_short_string(self, visitStr):
-    result = list(Visit.gql('WHERE ANCESTOR IS :1 and short_string = :2',
-                            self, visitStr))
-    assert len(result) < 2
-    if len(result) == 1:
-      result = result[0]
-    else:
-      result = None
-    return result
+    visit = Visit.get_by_short_string(visitStr)
+    if visit and visit.parent_key() != self.key():
+      visit = None
+    return visit
 
   def get_visits_by_short_string(self, visitStr):
-    result = list(Visit.gql('WHERE ANCESTOR IS :1 and short_string = :2',
-                            self, visitStr))
-    return result
+    visit = self.get_visit_by_short_string(visitStr)
+    if visit:
+      return [visit]
+    return []
 
   def has_visits(self):
     return self.get_num_visits() > 0
@@ -421,7 +461,7 @@ class Patient(db.Model):
     if latest_visit is None:
       latest_visit = self.get_latest_visit()
     if latest_visit:
-      if force:
+      if force or (self.latest_visit_short_string != latest_visit.short_string):
         self.latest_visit_date = latest_visit.visit_date
         self.latest_visit_short_string = latest_visit.short_string
         # TODO(dan): This throws a TypeError if get_worst_zscore is not
@@ -458,12 +498,15 @@ class PatientCache():
       del keys[0:CHUNK_SIZE]
 
       for patient in db.get(some_keys):
-        num += 1
-        self._cache[patient.key()] = patient
+        # A visit may outlive its patient
+        if patient:
+          num += 1
+          self._cache[patient.key()] = patient
       logging.info("Read %d patients" % num)
 
   def get_patient(self, patient_key):
-    return self._cache[patient_key]
+    '''Return the patient, or None if it was not found.'''
+    return self._cache.get(patient_key)
 
 
 class Visit(db.Model):
@@ -471,6 +514,13 @@ class Visit(db.Model):
   RECUMBENT = 'RECUMBENT'
   UNKNOWN = 'UNKNOWN'
 
+  # Where get_visit_statistics() stores newly calculated statistics:
+  # STATS_ENTITY: a VisitStatistics entity, referenced by visit_statistics
+  # STATS_PACKED: packed_statistics on the visit itself
+  STATS_ENTITY = 'entity'
+  STATS_PACKED = 'packed'
+  STATISTICS_STORAGE = STATS_ENTITY
+
   # parent is Patient
 
   # Date created in this DB
@@ -500,10 +550,20 @@ class Visit(db.Model):
                                       default = STANDING)
   visit_statistics = db.ReferenceProperty(reference_class = VisitStatistics,
                                           required = False, default = None)
+  # The same statistics packed into the visit, so reading them costs no
+  # datastore get.  get_visit_statistics() prefers this when it is set.
+  # See STATISTICS_STORAGE and the packvisitstats command.
+  packed_statistics = PackedVisitStatisticsProperty(required = False,
+                                                    default = None)
   # 'organization' comes from the parent Patient
   # We duplicate it on Visit in order to query against it
   # TODO(dan): Change to required=True
   organization = db.StringProperty(required = False)
+  # 'residence_key' (the residence, lower-cased) and 'country' also come from
+  # the parent Patient, so reports can filter by them in queries.
+  # See set_patient_fields().
+  residence_key = db.StringProperty(required = False)
+  country = db.StringProperty(required = False)
 
   # Notes about the visit
   notes = db.TextProperty(required=False, verbose_name = _('Visit notes'))
@@ -523,16 +583,34 @@ class Visit(db.Model):
 
   def assign_short_string(self):
     assert self.short_string is None, "Tried to assign short_string twice"
-    while not self.short_string:
-      # 1 / (31^6) = 1e-9 is the probability two strings collide
-      # in an empty space
-      astr = util.random_string(6)
-      if not Visit.get_by_short_string(astr):
-        self.short_string = astr
+    self.short_string = shortstring.next_short_string(Visit)
+
+  @staticmethod
+  def allocate_short_strings(num):
+    '''Reserve num short strings, e.g. for a bulk import.'''
+    return shortstring.allocate_short_strings(Visit, num)
 
   @staticmethod
   def get_by_short_string(short_string):
-    return Visit.gql('WHERE short_string = :1', short_string).get()
+    return shortstring.get([(Visit, short_string)])[0]
+
+  @staticmethod
+  def make_residence_key(residence):
+    if residence:
+      return residence.lower()
+    return None
+
+  def set_patient_fields(self, patient):
+    '''Set the fields duplicated from patient.  Returns True iff any changed.
+
+    Does not put() the visit.
+    '''
+    residence_key = Visit.make_residence_key(patient.residence)
+    changed = (self.residence_key != residence_key
+               or self.country != patient.country)
+    self.residence_key = residence_key
+    self.country = patient.country
+    return changed
 
   def copy_to_patient(self, patient):
     """ Create visit like this and attach it to patient """
@@ -540,6 +618,7 @@ class Visit(db.Model):
     for prop in self.properties():
       # copy from self to newVisit
       setattr(newVisit, prop, getattr(self, prop)) 
+    newVisit.set_patient_fields(patient)
     # Could not call put_visit(). The error says 'Nested transactions are not supported' when 
     # the code calls Visit.increment_count() 
     #newVisit.assign_short_string()
@@ -557,8 +636,16 @@ class Visit(db.Model):
     return newVisit
 
   def delete_statistics(self):
-    stats = self.visit_statistics
-    if stats: stats.delete() 
+    stats_key = Visit.visit_statistics.get_value_for_datastore(self)
+    if stats_key: db.delete(stats_key)
+
+  def clear_visit_statistics(self):
+    """Forget the cached statistics, so they are recalculated.
+
+    Does not put() the visit.
+    """
+    self.visit_statistics = None
+    self.packed_statistics = None
 
   @staticmethod
   def delete_visits(visits):
@@ -566,8 +653,9 @@ class Visit(db.Model):
     objs = []
     num = 0
     for visit in visits:
-      stats = visit.visit_statistics
-      if stats: objs.append(stats)
+      # Delete by key, without fetching the statistics
+      stats_key = Visit.visit_statistics.get_value_for_datastore(visit)
+      if stats_key: objs.append(stats_key)
       objs.append(visit)
       num += 1
 
@@ -578,6 +666,7 @@ class Visit(db.Model):
     """ Put the visit, assign short string and increment visit count """
     self.assign_short_string()
     self.put()
+    shortstring.register([self])
     Visit.increment_count() 
     
   @models.permalink
@@ -644,6 +733,9 @@ class Visit(db.Model):
 
   def get_visit_statistics(self):
     # TODO(dan): Implement timeout of cached statistics: 1 day
+    if self.packed_statistics:
+      return self.packed_statistics
+
     try:
       stats = self.visit_statistics
     except db.Error, dummy:
@@ -651,15 +743,18 @@ class Visit(db.Model):
       self.visit_statistics = None
 
     if not stats:
-      visit_stats = VisitStatistics.get_stats_for_visit(self)
-      if visit_stats:
-        visit_stats.put()
-        self.visit_statistics = visit_stats
-      #logging.info("calculate VisitStatistics: %s" % visit_stats)
+      stats = VisitStatistics.get_stats_for_visit(self)
+      if stats:
+        if Visit.STATISTICS_STORAGE == Visit.STATS_PACKED:
+          self.packed_statistics = stats
+        else:
+          stats.put()
+          self.visit_statistics = stats
+      #logging.info("calculate VisitStatistics: %s" % stats)
   
       # Cache the stats or lack thereof
       self.put()
-    return self.visit_statistics
+    return stats
 
   def is_alertworthy(self):
     """Return true if any visit statistic is alertworthy."""
@@ -722,48 +817,73 @@ class Visit(db.Model):
         visit_stat_props.append(prop)
     return visit_stat_props
 
+  @staticmethod
+  def export_csv_header_names():
+    return (['patient_' + x for x in Visit._patient_prop_names]
+            + ['visit_' + x for x in Visit._visit_prop_names]
+            + Visit.visit_stats_expanded_names())
+
   @staticmethod
   def export_csv_header():
-    patient_prop_names = ",".join(map(lambda x: 'patient_' + x,
-                                      Visit._patient_prop_names))
-    visit_prop_names = ",".join(map(lambda x: 'visit_' + x,
-                                    Visit._visit_prop_names))
-    visit_stat_props = Visit.visit_stats_expanded_names()
-    visit_stat_prop_names = ",".join(visit_stat_props)
-    return (patient_prop_names
-            + "," + visit_prop_names
-            + "," + visit_stat_prop_names)
+    return ",".join(Visit.export_csv_header_names())
 
-  def export_csv_line(self, patient):
-    '''A line of CSV values representing this visit and patient.
+  def export_csv_values(self, patient):
+    '''Values representing this visit and patient, for a csv.writer.
 
-    It is in the same order as export_csv_header.
+    They are in the same order as export_csv_header_names.
     Use the patient passed in so that we can load patients in bulk.
     '''
     assert patient.key() == self.parent_key()
-    patient_line = util.csv_line(Visit._patient_prop_names,
-                                 Patient.properties(),
-                                 patient)
-    visit_line = util.csv_line(Visit._visit_prop_names,
-                               Visit.properties(),
-                               self)
+    values = util.csv_values(Visit._patient_prop_names,
+                             Patient.properties(),
+                             patient)
+    values += util.csv_values(Visit._visit_prop_names,
+                              Visit.properties(),
+                              self)
     visit_stats = self.get_visit_statistics()
     if visit_stats:
-      visit_stats_line = util.csv_line(Visit._visit_stat_prop_names,
-                                       VisitStatistics.properties(),
-                                       self.get_visit_statistics())
+      values += util.csv_values(Visit._visit_stat_prop_names,
+                                VisitStatistics.properties(),
+                                visit_stats)
     else:
-      visit_stat_props = []
-      for dummy in range(len(Visit.visit_stats_expanded_names())):
-        visit_stat_props.append('')
-      visit_stats_line = ",".join(visit_stat_props)
+      values += [''] * len(Visit.visit_stats_expanded_names())
+    return values
+
+  def export_csv_line(self, patient):
+    '''A line of CSV values representing this visit and patient.
+
+    It is in the same order as export_csv_header.
+    Use the patient passed in so that we can load patients in bulk.
+    '''
+    return util.csv_row_line(self.export_csv_values(patient))
+
+class VisitPatientFieldsSet(db.Model):
+  """Marks that all visits of the organization (the key name) have their
+  patient fields (see Visit.set_patient_fields()).
+
+  Written by the setvisitpatientfields command; until then, reports check
+  the patients themselves instead of filtering visits by those fields."""
+  set_date = db.DateTimeProperty(auto_now=True)
+
+  @staticmethod
+  def is_set(org):
+    return VisitPatientFieldsSet.get_by_key_name(org) is not None
+
+  @staticmethod
+  def mark(org):
+    VisitPatientFieldsSet(key_name=org).put()
 
-    return patient_line + "," + visit_line + "," + visit_stats_line
 
 # Patient properties to export
-Visit._patient_prop_names = sorted(util.printable_properties(Patient).keys())
+# (not the bookkeeping of the search indexes)
+Visit._patient_prop_names = sorted([
+  name for name in util.printable_properties(Patient).keys()
+  if name != 'search_index_version'])
 # Visit properties to export
-Visit._visit_prop_names = sorted(util.printable_properties(Visit).keys())
+# (not those duplicated from the patient)
+Visit._visit_prop_names = sorted([
+  name for name in util.printable_properties(Visit).keys()
+  if name not in ['residence_key', 'country']])
 # VisitStatistics properties to export
 Visit._visit_stat_prop_names = sorted(util.printable_properties(
                                              VisitStatistics).keys())
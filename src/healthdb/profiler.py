@@ -0,0 +1,199 @@
+'''Sampled cProfile profiles of requests, merged in the datastore.
+
+main.py runs profile_request() instead of the plain handler when
+ENABLE_PROFILER is set.  It profiles PROFILE_PERCENTAGE percent of requests
+(or, with ONLY_FORCED_PROFILE, those with profile=forced in the query
+string), like appenginepatch's profile_main(), but instead of logging the
+stats it stores them as a ProfileSample of the request's view, e.g.
+healthdb.views.patients_search.  That is one put of a new entity, so
+samples do not contend with each other.  merge_samples() later folds them
+into each view's ProfileReport, which merges samples from all requests and
+instances, so hot paths show up under real traffic.
+
+Usage:
+
+merge_samples()
+reports = ProfileReport.all().order('-total_seconds')
+data = get_combined_data(['healthdb.views.reports_view'])
+open('reports.prof', 'wb').write(data)   # then e.g. python -m pstats
+
+The data is the format of pstats.Stats.dump_stats().  See the
+request_profiles view for downloading it.
+'''
+
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import random
+import zlib
+from StringIO import StringIO
+
+from google.appengine.ext import db
+
+from django.conf import settings
+from django.core import urlresolvers
+
+# Name of the view of requests not matching a URL pattern
+UNRESOLVED = 'unresolved'
+# Stay below the datastore's limit on an entity
+MAX_DATA_SIZE = 900 * 1024
+# Samples merged at once
+MERGE_BATCH = 50
+
+
+class ProfileReport(db.Model):
+  """Merged profile stats of sampled requests to one view (the key name)."""
+  num_requests = db.IntegerProperty(required=True, default=0)
+  # Total time of the profiled requests
+  total_seconds = db.FloatProperty(required=True, default=0.0)
+  updated_date = db.DateTimeProperty(auto_now=True)
+  # zlib-compressed marshal of pstats.Stats.stats
+  data = db.BlobProperty(required=False)
+
+  def get_view_name(self):
+    return self.key().name()
+
+  def mean_seconds(self):
+    if not self.num_requests:
+      return 0.0
+    return self.total_seconds / self.num_requests
+
+
+class ProfileSample(db.Model):
+  """The profile stats of one sampled request, until merge_samples()."""
+  view_name = db.StringProperty(required=True)
+  seconds = db.FloatProperty(required=True)
+  # zlib-compressed marshal of pstats.Stats.stats
+  data = db.BlobProperty(required=True)
+
+
+class _StoredStats(object):
+  '''Stats already made, in the form pstats.Stats() reads from a profiler.'''
+  def __init__(self, stats):
+    self.stats = stats
+
+  def create_stats(self):
+    pass
+
+def _load(data):
+  return pstats.Stats(_StoredStats(marshal.loads(zlib.decompress(data))))
+
+def _dump(stats):
+  return zlib.compress(marshal.dumps(stats.stats))
+
+def view_name_for(path):
+  '''The module and name of the view path resolves to.'''
+  try:
+    func = urlresolvers.resolve(path)[0]
+  except urlresolvers.Resolver404:
+    return UNRESOLVED
+  # Django's login_required keeps the view in view_func
+  while hasattr(func, 'view_func'):
+    func = func.view_func
+  return '%s.%s' % (getattr(func, '__module__', ''),
+                    getattr(func, '__name__', func.__class__.__name__))
+
+def should_profile():
+  if getattr(settings, 'ONLY_FORCED_PROFILE', False):
+    return 'profile=forced' in os.environ.get('QUERY_STRING', '')
+  percentage = getattr(settings, 'PROFILE_PERCENTAGE', None)
+  return not percentage or random.random() < float(percentage) / 100.0
+
+def profile_request(func):
+  '''Run func (the request handler), profiling it if sampled.'''
+  if not should_profile():
+    return func()
+
+  prof = cProfile.Profile()
+  try:
+    prof.runcall(func)
+  finally:
+    try:
+      add_sample(view_name_for(os.environ.get('PATH_INFO', '/')),
+                 pstats.Stats(prof))
+    except Exception, err:
+      # Profiling must not fail the request
+      logging.exception('Storing profile failed: %s', err)
+
+def add_sample(view_name, stats):
+  '''Store the pstats.Stats of one request, for merge_samples().'''
+  data = _dump(stats)
+  if len(data) > MAX_DATA_SIZE:
+    logging.warning('Profile of %s is too big, not storing' % view_name)
+    return
+  ProfileSample(view_name=view_name, seconds=stats.total_tt,
+                data=db.Blob(data)).put()
+
+def merge_samples():
+  '''Merge the stored samples into their views' reports, and delete them.'''
+  while True:
+    samples = ProfileSample.all().fetch(MERGE_BATCH)
+    if not samples:
+      break
+    by_view = {}
+    for sample in samples:
+      by_view.setdefault(sample.view_name, []).append(sample)
+    reports = ProfileReport.get_by_key_name(by_view.keys())
+    for view_name, report in zip(by_view.keys(), reports):
+      if report is None:
+        report = ProfileReport(key_name=view_name)
+      merged = report.data and _load(report.data) or None
+      for sample in by_view[view_name]:
+        if merged is None:
+          merged = _load(sample.data)
+        else:
+          merged.add(_load(sample.data))
+        report.num_requests += 1
+        report.total_seconds += sample.seconds
+      data = _dump(merged)
+      if len(data) > MAX_DATA_SIZE:
+        logging.warning('Profile of %s is too big, not storing' % view_name)
+        continue
+      report.data = db.Blob(data)
+      report.put()
+    db.delete(samples)
+
+def _get_combined_stats(view_names=None):
+  '''Merge the reports of view_names, or of all views.  None if none.'''
+  if view_names:
+    reports = ProfileReport.get_by_key_name(view_names)
+  else:
+    reports = ProfileReport.all().fetch(1000)
+  combined = None
+  for report in reports:
+    if not report or not report.data:
+      continue
+    if combined is None:
+      combined = _load(report.data)
+    else:
+      combined.add(_load(report.data))
+  return combined
+
+def get_combined_data(view_names=None):
+  '''Merged stats of view_names (or all views), as pstats would dump them.
+
+  Returns None if there are none.'''
+  combined = _get_combined_stats(view_names)
+  if combined is None:
+    return None
+  return marshal.dumps(combined.stats)
+
+def get_combined_text(view_names=None, sort_by='cumulative', limit=80):
+  '''Merged stats of view_names (or all views), printed by pstats.'''
+  combined = _get_combined_stats(view_names)
+  if combined is None:
+    return ''
+  out = StringIO()
+  combined.stream = out
+  combined.sort_stats(sort_by).print_stats(limit)
+  return out.getvalue()
+
+def delete_reports():
+  for model in (ProfileSample, ProfileReport):
+    while True:
+      keys = model.all(keys_only=True).fetch(100)
+      if not keys:
+        break
+      db.delete(keys)
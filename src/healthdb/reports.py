@@ -1,4 +1,9 @@
+import logging
+
+from ragendja.dbutils import prefetch_references
+
 import models
+import rollup
 import util
 
 class ReportLine():
@@ -14,103 +19,134 @@ class PatientReport():
     self.visit_date_to = visit_date_to
     self.country = default_country
     self.residence = residence
+    # Patients of the visits read so far
+    self._patient_cache = models.PatientCache([])
 
   def _get_visits(self, ordered = False):
-    '''Get visits from our org in our date range.
+    '''Get visits from our org in our date range, and in our residence or
+    (if no residence is given) our country.
+
+    The visits' copies of those are only used once setvisitpatientfields
+    has filled them in for our org; until then _get_patient_visits() checks
+    the patients of all our visits.
     TODO(dan): Move to Visit.'''
     query = "WHERE organization = :1 and visit_date >= :2 and visit_date <= :3"
+    args = [self.org, self.visit_date_from, self.visit_date_to]
+    if (self.residence > '' or self.country > '') \
+        and not models.VisitPatientFieldsSet.is_set(self.org):
+      logging.warning('Visit patient fields of %s not set, run '
+                      'setvisitpatientfields; checking patients instead'
+                      % self.org)
+    elif self.residence > '':
+      query += " and residence_key = :4"
+      args.append(models.Visit.make_residence_key(self.residence))
+    elif self.country > '':
+      query += " and country = :4"
+      args.append(self.country)
     if ordered: query += " ORDER BY visit_date DESC"
     
-    return models.Visit.gql(query, self.org, self.visit_date_from, self.visit_date_to)
+    return models.Visit.gql(query, *args)
+
+  def _get_visit_pages(self, ordered = False):
+    '''Yield the visits of _get_visits() a page at a time.
+
+    The patients of each page are read into self._patient_cache with one
+    batched get, and its visit_statistics with another.'''
+    FETCH_SIZE = 100
+    query = self._get_visits(ordered)
+    visits = query.fetch(FETCH_SIZE)
+    while visits:
+      self._patient_cache.load_patients(
+        [visit.parent_key() for visit in visits])
+      prefetch_references(visits, 'visit_statistics')
+      yield visits
+      if len(visits) < FETCH_SIZE:
+        break
+      query.with_cursor(query.cursor())
+      visits = query.fetch(FETCH_SIZE)
+
+  def _get_patient_visits(self, ordered = False):
+    '''Yield (visit, patient) for our visits whose patient is in our
+    residence or (if no residence is given) our country.
+
+    The query usually filters by the visits' copies of those already, so
+    checking the patient only matters if a copy is out of date, or not yet
+    set (see _get_visits()).'''
+    for visits in self._get_visit_pages(ordered):
+      for visit in visits:
+        patient = self._patient_cache.get_patient(visit.parent_key())
+        if not patient:
+          continue
+        if self.residence > '':
+          if not util.string_eq_nocase(patient.residence, self.residence):
+            continue
+        elif self.country > '':
+          if patient.country != self.country:
+            continue
+        yield (visit, patient)
 
   def get_screening_data(self):
     ''' Return # of visits and # unique patients within a date range.
     '''
     report_data = []
     visit_count = 0
-    visits = self._get_visits()
-    patients = []
-    
-    # Get patients and count
-    if self.residence > '':
-      for visit in visits:
-        if util.string_eq_nocase(visit.get_patient().residence, self.residence):
-          (patients, visit_count) = add_screening_record(visit, patients, visit_count)
-          #patients.append(visit.get_patient())
-          #visit_count += 1
-      patient_count = len(set(patients))
-    elif self.country > '':
-      for visit in visits:  
-        if visit.get_patient().country == self.country:
-          (patients, visit_count) = add_screening_record(visit, patients, visit_count)
-          #patients.append(visit.get_patient())
-          #visit_count += 1
-      patient_count = len(set(patients))          
-    else:       
-      patient_count = len(set([visit.get_patient() for visit in visits])) 
-      visit_count = visits.count()             
-        
+    patient_keys = {}
+    for visit, patient in self._get_patient_visits():
+      visit_count += 1
+      patient_keys[patient.key()] = 1
+
     # Build report
-    report_data.append(ReportLine(visitcount = visit_count, patientcount=patient_count))
+    report_data.append(ReportLine(visitcount = visit_count, patientcount=len(patient_keys)))
     return report_data
 
   def get_screening_details(self):
     ''' Retrieve patients that have visits within a date range in order to build a report
     '''
-    # TODO(dan): Factor get_screening_data and get_screening_details
-    report_detail = []
-    visits = self._get_visits(ordered = True)
-    
-    for visit in visits:
-      if self.residence > '':
-        if util.string_eq_nocase(visit.get_patient().residence, self.residence):
-          report_detail.append(ReportLine(patient=visit.get_patient(), visit=visit))  
-      elif self.country > '':
-        if visit.get_patient().country == self.country:
-          report_detail.append(ReportLine(patient=visit.get_patient(), visit=visit))
-      else:
-        report_detail.append(ReportLine(patient=visit.get_patient(), visit=visit))
-    
-    return report_detail
-    
+    return [ReportLine(patient=patient, visit=visit)
+            for visit, patient in self._get_patient_visits(ordered = True)]
+
   def get_undernutrition_data(self, zscore):
     ''' Retrieve undernutrition data based on zscore in order to build a report
+
+    Reads the precomputed rollup (see rollup.py) when it has been built for
+    our org and zscore is its cutoff.  Each child is then counted by their
+    latest visit in the date range.
+    '''
+    if float(zscore) == rollup.ZSCORE_CUTOFF and rollup.is_built(self.org):
+      totals = rollup.get_totals(self.org, self.visit_date_from,
+                                 self.visit_date_to, self.country,
+                                 self.residence)
+      return make_undernutrition_data(totals['stunted'],
+                                      totals['underweight'],
+                                      totals['wasting'],
+                                      totals['visits'], totals['patients'])
+    return self._get_undernutrition_data_from_visits(zscore)
+
+  def _get_undernutrition_data_from_visits(self, zscore):
+    ''' Undernutrition data from the visits themselves, counting each child
+    by their latest visit in the date range, as rollup.get_totals() does.
     '''
     # TODO(dan): Factor get_undernutrition_data and get_undernutrition_detail
-    report_data = []
-    patients = []
-    visits_latest = []
-    visits = self._get_visits()
+    # patient key -> (visit date, visit key, visit) of the latest visit
+    visits_latest = {}
     stunted_children_counter = 0
     underweight_children_counter = 0
     wasting_children_counter = 0
     visit_counter = 0
-    visit_latest_counter = 0
-    
+
     # Get latest visit per patient
-    for visit in visits:
-      if self.residence > '':
-        if util.string_eq_nocase(visit.get_patient().residence, self.residence):
-          (patients, visits_latest, visit_counter) = add_undernutrition_record(visit, patients, visits_latest, visit_counter)
-          #patients.append(visit.get_patient())
-          #visits_latest.append(visit.get_patient().get_latest_visit())
-          #visit_counter += 1
-      elif self.country > '':
-        if visit.get_patient().country == self.country:
-          (patients, visits_latest, visit_counter) = add_undernutrition_record(visit, patients, visits_latest, visit_counter)
-          #patients.append(visit.get_patient())
-          #visits_latest.append(visit.get_patient().get_latest_visit()) 
-          #visit_counter += 1     
-      else:
-        (patients, visits_latest, visit_counter) = add_undernutrition_record(visit, patients, visits_latest, visit_counter)          
-        #patients.append(visit.get_patient())
-        #visits_latest.append(visit.get_patient().get_latest_visit())
-        #visit_counter += 1
-            
-    visits_latest = list(set(visits_latest))
-    
+    for visit, patient in self._get_patient_visits():
+      visit_counter += 1
+      latest = (visit.visit_date, visit.key(), visit)
+      if patient.key() not in visits_latest \
+          or latest[:2] > visits_latest[patient.key()][:2]:
+        visits_latest[patient.key()] = latest
+
+    patient_count = len(visits_latest)
+    visits_latest = [latest[2] for latest in visits_latest.values()]
+    prefetch_references(visits_latest, 'visit_statistics')
+
     for visit in visits_latest:
-      visit_latest_counter += 1
       # If the statistics does not exist, ignore the visit in the counts
       try:
         stats = visit.get_visit_statistics()
@@ -125,75 +161,73 @@ class PatientReport():
             wasting_children_counter += 1
       except:
         pass
-    # Remove duplicate patients
-    patients = list(set(patients))
-    
-    percent_stunted = 0
-    percent_underweight = 0
-    percent_wasting = 0
-    total_undernourished = 0
-    percent_undernourished = 0
-    
-    if visit_counter > 0:
-      # Calculate percentages    
-      percent_stunted = stunted_children_counter * 100.00 / visit_counter
-      percent_underweight = underweight_children_counter * 100.00 / visit_counter
-      percent_wasting = wasting_children_counter * 100.00 / visit_counter
-      total_undernourished = stunted_children_counter + underweight_children_counter + wasting_children_counter
-      percent_undernourished = total_undernourished * 100.00 / visit_counter
-    
-    # Build report
-    report_data.append(ReportLine(stunted=stunted_children_counter, percentagestunted=percent_stunted,
-                                  underweight=underweight_children_counter, percentageunderweight=percent_underweight,
-                                  wasting=wasting_children_counter, percentagewasting=percent_wasting,
-                                  totalundernourished = total_undernourished, percentundernourished = percent_undernourished,
-                                  visitcount=visit_counter, patientcount=len(patients)))
-    
-    return report_data
 
-  def get_undernutrition_detail(self, zscore_type, zscore):
+    return make_undernutrition_data(stunted_children_counter,
+                                    underweight_children_counter,
+                                    wasting_children_counter,
+                                    visit_counter, patient_count)
+
+  def get_undernutrition_details(self, zscore):
     ''' Retrieve patients with undernutrition zscores within a date range in order to build a report
+
+    Returns a map from each report name in rollup.INDICATORS ('stunted',
+    'underweight', 'wasting') to its report lines, from one pass over the
+    visits.
     '''
-    report_detail = []
-    visits = self._get_visits(ordered = True)
-    for visit in visits:
+    cutoff = float(zscore)
+    report_details = {}
+    for dummy, name, dummy in rollup.INDICATORS:
+      report_details[name] = []
+
+    for visit, patient in self._get_patient_visits(ordered = True):
+      # If the statistics do not exist, leave the visit out
       try:
         stats = visit.get_visit_statistics()
-        stat = float(zscore)
-        if zscore_type == 'stunted':
-          stat = float(stats.length_or_height_for_age.zscore)
-        elif zscore_type == 'underweight':
-          stat = float(stats.weight_for_age.zscore)
-        elif zscore_type == 'wasting':
-          stat = float(stats.weight_for_length_or_height.zscore)
-        else:
-          stat = float(zscore)
-          
-        if stat < float(zscore):
-          if self.residence > '':
-            if util.string_eq_nocase(visit.get_patient().residence, self.residence):
-              report_detail.append(ReportLine(patient=visit.get_patient(), visit=visit))
-          elif self.country > '':
-            if visit.get_patient().country == self.country:
-              report_detail.append(ReportLine(patient=visit.get_patient(), visit=visit))
-          else:
-            report_detail.append(ReportLine(patient=visit.get_patient(), visit=visit))  
       except:
-        pass
-    
-    return report_detail
+        stats = None
+      if not stats:
+        continue
+      line = ReportLine(patient=patient, visit=visit)
+      for dummy, name, indicator in rollup.INDICATORS:
+        try:
+          stat = float(getattr(stats, indicator).zscore)
+        except (AttributeError, TypeError, ValueError):
+          continue
+        if stat < cutoff:
+          report_details[name].append(line)
 
-def add_screening_record(visit, patients, visit_count):
-  '''helper function
-  '''
-  patients.append(visit.get_patient())
-  visit_count += 1
-  return (patients, visit_count)
-  
-def add_undernutrition_record(visit, patients, visits_latest, visit_counter):
-  '''helper function
+    return report_details
+
+  def get_undernutrition_detail(self, zscore_type, zscore):
+    ''' Retrieve patients with undernutrition zscores of one type
+    '''
+    return self.get_undernutrition_details(zscore).get(zscore_type, [])
+
+def make_undernutrition_data(stunted_children_counter,
+                             underweight_children_counter,
+                             wasting_children_counter, visit_counter,
+                             patient_count):
+  '''Build the undernutrition report lines from the counts
   '''
-  patients.append(visit.get_patient())
-  visits_latest.append(visit.get_patient().get_latest_visit())
-  visit_counter += 1
-  return (patients, visits_latest, visit_counter)
\ No newline at end of file
+  report_data = []
+  percent_stunted = 0
+  percent_underweight = 0
+  percent_wasting = 0
+  total_undernourished = 0
+  percent_undernourished = 0
+
+  if visit_counter > 0:
+    # Calculate percentages
+    percent_stunted = stunted_children_counter * 100.00 / visit_counter
+    percent_underweight = underweight_children_counter * 100.00 / visit_counter
+    percent_wasting = wasting_children_counter * 100.00 / visit_counter
+    total_undernourished = stunted_children_counter + underweight_children_counter + wasting_children_counter
+    percent_undernourished = total_undernourished * 100.00 / visit_counter
+
+  # Build report
+  report_data.append(ReportLine(stunted=stunted_children_counter, percentagestunted=percent_stunted,
+                                underweight=underweight_children_counter, percentageunderweight=percent_underweight,
+                                wasting=wasting_children_counter, percentagewasting=percent_wasting,
+                                totalundernourished = total_undernourished, percentundernourished = percent_undernourished,
+                                visitcount=visit_counter, patientcount=patient_count))
+  return report_data
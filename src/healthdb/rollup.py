@@ -0,0 +1,250 @@
+'''Undernutrition rollup.
+
+Per-day undernutrition counts for each organization, country and
+residence, kept up to date as visits are stored, edited and deleted, so the
+undernutrition report reads one entity per day instead of every visit,
+its patient and its statistics.
+
+Usage:
+
+add_visits(visits, patient)          # after visits are stored
+add_visit_pairs([(visit, patient), ...])   # same, for several patients
+remove_visits(visits, patient)       # when visits are deleted
+old_names = bucket_names(visits, patient)  # before a visit or patient edit
+move_visits(old_names, visits, patient)    # after it
+totals = get_totals(org, date_from, date_to, country, residence)
+
+Each UndernutritionRollup holds the visits of one day as parallel lists of
+visit keys, patient keys and flags, so a visit can be replaced or removed
+exactly.  Updates to one rollup run in a transaction.  If one fails, the
+organization is marked not built, so reports read the visits again until
+rebuildrollup is run.
+
+To build the rollup for existing visits, use the rebuildrollup command.
+Reports only read the rollup of an organization once that has been run.
+'''
+
+import logging
+
+from google.appengine.ext import db
+
+# (flag letter, report name, VisitStatistics indicator)
+INDICATORS = [('s', 'stunted', 'length_or_height_for_age'),
+              ('u', 'underweight', 'weight_for_age'),
+              ('w', 'wasting', 'weight_for_length_or_height')]
+
+# A visit is flagged for an indicator when its zscore is below this
+ZSCORE_CUTOFF = -2.0
+
+# Flags of a visit with no indicator below ZSCORE_CUTOFF
+NO_FLAGS = '-'
+
+
+class UndernutritionRollup(db.Model):
+  """The visits of one day for an organization, country and residence."""
+  organization = db.StringProperty(required=True)
+  country = db.StringProperty(required=False)
+  # Lower-cased, to match residences without regard to case
+  residence = db.StringProperty(required=False)
+  day = db.DateProperty(required=True)
+
+  # Parallel lists, one entry per visit
+  visit_keys = db.ListProperty(db.Key, indexed=False)
+  patient_keys = db.ListProperty(db.Key, indexed=False)
+  # Letters from INDICATORS for the visit's low zscores, or NO_FLAGS
+  flags = db.StringListProperty(indexed=False)
+
+  def remove_visit(self, visit_key):
+    if visit_key in self.visit_keys:
+      idx = self.visit_keys.index(visit_key)
+      del self.visit_keys[idx]
+      del self.patient_keys[idx]
+      del self.flags[idx]
+
+  def add_visit(self, visit_key, patient_key, flags):
+    '''Add a visit, replacing it if it is already here.'''
+    self.remove_visit(visit_key)
+    self.visit_keys.append(visit_key)
+    self.patient_keys.append(patient_key)
+    self.flags.append(flags)
+
+
+class UndernutritionRollupBuilt(db.Model):
+  """Marks that the rollup of the organization (the key name) is complete.
+
+  Written by the rebuildrollup command; until then, reports read visits."""
+  built = db.DateTimeProperty(auto_now=True)
+
+
+def is_built(org):
+  return UndernutritionRollupBuilt.get_by_key_name(org) is not None
+
+def set_built(org):
+  UndernutritionRollupBuilt(key_name=org).put()
+
+def clear_built(org):
+  db.delete(db.Key.from_path(UndernutritionRollupBuilt.kind(), org))
+
+def normalize_residence(residence):
+  return (residence or '').lower()
+
+def bucket_name(visit, patient):
+  '''Key name of the rollup that visit of patient belongs to.'''
+  return '%s|%s|%s|%s' % (visit.organization, patient.country or '',
+                          normalize_residence(patient.residence),
+                          visit.visit_date.isoformat())
+
+def bucket_names(visits, patient):
+  return [bucket_name(visit, patient) for visit in visits]
+
+def visit_flags(visit):
+  '''Flags for the indicators of visit below ZSCORE_CUTOFF.'''
+  stats = visit.get_visit_statistics()
+  flags = ''
+  if stats:
+    for letter, dummy, indicator in INDICATORS:
+      zandp = getattr(stats, indicator, None)
+      if zandp and zandp.zscore and zandp.zscore < ZSCORE_CUTOFF:
+        flags += letter
+  return flags or NO_FLAGS
+
+def bucket_attrs(visit, patient):
+  return {'organization': visit.organization,
+          'country': patient.country,
+          'residence': normalize_residence(patient.residence),
+          'day': visit.visit_date}
+
+class _Changes():
+  '''Changes to several rollups, applied one transaction per rollup.'''
+  def __init__(self):
+    # key name -> [attrs, visit keys to remove, (visit, patient key, flags)s]
+    self._changes = {}
+
+  def _get(self, name, attrs):
+    if name not in self._changes:
+      self._changes[name] = [attrs, [], []]
+    return self._changes[name]
+
+  def remove(self, name, visit_key):
+    self._get(name, None)[1].append(visit_key)
+
+  def add(self, visit, patient):
+    name = bucket_name(visit, patient)
+    change = self._get(name, bucket_attrs(visit, patient))
+    change[0] = bucket_attrs(visit, patient)
+    change[2].append((visit.key(), patient.key(), visit_flags(visit)))
+
+  def apply(self):
+    '''Return the organizations whose rollup failed to update.'''
+    failed_orgs = {}
+    for name, (attrs, remove_keys, entries) in self._changes.items():
+      try:
+        db.run_in_transaction(_update_rollup, name, attrs, remove_keys,
+                              entries)
+      except Exception, err:
+        logging.exception('Updating rollup %s failed: %s', name, err)
+        # The organization is the first part of the bucket name
+        failed_orgs[name.split('|')[0]] = 1
+    for org in failed_orgs:
+      # Reports read the visits until rebuildrollup is run
+      clear_built(org)
+      logging.error('Marked the rollup of %s not built; run rebuildrollup'
+                    % org)
+    return failed_orgs.keys()
+
+def _update_rollup(name, attrs, remove_keys, entries):
+  rollup = UndernutritionRollup.get_by_key_name(name)
+  if rollup is None:
+    if not entries:
+      return
+    rollup = UndernutritionRollup(key_name=name, **attrs)
+  for visit_key in remove_keys:
+    rollup.remove_visit(visit_key)
+  for visit_key, patient_key, flags in entries:
+    rollup.add_visit(visit_key, patient_key, flags)
+  if rollup.visit_keys:
+    rollup.put()
+  elif rollup.is_saved():
+    rollup.delete()
+
+def add_visits(visits, patient):
+  '''Add (or update) stored visits of patient.'''
+  add_visit_pairs([(visit, patient) for visit in visits])
+
+def add_visit_pairs(pairs):
+  '''Add (or update) stored visits, given as (visit, patient) pairs.
+  Return the organizations whose rollup failed to update.'''
+  changes = _Changes()
+  for visit, patient in pairs:
+    changes.add(visit, patient)
+  return changes.apply()
+
+def remove_visits(visits, patient):
+  changes = _Changes()
+  for visit in visits:
+    changes.remove(bucket_name(visit, patient), visit.key())
+  changes.apply()
+
+def move_visits(old_names, visits, patient):
+  '''Update visits of patient after an edit.
+
+  old_names are the bucket_names() of the visits from before the edit.
+  '''
+  changes = _Changes()
+  for old_name, visit in zip(old_names, visits):
+    if old_name != bucket_name(visit, patient):
+      changes.remove(old_name, visit.key())
+    changes.add(visit, patient)
+  changes.apply()
+
+def get_rollups(org, date_from, date_to, country='', residence=''):
+  '''Rollups in the date range, in day order.
+
+  As in the reports, a residence takes precedence over a country.
+  '''
+  query = UndernutritionRollup.all().filter('organization =', org)
+  if residence:
+    query.filter('residence =', normalize_residence(residence))
+  elif country:
+    query.filter('country =', country)
+  query.filter('day >=', date_from).filter('day <=', date_to).order('day')
+
+  FETCH_SIZE = 100
+  rollups = query.fetch(FETCH_SIZE)
+  while rollups:
+    for rollup in rollups:
+      yield rollup
+    if len(rollups) < FETCH_SIZE:
+      break
+    query.with_cursor(query.cursor())
+    rollups = query.fetch(FETCH_SIZE)
+
+def get_totals(org, date_from, date_to, country='', residence=''):
+  '''Undernutrition counts for visits in the date range.
+
+  Returns a map with 'visits' (the number of visits), 'patients' (the
+  number of children with a visit) and, for each report name in INDICATORS,
+  the number of children whose latest visit in the range is flagged.  Of a
+  child's visits on the same day, the one with the greater key is latest.
+  '''
+  num_visits = 0
+  # patient key -> (day, visit key, flags) of the patient's latest visit
+  latest_flags = {}
+  num_rollups = 0
+  for rollup in get_rollups(org, date_from, date_to, country, residence):
+    num_rollups += 1
+    num_visits += len(rollup.visit_keys)
+    for visit_key, patient_key, flags in zip(rollup.visit_keys,
+                                             rollup.patient_keys,
+                                             rollup.flags):
+      latest = (rollup.day, visit_key, flags)
+      if patient_key not in latest_flags \
+          or latest[:2] > latest_flags[patient_key][:2]:
+        latest_flags[patient_key] = latest
+  logging.info("Read %d undernutrition rollups" % num_rollups)
+
+  totals = {'visits': num_visits, 'patients': len(latest_flags)}
+  for letter, name, dummy in INDICATORS:
+    totals[name] = len([latest for latest in latest_flags.values()
+                        if letter in latest[2]])
+  return totals
@@ -0,0 +1,350 @@
+'''Per-organization snapshots of the patient search terms, for typeahead.
+
+A snapshot holds a short record of each patient of an organization, and an
+inverted index from each search term (made by search_util.splitter and
+search_util.indexer, as for Patient.search_index) to the sorted ids of the
+patients with that term.  search() answers a query from it without
+datastore calls.
+
+Usage:
+
+results = search(org, query, limit)  # records of the matching patients
+
+Snapshots are kept in memcache, compressed and split into chunks (a memcache
+value is at most 1MB), and in each process.  Saving or deleting a patient
+appends the change to its organization's change log in memcache (a counter,
+and an entry per change), so readers apply the changes they have not seen.
+After COMPACT_CHANGES changes a reader stores a new snapshot.
+
+A snapshot is rebuilt from the datastore when it is missing, is older than
+MAX_AGE_SECONDS, or a change it needs is still gone after GAP_SECONDS.  The
+rebuild runs in a task (one at a time per organization, see queue_build());
+meanwhile search() uses the snapshot it has, however stale, or else the
+patient search index.  Changes made where this module is not loaded (e.g.
+by management commands over remote_api, whose memcache is local) show up
+once it is rebuilt.
+'''
+
+import bisect
+import logging
+import marshal
+import time
+import zlib
+
+from google.appengine.api import memcache
+try:
+  from google.appengine.api.taskqueue import Task
+except ImportError:
+  from google.appengine.api.labs.taskqueue import Task
+from django.core.urlresolvers import reverse
+from django.db.models import signals
+
+import models
+import search_util
+
+# memcache namespace
+MEMCACHE_PREFIX = 'search_snapshot:'
+# Bytes of a snapshot per memcache value
+CHUNK_SIZE = 1000000
+MAX_AGE_SECONDS = 24 * 60 * 60
+# Changes applied before a reader stores a new snapshot
+COMPACT_CHANGES = 100
+# How long a missing change may be in flight (counted, not yet stored)
+# before the snapshot is rebuilt
+GAP_SECONDS = 30
+# How long a queued rebuild keeps others from queueing one
+BUILD_LOCK_SECONDS = 10 * 60
+# Patients read by search() when there is no snapshot yet
+FALLBACK_FETCH = 100
+# Patients read at once when building
+FETCH_SIZE = 500
+# Increase when the record or index format changes
+FORMAT_VERSION = 1
+
+# Fields of a patient's record
+RECORD_FIELDS = ('short_string', 'name', 'birth_date', 'residence',
+                 'caregiver_name', 'country')
+# Fields whose terms are indexed
+INDEXED_FIELDS = ('name', 'residence', 'birth_date', 'caregiver_name')
+
+# org -> the Snapshot this process last used
+_snapshots = {}
+
+
+def _header_key(org):
+  return '%s%s' % (MEMCACHE_PREFIX, org)
+
+def _chunk_key(org, generation, index):
+  return '%s%s:%s:%d' % (MEMCACHE_PREFIX, org, generation, index)
+
+def _counter_key(org):
+  return '%schanges:%s' % (MEMCACHE_PREFIX, org)
+
+def _change_key(org, num):
+  return '%schange:%s:%d' % (MEMCACHE_PREFIX, org, num)
+
+def _lock_key(org):
+  return '%sbuilding:%s' % (MEMCACHE_PREFIX, org)
+
+def _patient_id(patient):
+  return patient.key().id_or_name()
+
+def make_record(patient):
+  '''The record of a patient: a tuple of RECORD_FIELDS, as strings.'''
+  record = []
+  for field in RECORD_FIELDS:
+    value = getattr(patient, field)
+    if value is None:
+      value = u''
+    record.append(unicode(value))
+  return tuple(record)
+
+def _record_words(record):
+  '''The words of a record's indexed fields.'''
+  words = []
+  for field in INDEXED_FIELDS:
+    words.extend(search_util.splitter(record[RECORD_FIELDS.index(field)],
+                                      indexing=True))
+  return words
+
+
+class Snapshot(object):
+  """The records and search terms of an organization's patients."""
+  def __init__(self, num_changes=0, built=None):
+    # patient id -> record
+    self.records = {}
+    # term -> sorted patient ids
+    self.terms = {}
+    # Number of changes of the change log applied
+    self.num_changes = num_changes
+    self.built = built or time.time()
+    # Of the snapshot in memcache, if any, this was loaded from or stored as
+    self.generation = None
+    # When the next change was first found missing, if it is
+    self.missing_since = None
+
+  def _terms_of(self, record):
+    return set(search_util.indexer(_record_words(record), indexing=True))
+
+  def put(self, patient_id, record):
+    '''Add or replace a patient's record, or remove it if record is None.'''
+    old = self.records.get(patient_id)
+    if old == record:
+      return
+    if old:
+      for term in self._terms_of(old):
+        ids = self.terms[term]
+        del ids[bisect.bisect_left(ids, patient_id)]
+        if not ids:
+          del self.terms[term]
+      del self.records[patient_id]
+    if record:
+      for term in self._terms_of(record):
+        bisect.insort(self.terms.setdefault(term, []), patient_id)
+      self.records[patient_id] = record
+
+  def search(self, query, limit=10, country=None):
+    '''Records of patients matching every word of query, by name.
+
+    Each word must start a word of the patient's indexed fields.  (The index
+    finds the candidates, so a word shorter than the shortest indexed
+    prefix only matches a whole word.)'''
+    words = set(search_util.splitter(query, indexing=False))
+    if not words:
+      return []
+    postings = [self.terms.get(term, []) for term in
+                set(search_util.indexer(list(words), indexing=False))]
+    if not postings:
+      return []
+    postings.sort(key=len)
+    ids = set(postings[0])
+    for other in postings[1:]:
+      ids.intersection_update(other)
+
+    records = []
+    for patient_id in ids:
+      record = self.records[patient_id]
+      if country and record[RECORD_FIELDS.index('country')] != country:
+        continue
+      # Terms past the longest indexed prefix only found candidates
+      record_words = _record_words(record)
+      for word in words:
+        for record_word in record_words:
+          if record_word.startswith(word):
+            break
+        else:
+          break
+      else:
+        records.append(record)
+    records.sort(key=lambda record: record[RECORD_FIELDS.index('name')])
+    return records[:limit]
+
+  def dumps(self):
+    return zlib.compress(marshal.dumps(
+      (FORMAT_VERSION, self.num_changes, self.built, self.records,
+       self.terms)))
+
+  @staticmethod
+  def loads(data):
+    '''The snapshot dumped as data, or None if it has an old format.'''
+    version, num_changes, built, records, terms = \
+      marshal.loads(zlib.decompress(data))
+    if version != FORMAT_VERSION:
+      return None
+    snapshot = Snapshot(num_changes, built)
+    snapshot.records = records
+    snapshot.terms = terms
+    return snapshot
+
+
+def _store(org, snapshot):
+  '''Store snapshot in memcache, chunks first and then its header.'''
+  data = snapshot.dumps()
+  generation = '%d' % (time.time() * 1000)
+  chunks = {}
+  for index, start in enumerate(range(0, len(data), CHUNK_SIZE)):
+    chunks[_chunk_key(org, generation, index)] = \
+      data[start:start + CHUNK_SIZE]
+  if memcache.set_multi(chunks, time=MAX_AGE_SECONDS):
+    logging.warning('Could not store the search snapshot of %s' % org)
+    return
+  memcache.set(_header_key(org), (generation, len(chunks),
+                                  snapshot.num_changes, snapshot.built),
+               time=MAX_AGE_SECONDS)
+  snapshot.generation = generation
+
+def _load(org, header):
+  '''The snapshot with header from memcache, or None if it is gone.'''
+  generation, num_chunks = header[:2]
+  keys = [_chunk_key(org, generation, index) for index in range(num_chunks)]
+  chunks = memcache.get_multi(keys)
+  if len(chunks) < num_chunks:
+    return None
+  snapshot = Snapshot.loads(''.join([chunks[key] for key in keys]))
+  if snapshot:
+    snapshot.generation = generation
+  return snapshot
+
+def build(org):
+  '''Build the snapshot of org from the datastore, and store it.
+
+  Reads every patient of org, so it runs in a task, see queue_build().'''
+  # Changes after this are applied by readers, so note it first
+  memcache.add(_counter_key(org), 0)
+  snapshot = Snapshot(memcache.get(_counter_key(org)) or 0)
+  query = models.Patient.all().filter('organization =', org)
+  patients = query.fetch(FETCH_SIZE)
+  while patients:
+    for patient in patients:
+      snapshot.put(_patient_id(patient), make_record(patient))
+    if len(patients) < FETCH_SIZE:
+      break
+    query.with_cursor(query.cursor())
+    patients = query.fetch(FETCH_SIZE)
+  logging.info('Built the search snapshot of %s: %d patients, %d terms'
+               % (org, len(snapshot.records), len(snapshot.terms)))
+  _store(org, snapshot)
+  return snapshot
+
+def queue_build(org):
+  '''Queue a task to build the snapshot of org, unless one is queued.'''
+  if memcache.add(_lock_key(org), 1, time=BUILD_LOCK_SECONDS):
+    Task(url=reverse('healthdb.views.search_snapshot_task'), method='POST',
+         params={'org': org}).add()
+
+def run_build_task(org):
+  build(org)
+  memcache.delete(_lock_key(org))
+
+def _apply_changes(org, snapshot, num_changes):
+  '''Apply the changes up to num_changes, stopping at one that is missing.
+  Returns False if one is.'''
+  keys = [_change_key(org, num)
+          for num in range(snapshot.num_changes + 1, num_changes + 1)]
+  changes = memcache.get_multi(keys)
+  for key in keys:
+    if key not in changes:
+      if snapshot.missing_since is None:
+        snapshot.missing_since = time.time()
+      return False
+    patient_id, record = changes[key]
+    snapshot.put(patient_id, record)
+    snapshot.num_changes += 1
+  snapshot.missing_since = None
+  return True
+
+def get_snapshot(org):
+  '''The snapshot of org, as current as memcache allows.
+
+  Queues a rebuild if it is missing or out of date, and returns None if
+  there is none yet.'''
+  header_key = _header_key(org)
+  counter_key = _counter_key(org)
+  cached = memcache.get_multi([header_key, counter_key])
+  header = cached.get(header_key)
+  num_changes = cached.get(counter_key)
+  snapshot = _snapshots.get(org)
+  if header is None or num_changes is None:
+    # Changes since this process's snapshot (if any) are gone
+    queue_build(org)
+    return snapshot
+  if time.time() - header[3] > MAX_AGE_SECONDS:
+    queue_build(org)
+
+  if not snapshot or snapshot.generation != header[0]:
+    snapshot = _load(org, header) or snapshot
+    if not snapshot:
+      queue_build(org)
+      return None
+  if num_changes < snapshot.num_changes:
+    # The change log was restarted, by a build
+    queue_build(org)
+  elif not _apply_changes(org, snapshot, num_changes):
+    if time.time() - snapshot.missing_since > GAP_SECONDS:
+      queue_build(org)
+  elif num_changes - header[2] >= COMPACT_CHANGES:
+    _store(org, snapshot)
+  _snapshots[org] = snapshot
+  return snapshot
+
+def _search_index(org, query, limit, country):
+  '''Snapshot.search() over the patients the search index finds for
+  query, for when there is no snapshot yet.'''
+  if not search_util.splitter(query, indexing=False):
+    return []
+  filters = ('organization =', org)
+  if country:
+    filters += ('country =', country)
+  snapshot = Snapshot()
+  for patient in models.Patient.search_index.search(
+      query, filters=filters).fetch(FALLBACK_FETCH):
+    snapshot.put(_patient_id(patient), make_record(patient))
+  return snapshot.search(query, limit, country)
+
+def search(org, query, limit=10, country=None):
+  '''Records (as dicts of RECORD_FIELDS) of org's patients matching query,
+  see Snapshot.search().'''
+  snapshot = get_snapshot(org)
+  if snapshot:
+    records = snapshot.search(query, limit, country)
+  else:
+    records = _search_index(org, query, limit, country)
+  return [dict(zip(RECORD_FIELDS, record)) for record in records]
+
+
+def _add_change(org, patient_id, record):
+  # Only when a snapshot of org is kept (the counter exists)
+  num = memcache.incr(_counter_key(org))
+  if num is not None:
+    memcache.set(_change_key(org, num), (patient_id, record),
+                 time=MAX_AGE_SECONDS)
+
+def patient_saved(sender, instance, **kwargs):
+  _add_change(instance.organization, _patient_id(instance),
+              make_record(instance))
+
+def patient_deleted(sender, instance, **kwargs):
+  _add_change(instance.organization, _patient_id(instance), None)
+
+signals.post_save_committed.connect(patient_saved, sender=models.Patient)
+signals.post_delete_committed.connect(patient_deleted, sender=models.Patient)
@@ -1,6 +1,10 @@
 import re
 import string
 
+from django.conf import settings
+
+from search.core import capped_startswith
+
 _PUNCTUATION_REGEX = re.compile(
     '[' + re.escape(string.punctuation.replace('-', '').replace(
         '_', '').replace('#', '').replace('-', '')) + ']')
@@ -37,3 +41,19 @@ def splitter(text, indexing=False, **kwargs):
         if word:
             keywords.append(word)
     return keywords
+
+# Version of the splitter and indexers, stamped on each patient put.
+# Increase it when they change, then run updatesearchindex.
+# 1: every prefix
+# 2: capped prefixes
+INDEX_VERSION = 2
+
+# Prefixes of min to max length, and whole words outside that, are indexed.
+# Terms longer than max are searched by their prefix, so check the results
+# with SearchIndexProperty.matches().
+indexer = capped_startswith(
+    getattr(settings, 'SEARCH_PREFIX_MIN_LENGTH', 1),
+    getattr(settings, 'SEARCH_PREFIX_MAX_LENGTH', None))
+
+# Birth dates are searched by YYYY, YYYY-MM or YYYY-MM-DD
+date_indexer = capped_startswith(4, 10)
@@ -0,0 +1,153 @@
+'''Short string lookup.
+
+Patients and visits are named in URLs by their short_string.  Rather than
+query by that property, look up a ShortStringMap, whose key name is built
+from the kind and short string, and which holds the entity's key.  The
+mappings are cached in memcache.
+
+Usage:
+
+patient.short_string = next_short_string(models.Patient)
+register([patient, visit])       # after they are put
+patient, visit = get([(models.Patient, patientStr),
+                      (models.Visit, visitStr)])
+
+New short strings are reserved by creating their ShortStringMap (without a
+target yet) in a transaction, so two requests never get the same one.  Each
+process reserves RESERVE_SIZE at a time and hands them out as needed, so
+most creates cost no datastore calls for their short string.  This relies
+on every existing short string having a map: run addshortstringmap first.
+
+A mapping is only a hint: get() checks the entity it finds, and falls back
+to a query (repairing the mapping) when it is missing or stale, e.g. for
+visits copied by a patient merge.  To add mappings for existing entities,
+use the addshortstringmap command.
+'''
+
+import logging
+import threading
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import util
+
+# memcache namespace for mappings
+MEMCACHE_PREFIX = 'shortstring:'
+
+SHORT_STRING_LENGTH = 6
+# Short strings a process reserves at a time
+RESERVE_SIZE = 10
+
+# kind -> short strings reserved by this process, not yet used
+_reserved = {}
+_reserved_lock = threading.Lock()
+
+
+class ShortStringMap(db.Model):
+  """Maps a kind and short string (the key name) to an entity.
+
+  Without a target, the short string is reserved but not yet used."""
+  target = db.ReferenceProperty(required=False, indexed=False)
+
+  def get_target_key(self):
+    return ShortStringMap.target.get_value_for_datastore(self)
+
+
+def _key_name(kind, short_string):
+  return '%s:%s' % (kind, short_string)
+
+def register(entities):
+  '''Store the mappings of stored entities with short strings.'''
+  maps = []
+  cached = {}
+  for entity in entities:
+    key_name = _key_name(entity.kind(), entity.short_string)
+    maps.append(ShortStringMap(key_name=key_name, target=entity.key()))
+    cached[key_name] = str(entity.key())
+  db.put(maps)
+  memcache.set_multi(cached, key_prefix=MEMCACHE_PREFIX)
+
+def _get_target_keys(key_names):
+  '''Return key name -> target key for the mappings that exist.'''
+  target_keys = {}
+  cached = memcache.get_multi(key_names, key_prefix=MEMCACHE_PREFIX)
+  for key_name, key_str in cached.items():
+    target_keys[key_name] = db.Key(key_str)
+
+  missing = [key_name for key_name in key_names if key_name not in cached]
+  if missing:
+    to_cache = {}
+    for key_name, the_map in zip(missing,
+                                 ShortStringMap.get_by_key_name(missing)):
+      if the_map and the_map.get_target_key():
+        target_keys[key_name] = the_map.get_target_key()
+        to_cache[key_name] = str(target_keys[key_name])
+    if to_cache:
+      memcache.set_multi(to_cache, key_prefix=MEMCACHE_PREFIX)
+  return target_keys
+
+def get(pairs):
+  '''Return the entities for (model class, short string) pairs.
+
+  An entity that does not exist is None.  When all mappings are cached and
+  current, this is one batch get.
+  '''
+  key_names = [_key_name(model_class.kind(), short_string)
+               for model_class, short_string in pairs]
+  target_keys = _get_target_keys(key_names)
+  found_keys = [target_keys[key_name] for key_name in key_names
+                if key_name in target_keys]
+  found = {}
+  for entity in db.get(found_keys):
+    if entity:
+      found[entity.key()] = entity
+
+  entities = []
+  to_register = []
+  for (model_class, short_string), key_name in zip(pairs, key_names):
+    entity = found.get(target_keys.get(key_name))
+    if entity is None or entity.short_string != short_string:
+      entity = model_class.all().filter('short_string =', short_string).get()
+      if entity:
+        logging.info("Repairing short string map %s" % key_name)
+        to_register.append(entity)
+    entities.append(entity)
+  if to_register:
+    register(to_register)
+  return entities
+
+def _reserve(key_name):
+  if ShortStringMap.get_by_key_name(key_name):
+    return False
+  ShortStringMap(key_name=key_name).put()
+  return True
+
+def allocate_short_strings(model_class, num):
+  '''Reserve and return num new short strings for model_class.'''
+  kind = model_class.kind()
+  short_strings = []
+  while len(short_strings) < num:
+    # 1 / (31^6) = 1e-9 is the probability two strings collide
+    # in an empty space
+    candidates = list(set([util.random_string(SHORT_STRING_LENGTH)
+                           for dummy in range(num - len(short_strings))]))
+    key_names = [_key_name(kind, candidate) for candidate in candidates]
+    # Skip the taken ones without a transaction each
+    maps = ShortStringMap.get_by_key_name(key_names)
+    for candidate, key_name, the_map in zip(candidates, key_names, maps):
+      if the_map is None and db.run_in_transaction(_reserve, key_name):
+        short_strings.append(candidate)
+  return short_strings
+
+def next_short_string(model_class):
+  '''Return a new short string for model_class, reserved by this process.'''
+  # Mapper threads call this at once
+  _reserved_lock.acquire()
+  try:
+    reserved = _reserved.setdefault(model_class.kind(), [])
+    if not reserved:
+      reserved.extend(allocate_short_strings(model_class, RESERVE_SIZE))
+    return reserved.pop()
+  finally:
+    _reserved_lock.release()
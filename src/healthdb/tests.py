@@ -6,20 +6,64 @@ import math
 import unittest
 from xml.dom import minidom
 
+# AppEngine imports
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
 # Local imports
 import models
 import util
 import datetime
 import counter
+import export
+import mailer
+import reports
+import rollup
+import shortstring
+import db_cache
+import db_log
+import profiler
+import mapper
+import search_util
+import search_snapshot
+import views
 
 from growthcalc.growthcalc import VisitStatistics
 import growthcalc.growthcalc
+import growthcalc.scorecache
 
 from growthcalc.growthcalc import Sex
 from growthcalc.growthcalc import Measured
 
+from search.core import capped_startswith, update_index_values
+
+import base64
 import csv
 
+from django.core.urlresolvers import resolve, reverse
+from django.http import HttpRequest, QueryDict
+
+def run_tasks(view_name, queue_name='default'):
+  '''Run the queued tasks to view_name (and those they queue), as the task
+  queue would.  Returns the number run.'''
+  from google.appengine.api import apiproxy_stub_map
+  stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+  url = reverse(view_name)
+  num = 0
+  while True:
+    tasks = [task for task in stub.GetTasks(queue_name)
+             if task['url'] == url]
+    if not tasks:
+      return num
+    for task in tasks:
+      stub.DeleteTask(queue_name, task['name'])
+      view, args, kwargs = resolve(task['url'])
+      request = HttpRequest()
+      request.method = 'POST'
+      request.POST = QueryDict(base64.b64decode(task['body']))
+      view(request, *args, **kwargs)
+      num += 1
+
 class TestGrowthCalculator(unittest.TestCase):
   def test1(self):    
     # Bernadette
@@ -257,6 +301,144 @@ class TestGrowthCalculator(unittest.TestCase):
       self.assertTrue(util.isNanOrNear(testScore, zandp.percentile, eps))
     self.assertEquals(lineNum, 23)
 
+  def testBatchMatchesScalar(self):
+    cols = {'date_of_birth': [], 'date_of_visit': [], 'sex': [],
+            'weight': [], 'length': [], 'measured': [],
+            'head_circumference': [], 'hasOedema': []}
+    scalar_stats = []
+    for row in csv.DictReader(open('growthcalc/anthrotest.csv')):
+      try:
+        dateOfBirth = datetime.datetime.strptime(row['dateOfBirth'], "%m/%d/%Y")
+      except:
+        dateOfBirth = None
+      try:
+        dateOfVisit = datetime.datetime.strptime(row['dateOfVisit'], "%m/%d/%Y")
+      except:
+        dateOfVisit = None
+      oedema = (row['oedema'] == "TRUE")
+      cols['date_of_birth'].append(dateOfBirth)
+      cols['date_of_visit'].append(dateOfVisit)
+      cols['sex'].append(row['sex'])
+      cols['weight'].append(float(row['weight']))
+      cols['length'].append(float(row['lengthOrHeight']))
+      cols['measured'].append(row['measured'])
+      cols['head_circumference'].append(float(row['headCircumference']))
+      cols['hasOedema'].append(oedema)
+      scalar_stats.append(VisitStatistics.get_stats(
+        dateOfBirth, dateOfVisit, row['sex'], float(row['weight']),
+        float(row['headCircumference']), float(row['lengthOrHeight']),
+        row['measured'], oedema, None))
+
+    columns = growthcalc.growthcalc.calculate_scores_batch(cols)
+    self.assertEquals(len(scalar_stats), len(columns['weight']))
+    for idx, visit_stats in enumerate(scalar_stats):
+      # Identical, not just near: repr() also makes NaN equal to NaN
+      self.assertEquals(repr(visit_stats.body_mass_index),
+                        repr(columns['body_mass_index'][idx]))
+      self.assertEquals(visit_stats.age_in_days, columns['age_in_days'][idx])
+      for indicator in VisitStatistics.INDICATORS:
+        zandp = visit_stats.get_zandp(indicator)
+        self.assertEquals(repr(zandp.zscore),
+                          repr(columns[indicator][idx].zscore))
+        self.assertEquals(repr(zandp.percentile),
+                          repr(columns[indicator][idx].percentile))
+
+class TestReferenceTable(unittest.TestCase):
+  def test_lookup(self):
+    table = growthcalc.growthcalc.get_reference_table(
+                                                  'growthcalc/weianthro.csv')
+    # First row of weianthro.csv
+    self.assertEquals((0.3487, 3.3464, 0.14602), table.lookup(1, 0))
+    self.assertEquals(None, table.lookup(1, 1857))
+    self.assertEquals(None, table.lookup(3, 0))
+    self.assertEquals(None, table.lookup(1, util.NaN))
+
+    table = growthcalc.growthcalc.get_reference_table(
+                                                  'growthcalc/wflanthro.csv')
+    self.assertEquals((-0.3521, 2.4577, 0.09176), table.lookup(1, 45.1))
+    # Only exact grid points match
+    self.assertEquals(None, table.lookup(1, 45.15))
+    self.assertEquals(None, table.lookup(1, 44.9))
+
+  def test_lookup_interpolate(self):
+    table = growthcalc.growthcalc.get_reference_table(
+                                                  'growthcalc/wflanthro.csv')
+    # On the grid, interpolation returns the row itself
+    self.assertEquals((-0.3521, 2.4577, 0.09176), table.lookup(1, 45.1, True))
+    # Half way between the 45.1 and 45.2 rows
+    power, median, variationCoefficient = table.lookup(1, 45.15, True)
+    util.assertNear(self, -0.3521, power, 1e-9)
+    util.assertNear(self, (2.4577 + 2.4744) / 2, median, 1e-9)
+    util.assertNear(self, (0.09176 + 0.0917) / 2, variationCoefficient, 1e-9)
+    # Still nothing outside the table
+    self.assertEquals(None, table.lookup(1, 44.95, True))
+    self.assertEquals(None, table.lookup(1, 110.05, True))
+
+  def test_weight_for_length_off_grid(self):
+    # 74.05 cm is between grid points, which used to give NaN
+    visit_stats = VisitStatistics.get_stats(datetime.date(2009, 1, 1),
+                                            datetime.date(2010, 1, 1),
+                                            Sex.FEMALE,
+                                            9.0, None, 74.05,
+                                            Measured.RECUMBENT, False)
+    zandp = visit_stats.get_zandp('weight_for_length_or_height')
+    self.assertFalse(util.isNaN(zandp.zscore))
+
+  def test_load_reference_tables(self):
+    growthcalc.growthcalc.load_reference_tables()
+    for fileName in growthcalc.growthcalc.ANTHRO_FILES:
+      self.assertTrue(
+        growthcalc.growthcalc.get_reference_table(fileName).is_loaded())
+
+class TestScoreCache(unittest.TestCase):
+  PMAP = {'date_of_birth': datetime.date(2005,03,21),
+          'date_of_visit': datetime.date(2007,03,25),
+          'sex': Sex.FEMALE, 'weight': 8.2, 'length': 74.0,
+          'measured': Measured.RECUMBENT, 'hasOedema': False,
+          'head_circumference': 45.0, 'format': 'xml'}
+
+  def test_cached_scores(self):
+    cache = growthcalc.growthcalc.score_cache
+    cache.clear()
+    cache.clear_counters()
+    stats1 = growthcalc.growthcalc.calculate_scores_cached(
+                                                   TestScoreCache.PMAP)
+    stats2 = growthcalc.growthcalc.calculate_scores_cached(
+                                                   TestScoreCache.PMAP)
+    self.assertEquals(1, cache.counters()['misses'])
+    self.assertEquals(1, cache.counters()['hits'])
+    self.assertEquals(stats1.weight_for_age.zscore,
+                      stats2.weight_for_age.zscore)
+    # Hits are generated now, with their own values
+    self.assertTrue(stats2.generated_date >= stats1.generated_date)
+    self.assertFalse(stats1.weight_for_age is stats2.weight_for_age)
+
+    # Any change in the inputs is a different key
+    pmap = dict(TestScoreCache.PMAP)
+    pmap['weight'] = 8.2000001
+    growthcalc.growthcalc.calculate_scores_cached(pmap)
+    self.assertEquals(2, cache.counters()['misses'])
+
+  def test_version(self):
+    key1 = growthcalc.scorecache.ScoreCache.make_key('1', TestScoreCache.PMAP)
+    key2 = growthcalc.scorecache.ScoreCache.make_key('2', TestScoreCache.PMAP)
+    self.assertNotEquals(key1, key2)
+
+  def test_lru_and_ttl(self):
+    cache = growthcalc.scorecache.ScoreCache(max_size=4, ttl=60)
+    for num in range(4):
+      cache.set(str(num), num)
+    # Use '0' so '1' is the least recently used
+    self.assertEquals(0, cache.get('0'))
+    cache.set('4', 4)
+    self.assertEquals(None, cache.get('1'))
+    self.assertEquals(0, cache.get('0'))
+    self.assertEquals(4, cache.get('4'))
+
+    cache = growthcalc.scorecache.ScoreCache(max_size=4, ttl=-1)
+    cache.set('0', 0)
+    self.assertEquals(None, cache.get('0'))
+
 class TestUtilFunctions(unittest.TestCase):
   def test_random_string(self):
     self.assertEquals(6, len(util.random_string(6)))
@@ -394,6 +576,26 @@ class TestVisitStatistics(unittest.TestCase):
     foo = str(visit_stats)
     self.assertTrue(foo is not None)
 
+  def test_pack_unpack(self):
+    Packed = growthcalc.growthcalc.PackedVisitStatisticsProperty
+    for xml in [TestVisitStatistics.XML1, TestVisitStatistics.XML2]:
+      visit_stats = models.VisitStatistics._parse_visit_statistics(xml)
+      unpacked = Packed.unpack(Packed.pack(visit_stats))
+      self.assertEquals(visit_stats.generated_date, unpacked.generated_date)
+      self.assertEquals(visit_stats.age_in_days, unpacked.age_in_days)
+      self.assertEquals(visit_stats.body_mass_index, unpacked.body_mass_index)
+      for indicator in models.VisitStatistics.INDICATORS:
+        zandp = getattr(visit_stats, indicator)
+        if zandp:
+          self.assertEquals(repr(zandp.zscore),
+                            repr(unpacked.get_zandp(indicator).zscore))
+          self.assertEquals(repr(zandp.percentile),
+                            repr(unpacked.get_zandp(indicator).percentile))
+        else:
+          self.assertEquals(None, unpacked.get_zandp(indicator))
+      self.assertEquals(visit_stats.get_worst_zscore(),
+                        unpacked.get_worst_zscore())
+
   def test_is_alertworthy(self):
     visit_stats = models.VisitStatistics._parse_visit_statistics(
                     TestVisitStatistics.XML1)
@@ -507,6 +709,55 @@ class TestPatient(unittest.TestCase):
     self.assertTrue(len(full_url) > 0)
     self.assertTrue(full_url.find('http:') != -1)
 
+  def test_prefetch_latest_visits(self):
+    patient = TestPatientMerge.make_patient_with_visit("Prefetch")
+    visit = patient.get_latest_visit()
+    patient.set_latest_visit(visit)
+    self.assertEqual(visit.short_string, patient.latest_visit_short_string)
+
+    patients = models.Patient.prefetch_latest_visits(
+      [models.Patient.get(patient.key())])
+    self.assertEqual(1, len(patients))
+    self.assertEqual(visit.key(), patients[0]._latest_visit.key())
+
+    models.Visit.delete_visits([visit])
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
+class TestShortString(unittest.TestCase):
+  def test_get(self):
+    patient = TestPatientMerge.make_patient_with_visit("Short")
+    visit = patient.get_latest_visit()
+    found_patient, found_visit = models.Patient.get_patient_and_visit(
+      patient.short_string, visit.short_string)
+    self.assertEqual(patient.key(), found_patient.key())
+    self.assertEqual(visit.key(), found_visit.key())
+
+    # Unmapped, e.g. stored before mappings existed
+    memcache.flush_all()
+    shortstring.ShortStringMap.get_by_key_name(
+      'Patient:%s' % patient.short_string).delete()
+    self.assertEqual(patient.key(),
+                     models.Patient.get_by_short_string(
+                       patient.short_string).key())
+    self.assertTrue(shortstring.ShortStringMap.get_by_key_name(
+      'Patient:%s' % patient.short_string))
+
+    self.assertEqual(None, models.Visit.get_by_short_string('nosuch'))
+
+    # New short strings are reserved, and not taken
+    short_strings = models.Patient.allocate_short_strings(3)
+    self.assertEqual(3, len(set(short_strings)))
+    self.assertFalse(patient.short_string in short_strings)
+    for short_string in short_strings:
+      self.assertTrue(shortstring.ShortStringMap.get_by_key_name(
+        'Patient:%s' % short_string))
+      self.assertEqual(None, models.Patient.get_by_short_string(short_string))
+
+    models.Visit.delete_visits([visit])
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
 class TestVisit(unittest.TestCase):
   def test1(self):
     patient = TestPatient.make_patient()
@@ -558,6 +809,12 @@ class TestVisit(unittest.TestCase):
     # test line is unterminated
     self.assertFalse(export_line[-1] in ["\r", "\n"])
 
+    # export_csv_values() are the values of export_csv_line()
+    export_values = visit.export_csv_values(patient)
+    self.assertEqual(len(models.Visit.export_csv_header_names()),
+                     len(export_values))
+    self.assertEqual(export_line, util.csv_row_line(export_values))
+
 class TestCsvExport(unittest.TestCase):
   def test1(self):
     names = util.printable_properties(models.Patient).keys()
@@ -569,7 +826,11 @@ class TestCsvExport(unittest.TestCase):
     names = util.printable_properties(models.Visit).keys()
     self.assertTrue('created_date' in names)
     self.assertTrue('short_string' in names)
-    self.assertEqual(len(names), 11)
+    self.assertTrue('residence_key' in names)
+    self.assertEqual(len(names), 13)
+    # Not exported, they are the same as the patient's
+    self.assertFalse('residence_key' in models.Visit._visit_prop_names)
+    self.assertEqual(len(models.Visit._visit_prop_names), 11)
     #logging.info(names)
 
   def test_visit_export_header(self):
@@ -591,6 +852,21 @@ class TestCounter(unittest.TestCase):
     counter.set_value(name, 2)
     assert counter.get_count(name) == 2
 
+  def test_cached(self):
+    name = "bar"
+    counter.set_value(name, 5)
+    counter.increment(name, -2)
+    assert counter.get_count(name) == 3
+
+    # Read from the shards when the count is not cached
+    memcache.delete(counter.MEMCACHE_PREFIX + name)
+    counter.increase_shards(name, 3)
+    for dummy in range(10):
+      counter.increment(name)
+    assert counter.get_count(name) == 13
+    memcache.delete(counter.MEMCACHE_PREFIX + name)
+    assert counter.get_count(name) == 13
+
 class TestPatientMerge(unittest.TestCase):
   @staticmethod
   def make_patient_with_visit(patientName):
@@ -665,6 +941,398 @@ class TestVisitDelete(unittest.TestCase):
     patient.delete()  
     models.Patient.set_count(models.Patient.get_count() - 1)
       
+class TestRecalcVisitStats(unittest.TestCase):
+  def test_recalc_packed(self):
+    from management.commands import recalc_visit_stats
+    patient = TestPatientMerge.make_patient_with_visit("Recalc")
+    visit = patient.get_visits()[0]
+    stats = visit.get_visit_statistics()
+    visit.packed_statistics = stats
+    visit.put()
+
+    # Packed statistics stay packed, since they are what is read
+    visit.weight = 9.0
+    recalc_visit_stats.recalc_visits([visit])
+    visit = models.Visit.get(visit.key())
+    self.assertEqual(None,
+                     models.Visit.visit_statistics.get_value_for_datastore(
+                       visit))
+    self.assertEqual(9.0, visit.get_visit_statistics().weight)
+
+    models.Visit.delete_visits([visit])
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
+class TestRollup(unittest.TestCase):
+  def test_add_move_remove(self):
+    patient = TestPatientMerge.make_patient_with_visit("Rollup")
+    visit = patient.get_visits()[0]
+    visit.organization = "maventy"
+    # underweight, not stunted
+    visit.weight = 5.0
+    visit.height = 78.0
+    visit.put()
+    date_from = datetime.date(2010, 12, 1)
+    date_to = datetime.date(2011, 1, 31)
+
+    rollup.add_visits([visit], patient)
+    # adding again replaces the visit
+    rollup.add_visits([visit], patient)
+    totals = rollup.get_totals("maventy", date_from, date_to, residence="TEST")
+    self.assertEqual(1, totals['visits'])
+    self.assertEqual(1, totals['patients'])
+    self.assertEqual(1, totals['underweight'])
+    self.assertEqual(0, totals['stunted'])
+
+    old_buckets = rollup.bucket_names([visit], patient)
+    patient.residence = "elsewhere"
+    patient.put()
+    rollup.move_visits(old_buckets, [visit], patient)
+    totals = rollup.get_totals("maventy", date_from, date_to, residence="test")
+    self.assertEqual(0, totals['visits'])
+    totals = rollup.get_totals("maventy", date_from, date_to,
+                               residence="Elsewhere")
+    self.assertEqual(1, totals['visits'])
+
+    rollup.remove_visits([visit], patient)
+    totals = rollup.get_totals("maventy", date_from, date_to)
+    self.assertEqual(0, totals['patients'])
+
+    models.Visit.delete_visits([visit])
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
+  def test_totals_match_visits(self):
+    patient = TestPatientMerge.make_patient_with_visit("Rollup report")
+    patient.residence = "rollupreport"
+    patient.put()
+    visits = patient.get_visits()
+    # (visit date, weight, height): underweight in the range, then normal
+    # on the same day (the greater key is latest) and later in the range,
+    # then underweight after the range
+    for visit_date, weight, height in [
+        (datetime.date(2011, 1, 1), 5.0, 78.0),
+        (datetime.date(2011, 1, 1), 10.0, 78.0),
+        (datetime.date(2011, 1, 20), 10.0, 78.0),
+        (datetime.date(2011, 3, 1), 5.0, 78.0)]:
+      visit = models.Visit(parent=patient, evaluator_name="test",
+                           visit_date=visit_date, weight=weight,
+                           height=height)
+      visit.put_visit()
+      visits.append(visit)
+    for visit in visits:
+      visit.organization = "maventy"
+      visit.set_patient_fields(patient)
+      visit.put()
+    rollup.add_visits(visits, patient)
+
+    date_from = datetime.date(2010, 12, 1)
+    date_to = datetime.date(2011, 1, 31)
+    totals = rollup.get_totals("maventy", date_from, date_to,
+                               residence="rollupreport")
+    report = reports.PatientReport("maventy", date_from, date_to, "",
+                                   "rollupreport")
+    line = report._get_undernutrition_data_from_visits(
+      rollup.ZSCORE_CUTOFF)[0]
+    self.assertEqual(4, totals['visits'])
+    self.assertEqual(totals['visits'], line.visitcount)
+    self.assertEqual(1, totals['patients'])
+    self.assertEqual(totals['patients'], line.patientcount)
+    self.assertEqual(totals['stunted'], line.stunted)
+    self.assertEqual(totals['underweight'], line.underweight)
+    self.assertEqual(totals['wasting'], line.wasting)
+
+    rollup.remove_visits(visits, patient)
+    models.Visit.delete_visits(visits)
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
+class TestReportFilter(unittest.TestCase):
+  def test_patient_fields_not_set(self):
+    patient = TestPatientMerge.make_patient_with_visit("Report filter")
+    patient.residence = "reportfilter"
+    patient.put()
+    visit = patient.get_visits()[0]
+    visit.organization = "maventy"
+    # As stored before the patient fields were copied to visits
+    visit.residence_key = None
+    visit.country = None
+    visit.put()
+    date_from = datetime.date(2010, 12, 1)
+    date_to = datetime.date(2011, 1, 31)
+
+    def count_visits():
+      report = reports.PatientReport("maventy", date_from, date_to, "",
+                                     "reportfilter")
+      return report.get_screening_data()[0].visitcount
+
+    # Until setvisitpatientfields has run, the patients are checked
+    self.assertEqual(1, count_visits())
+    # Then the query filters by the visits' copies
+    models.VisitPatientFieldsSet.mark("maventy")
+    self.assertEqual(0, count_visits())
+
+    models.VisitPatientFieldsSet.get_by_key_name("maventy").delete()
+    models.Visit.delete_visits([visit])
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
+class TestDbCache(unittest.TestCase):
+  def setUp(self):
+    db_cache.patch_db_get()
+    db_cache.start_request()
+
+  def tearDown(self):
+    db_cache.end_request()
+
+  def test_identity_map(self):
+    patient = TestPatientMerge.make_patient_with_visit("Cached")
+    visit = patient.get_latest_visit()
+    stats = db_cache.get_stats()
+    # Both were stored by put
+    self.assertTrue(models.Patient.get(patient.key()) is patient)
+    found = db.get([visit.key(), patient.key()])
+    self.assertTrue(found[0] is visit)
+    self.assertTrue(found[1] is patient)
+    self.assertEqual(stats['hits'] + 3, db_cache.get_stats()['hits'])
+    self.assertEqual(stats['misses'], db_cache.get_stats()['misses'])
+
+    # Only the miss is fetched
+    found = db.get([patient.key(), db.Key.from_path('Patient', 'nosuch')])
+    self.assertTrue(found[0] is patient)
+    self.assertEqual(None, found[1])
+    self.assertEqual(stats['misses'] + 1, db_cache.get_stats()['misses'])
+
+    models.Visit.delete_visits([visit])
+    self.assertEqual(None, models.Visit.get(visit.key()))
+    patient.delete()
+    self.assertEqual(None, models.Patient.get(patient.key()))
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
+    # Nothing is kept past the request
+    db_cache.end_request()
+    self.assertEqual(0, db_cache.get_cache_size())
+
+class TestDbLog(unittest.TestCase):
+  def test_request_profile(self):
+    profile = db_log.RequestProfile('/test')
+    for ms in [5, 50, 5000]:
+      profile.add('Get', 'Patient', 'Get Patient', ms)
+    profile.add('RunQuery', 'Visit', 'RunQuery Visit ancestor', 20)
+
+    stats = profile.calls[('Get', 'Patient')]
+    self.assertEqual(3, stats.count)
+    self.assertEqual(5000, stats.max_ms)
+    self.assertEqual([1, 0, 1, 0, 0, 0, 1], stats.histogram)
+    self.assertEqual([('Get Patient', 3)], profile.repeated(2))
+    self.assertEqual([], profile.repeated(3))
+
+    stats.merge(profile.calls[('RunQuery', 'Visit')])
+    self.assertEqual(4, stats.count)
+    self.assertEqual(5075, stats.total_ms)
+    self.assertEqual([1, 1, 1, 0, 0, 0, 1], stats.histogram)
+
+class TestProfiler(unittest.TestCase):
+  def test_add_sample(self):
+    import cProfile
+    import pstats
+    for dummy in range(2):
+      prof = cProfile.Profile()
+      prof.runcall(util.random_string, 6)
+      profiler.add_sample('test.view', pstats.Stats(prof))
+    self.assertEqual(2, profiler.ProfileSample.all().count())
+
+    profiler.merge_samples()
+    self.assertEqual(0, profiler.ProfileSample.all().count())
+    report = profiler.ProfileReport.get_by_key_name('test.view')
+    self.assertEqual(2, report.num_requests)
+    self.assertTrue(profiler.get_combined_data(['test.view']))
+    self.assertTrue('random_string' in
+                    profiler.get_combined_text(['test.view']))
+    self.assertEqual(None, profiler.get_combined_data(['no.such.view']))
+
+    profiler.delete_reports()
+    self.assertEqual(None, profiler.ProfileReport.get_by_key_name('test.view'))
+
+class TestMapper(unittest.TestCase):
+  class CountMapper(mapper.Mapper):
+    model_class = models.Patient
+    keys_only = True
+    batch_size = 2
+
+    def __init__(self):
+      mapper.Mapper.__init__(self)
+      self.keys = []
+
+    def map_batch(self, keys, pool):
+      self.keys.extend(keys)
+
+  def test_map_ranges(self):
+    patients = [TestPatientMerge.make_patient_with_visit("Mapped")
+                for dummy in range(5)]
+    the_mapper = TestMapper.CountMapper()
+    all_keys = models.Patient.all(keys_only=True).order('__key__').fetch(1000)
+
+    ranges = mapper.split_key_ranges(the_mapper.query(keys_only=True), 2)
+    self.assertEqual((len(all_keys) + 1) / 2, len(ranges))
+    for start, end in ranges:
+      mapper.map_range(the_mapper, start, end)
+    self.assertEqual(all_keys, the_mapper.keys)
+
+    # Stopping after a batch, and resuming from the cursor
+    the_mapper.keys = []
+    num, cursor = mapper.map_range(the_mapper, None, None, max_batches=1)
+    self.assertEqual(2, num)
+    num, cursor = mapper.map_range(the_mapper, None, None, cursor)
+    self.assertEqual(None, cursor)
+    self.assertEqual(all_keys, the_mapper.keys)
+
+    for patient in patients:
+      models.Visit.delete_visits(patient.get_visits())
+      patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - len(patients))
+
+class TestExport(unittest.TestCase):
+  def test_export_task(self):
+    # The task's URL reaches its view, not an org's export page
+    self.assertEqual(views.export_visits_task,
+                     resolve(reverse('healthdb.views.export_visits_task'))[0])
+
+    patient = TestPatientMerge.make_patient_with_visit("Exported")
+    visit = patient.get_visits()[0]
+    visit.organization = "maventy"
+    visit.put()
+    the_export = export.start_export("maventy")
+    self.assertTrue(run_tasks('healthdb.views.export_visits_task') >= 1)
+    the_export = export.VisitExport.get(the_export.key())
+    self.assertTrue(the_export.done)
+    self.assertTrue(the_export.num_visits >= 1)
+    self.assertTrue(patient.short_string in
+                    ''.join(the_export.get_shard_data()))
+
+    db.delete(export.VisitExportShard.all(keys_only=True).ancestor(
+      the_export).fetch(1000))
+    the_export.delete()
+    models.Visit.delete_visits(patient.get_visits())
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
+class TestMailer(unittest.TestCase):
+  def test_digest(self):
+    addresses = ['Digest Test <digest-test@example.com>']
+    recipients_key = mailer._recipients_key(addresses)
+    for num in range(mailer.DIGEST_THRESHOLD + 2):
+      mailer.send_notification('Note %d' % num, 'Body %d' % num, addresses)
+    # The first ones are sent one by one, the rest held for the digest
+    self.assertEqual(mailer.DIGEST_THRESHOLD,
+                     run_tasks('mailer.send_mail_task', mailer.MAIL_QUEUE))
+    pending = mailer.PendingNotification.all().ancestor(
+      mailer._pending_parent(recipients_key))
+    self.assertEqual(2, pending.count())
+    self.assertEqual(addresses, pending.get().to)
+
+    self.assertEqual(1, run_tasks('mailer.send_digest_task',
+                                  mailer.MAIL_QUEUE))
+    self.assertEqual(0, pending.count())
+
+class TestSearchIndex(unittest.TestCase):
+  def test_capped_startswith(self):
+    indexer = capped_startswith(2, 4)
+    self.assertEqual(['jo', 'joh', 'john', 'johnathan', 'j', 'li'],
+                     indexer(['johnathan', 'j', 'li'], indexing=True))
+    # Long terms are searched by their prefix
+    self.assertEqual(['john', 'j'],
+                     indexer(['johnny', 'j'], indexing=False))
+
+  def test_patient_search(self):
+    patient = TestPatientMerge.make_patient_with_visit("Rasoanirina Voahangy")
+    self.assertTrue('rasoanirina' in patient.name_index)
+    self.assertFalse('r' in patient.name_index)
+    self.assertEqual(['2009', '2009-1', '2009-11', '2009-11-1', '2009-11-14'],
+                     patient.birth_date_index)
+
+    for name in ('rasoan', 'Rasoanirina voah'):
+      keys = models.Patient.name_index.search(name, keys_only=True).fetch(10)
+      self.assertTrue(patient.key() in keys)
+      self.assertTrue(models.Patient.name_index.matches(patient, name))
+    # Found by the prefix 'rasoanir', but not a match
+    self.assertFalse(models.Patient.name_index.matches(patient,
+                                                       'Rasoanirinab voah'))
+    keys = models.Patient.birth_date_index.search('2009-11',
+                                                  keys_only=True).fetch(10)
+    self.assertTrue(patient.key() in keys)
+
+    models.Visit.delete_visits(patient.get_visits())
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
+  def test_update_index_values(self):
+    patient = TestPatientMerge.make_patient_with_visit("Update Index")
+    self.assertEqual(search_util.INDEX_VERSION, patient.search_index_version)
+    self.assertFalse(update_index_values(patient))
+
+    # As if built by an older indexer
+    patient.name_index = patient.name_index + ['u']
+    self.assertTrue(update_index_values(patient))
+    self.assertFalse('u' in patient.name_index)
+
+    models.Visit.delete_visits(patient.get_visits())
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 1)
+
+class TestSearchSnapshot(unittest.TestCase):
+  def test_search(self):
+    snapshot = search_snapshot.Snapshot()
+    snapshot.put(1, (u'aaaaaa', u'Rasoanirina Voahangy', u'2009-11-14',
+                     u'Anivorano', u'Hery', u'Madagascar'))
+    snapshot.put(2, (u'bbbbbb', u'Rasoa Nirina', u'2010-01-02',
+                     u'Andranonakoho', u'', u'Madagascar'))
+    names = lambda records: [record[1] for record in records]
+    self.assertEqual([u'Rasoa Nirina', u'Rasoanirina Voahangy'],
+                     names(snapshot.search('raso')))
+    # Past the longest indexed prefix, the whole word is checked
+    self.assertEqual([u'Rasoanirina Voahangy'],
+                     names(snapshot.search('rasoanirina')))
+    self.assertEqual([], snapshot.search('rasoanirinab'))
+    self.assertEqual([u'Rasoa Nirina'], names(snapshot.search('nir raso')))
+    self.assertEqual([u'Rasoanirina Voahangy'],
+                     names(snapshot.search('2009-11')))
+    self.assertEqual([], snapshot.search('raso', country='India'))
+
+    snapshot.put(1, None)
+    self.assertEqual([u'Rasoa Nirina'], names(snapshot.search('raso')))
+    self.assertFalse('voahangy' in snapshot.terms)
+    self.assertEqual(snapshot.terms,
+                     search_snapshot.Snapshot.loads(snapshot.dumps()).terms)
+
+  def test_changes(self):
+    memcache.flush_all()
+    search_snapshot._snapshots.clear()
+    patient = TestPatientMerge.make_patient_with_visit("Snapshotted")
+    # With no snapshot yet, the search index answers and a build is queued
+    self.assertEqual(1, len(search_snapshot.search('maventy', 'snapshot')))
+    self.assertEqual(None, search_snapshot.get_snapshot('maventy'))
+    self.assertTrue(memcache.get(search_snapshot._lock_key('maventy')))
+    search_snapshot.run_build_task('maventy')
+    self.assertEqual(1, len(search_snapshot.search('maventy', 'snapshot')))
+
+    # Saves and deletes are applied from the change log
+    other = TestPatientMerge.make_patient_with_visit("Snapshotted Too")
+    self.assertEqual(2, len(search_snapshot.search('maventy', 'snapshot')))
+    models.Visit.delete_visits(other.get_visits())
+    other.delete()
+    self.assertEqual(1, len(search_snapshot.search('maventy', 'snapshot')))
+
+    # Loaded from memcache by another process
+    search_snapshot._snapshots.clear()
+    results = search_snapshot.search('maventy', 'snapshotted')
+    self.assertEqual([patient.short_string],
+                     [result['short_string'] for result in results])
+
+    models.Visit.delete_visits(patient.get_visits())
+    patient.delete()
+    models.Patient.set_count(models.Patient.get_count() - 2)
+
 class TestStringEqNoCase(unittest.TestCase):
   def test_function(self):
     self.assertFalse(util.string_eq_nocase('Anivorano', None))
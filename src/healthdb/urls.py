@@ -8,12 +8,28 @@ urlpatterns = patterns(
 
     (r'^$', 'index'),
 
+    # App Engine 'warmup' inbound service, see app.yaml
+    (r'^_ah/warmup$', 'warmup'),
+
     (r'^database$', 'database_index'),
 
     (r'^contact$', 'contact'),
     
     (r'^dev/run-tasks$', 'dev_run_tasks'),
 
+    # Task queue handlers, admin only in app.yaml.  Before the
+    # (?P<orgStr>...) patterns, which would match e.g. tasks/export-visits.
+    (r'^tasks/export-visits$', 'export_visits_task'),
+    (r'^tasks/mapper/start$', 'mapper_start'),
+    (r'^tasks/mapper/split$', 'mapper_split_task'),
+    (r'^tasks/mapper$', 'mapper_task'),
+    (r'^tasks/search-snapshot$', 'search_snapshot_task'),
+
+    # Admin only in app.yaml
+    (r'^profile/datastore$', 'datastore_profile'),
+    (r'^profile/requests$', 'request_profiles'),
+    (r'^profile/requests/download$', 'request_profile_download'),
+
 # TODO(dan): live-search works, autocomplete doesn't
 #     (r'^patients/live-search$', 'live_search'),
 
@@ -37,6 +53,9 @@ urlpatterns = patterns(
     (r'^(?P<orgStr>[a-z_0-9]+)/patients/search$',
        'patients_search'),
 
+    (r'^(?P<orgStr>[a-z_0-9]+)/patients/typeahead$',
+       'patients_typeahead'),
+
     (r'^(?P<orgStr>[a-z_0-9]+)/patients/(?P<patientStr>[a-zA-Z0-9]{6,})$',
        'patient_view'),
 
@@ -52,8 +71,10 @@ urlpatterns = patterns(
     (r'^(?P<orgStr>[a-z_0-9]+)/patients/(?P<patientStr>[a-zA-Z0-9]+)/visit/(?P<visitStr>[a-zA-Z0-9]+)/edit$',
       'visit_edit'),
 
-# TODO(dan): Redo for per-organization download, or ditch
-#    (r'^download-visits$', 'download_visits_csv'),
+    (r'^(?P<orgStr>[a-z_0-9]+)/export-visits$', 'export_visits'),
+
+    (r'^(?P<orgStr>[a-z_0-9]+)/export-visits/(?P<exportId>[0-9]+)/visits.csv$',
+      'export_visits_download'),
 
 # NOTE(dan): No country selector anymore
     (r'^(?P<orgStr>[a-z_0-9]+)/select-country', 'select_country'),
@@ -76,13 +76,11 @@ def _csv_string(a_val):
     a_val = a_val.encode('utf-8')
   return a_val
 
-def csv_line(prop_names, props, model_class):
-  '''Return a CSV line with the properties of the given model_class.
-
-  A CSV line comes from a csv.writer.  \r and \n are quoted, but line
-  unterminated.
+def csv_values(prop_names, props, model_class):
+  '''Return the values of csv_line, encoded for a csv.writer.
 
-  Print any property returned from prop_names.
+  Write them with a csv.writer of your own to write many rows without
+  building a string for each.
   '''
   vals = []
   for name in prop_names:
@@ -98,15 +96,31 @@ def csv_line(prop_names, props, model_class):
 #      val = "?"
     else:
       vals.append(val)
+  return map(_csv_string, vals)
+
+def csv_row_line(vals):
+  '''Return a CSV line with the given values, as from csv_values().
 
+  \r and \n are quoted, but line unterminated.
+  '''
   string_writer = StringWriter()
   # leave lineterminator \r\n so that those chars will be quoted
   cwriter = csv.writer(string_writer)
-  cwriter.writerow(map(_csv_string, vals))
+  cwriter.writerow(vals)
   the_str = string_writer.get_str()
   # remove final \r\n
   return the_str[0:(len(the_str)-2)]
 
+def csv_line(prop_names, props, model_class):
+  '''Return a CSV line with the properties of the given model_class.
+
+  A CSV line comes from a csv.writer.  \r and \n are quoted, but line
+  unterminated.
+
+  Print any property returned from prop_names.
+  '''
+  return csv_row_line(csv_values(prop_names, props, model_class))
+
 
 def random_string(len):
   """Generate a user-friendly random string of the given length."""
@@ -2,6 +2,7 @@
 
 # Python imports
 import logging
+from functools import wraps
 
 # AppEngine imports
 from google.appengine.runtime import DeadlineExceededError
@@ -11,16 +12,25 @@ from google.appengine.runtime.apiproxy_errors import CapabilityDisabledError
 # Django imports
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.contrib.auth.decorators import login_required
+from django.core.urlresolvers import reverse
 
 # GAE patch imports
-from ragendja.template import render_to_response
+from ragendja.template import render_to_response, JSONResponse
 from appenginepatcher import on_production_server
 
 # Local imports
 import models
 import reports
+import rollup
+import export
+import shortstring
 from forms import PatientForm, VisitForm, ContactForm, PatientSearchForm, ConfirmationForm, CalculatorForm, ReportsForm
 import mailer
+import growthcalc.growthcalc
+import db_log
+import profiler
+import mapper
+import search_snapshot
 
 from search.views import show_search_results_from_results, query_param_search
 
@@ -34,6 +44,7 @@ def org_required(func):
   def view_func(request):
     ...
   '''
+  @wraps(func)
   def wrap(request, orgStr, *args, **kwargs):
 #    logging.info("In org_required wrap, orgStr '%s' isNone %s user.orgStr %s"
 #                 % (orgStr, orgStr is None, request.user.organization))
@@ -84,6 +95,14 @@ def respond(request, template, params=None):
 def index(request):
   return respond(request, 'index.html', {})
 
+def warmup(request):
+  '''Handler for App Engine's warmup requests (/_ah/warmup).
+
+  Loads the WHO reference tables before the instance takes user requests.
+  '''
+  growthcalc.growthcalc.load_reference_tables()
+  return HttpResponse('')
+
 @login_required
 def database_index(request):
   orgStr = request.user.organization
@@ -104,13 +123,13 @@ def _store_new_patient(patientForm, orgStr, request_user):
   patient = None
   # store the patient
   try:
-    # TODO(dan): Should assign_short_string .. put() in a transaction.
     patient = patientForm.save(commit=False)
     # if request_user is not anonymous, save it in created_by_user
     if request_user.username: patient.created_by_user = request_user
     patient.assign_short_string()
     patient.organization = orgStr
     patient.put()
+    shortstring.register([patient])
     models.Patient.increment_count()
   except ValueError, err:
     logging.error("_store_new_patient error: " + unicode(err))
@@ -158,6 +177,11 @@ def patient_edit(request, orgStr, patientStr):
     patientForm = PatientForm(instance=patient)
     return render_this(patient, patientForm)
 
+  # The patient's country and residence are also on their visits, and place
+  # them in the rollup
+  visits = patient.get_visits()
+  old_buckets = rollup.bucket_names(visits, patient)
+
   patientForm = PatientForm(request.POST, instance=patient)
   if not patientForm.is_valid():
     # logging.info('patient_edit: %s' % patientForm.errors)
@@ -172,6 +196,11 @@ def patient_edit(request, orgStr, patientStr):
     patientForm.errors['__all__'] = unicode(err)
     return render_this(patient, patientForm)
   patient.put()
+  changed_visits = [visit for visit in visits
+                    if visit.set_patient_fields(patient)]
+  if changed_visits:
+    models.db.put(changed_visits)
+  rollup.move_visits(old_buckets, visits, patient)
 
   return HttpResponseRedirect(patient.get_view_url())
 
@@ -213,6 +242,7 @@ def patient_delete(request, orgStr, patientStr):
   # Email us the patient and visits to be deleted
   mailer.email_patient_with_visit_deleted(patient, visits)    
 
+  rollup.remove_visits(visits, patient)
   models.Visit.delete_visits(visits)
         
   patient.delete()
@@ -259,12 +289,19 @@ def patient_merge(request, orgStr):
       # then call a transaction to do all the datastore work
       assert patient_to_keep
       
+      # the merged patients' visits leave the rollup, as copies under
+      # patient_to_keep they come back
+      for patient in patients:
+        if patient.key() != patient_to_keep.key():
+          rollup.remove_visits(patient.get_visits(), patient)
+
       # get visits to attach to the patient
       mergevisits = models.Patient.get_visits_to_merge(patient_to_keep, patients)
       
       # run the visit merge in a transaction
       models.db.run_in_transaction(models.Patient.merge_visits, patient_to_keep, mergevisits)
       patient_to_keep.set_latest_visit(patient_to_keep.get_latest_visit())
+      rollup.add_visits(patient_to_keep.get_visits(), patient_to_keep)
       
       # run the delete in a transaction --> not allowed
       # if this delete fails, we'll have an extra patient and extra visits
@@ -295,9 +332,12 @@ def _store_new_visit(patient, visitForm, request_user):
     visit.organization = request_user.organization
     # if request_user is not anonymous, save in created_by_user
     if request_user.username: visit.created_by_user = request_user
+    visit.set_patient_fields(patient)
     visit.put()
+    shortstring.register([visit])
     patient.set_latest_visit(latest_visit = visit)
     models.Visit.increment_count()
+    rollup.add_visits([visit], patient)
   except ValueError, err:
     logging.error("_store_visit error: " + unicode(err))
     visitForm.errors['__all__'] = unicode(err)
@@ -364,9 +404,8 @@ def visit_new(request, orgStr, patientStr):
 def visit_edit(request, orgStr, patientStr, visitStr):
   """Edit an existing visit"""
   # need at least one "extra" option form, or the javascript breaks
-  patient = models.Patient.get_by_short_string(patientStr)
+  patient, visit = models.Patient.get_patient_and_visit(patientStr, visitStr)
   if not patient: raise Http404
-  visit = patient.get_visit_by_short_string(visitStr)
   if not visit: raise Http404
 
   # NOTE(dan): patient and orgStr don't change, so they need not be params
@@ -378,6 +417,7 @@ def visit_edit(request, orgStr, patientStr, visitStr):
     visitForm = VisitForm(instance=visit)
     return render_this(visit, visitForm)
 
+  old_buckets = rollup.bucket_names([visit], patient)
   visitForm = VisitForm(request.POST, instance=visit)
 
   if not visitForm.is_valid():
@@ -394,19 +434,19 @@ def visit_edit(request, orgStr, patientStr, visitStr):
     visitForm.errors['__all__'] = unicode(err)
     return render_this(visit, visitForm)
   # Clear cached visit stats
-  visit.visit_statistics = None
+  visit.clear_visit_statistics()
   visit.put()
+  rollup.move_visits(old_buckets, [visit], patient)
 
   return HttpResponseRedirect(visit.get_view_url())
 
 @login_required
 @org_required
 def visit_view(request, orgStr, patientStr, visitStr):    
-  patient = models.Patient.get_by_short_string(patientStr)
+  patient, visit = models.Patient.get_patient_and_visit(patientStr, visitStr)
   if not patient:
     logging.warning("visit_view: patient %s not found" % patientStr)
     raise Http404
-  visit = patient.get_visit_by_short_string(visitStr)
   if not visit:
     logging.warning("visit_view: patient %s visit %s not found" %
                     (patientStr, visitStr))
@@ -425,12 +465,13 @@ def visit_delete(request, orgStr, patientStr, visitStr):
     # User is not logged in, don't allow them to go on with the delete
     return database_index(request)
    
-  patient = models.Patient.get_by_short_string(patientStr)
+  patient, visit = models.Patient.get_patient_and_visit(patientStr, visitStr)
   if not patient:
     logging.warning("visit_delete: patient %s not found" % patientStr)
     raise Http404
 
-  visit = patient.get_visits_by_short_string(visitStr)
+  # A list, as delete_visits() takes
+  visit = visit and [visit] or []
   if not visit:
     logging.warning("visit_delete: patient %s visit %s not found" %
                     (patientStr, visitStr))
@@ -439,6 +480,7 @@ def visit_delete(request, orgStr, patientStr, visitStr):
   # Email us the patient and visits to be deleted
   mailer.email_visit_deleted(patient, visit)    
   
+  rollup.remove_visits(visit, patient)
   models.Visit.delete_visits(visit)
     
   patient.set_latest_visit(patient.get_latest_visit())
@@ -542,6 +584,7 @@ def patients_search(request, orgStr):
   form = PatientSearchForm(request.GET)
 
   filters = ()
+  query = name = birth_date = None
   if form.is_valid():
     # Show no results if search returns no results
     key_based_on_empty_query = False
@@ -598,11 +641,25 @@ def patients_search(request, orgStr):
 
 #  logging.info("key_based_on_empty_query: %s" % key_based_on_empty_query)
 #  logging.info("results before show: %s" % results)
+  def converter(patients):
+    # The indexes find words longer than their longest prefix by that
+    # prefix, so check the whole words
+    patients = [patient for patient in patients
+                if (not query
+                    or models.Patient.search_index.matches(patient, query))
+                and (not name
+                     or models.Patient.name_index.matches(patient, name))
+                and (not birth_date
+                     or models.Patient.birth_date_index.matches(patient,
+                                                                birth_date))]
+    return models.Patient.prefetch_latest_visits(patients)
+
   return show_search_results_from_results(results,
         request, models.Patient,
         'search_index', filters = filters,
         key_based_on_empty_query = key_based_on_empty_query,
         key_based_order = ('-latest_visit_date', '-latest_visit_short_string'),
+        converter = converter,
         search_form_class = PatientSearchForm,
         extra_context = {'orgStr' : orgStr})
 
@@ -627,6 +684,30 @@ def dev_run_tasks(request):
   import admin
   return admin.run_tasks(request)
 
+# Most results a typeahead query returns
+TYPEAHEAD_LIMIT = 20
+
+@login_required
+@org_required
+def patients_typeahead(request, orgStr):
+  '''JSON list of the patients matching the 'query' parameter, from the
+  organization's search snapshot (see search_snapshot.py).
+
+  Each is a dict of search_snapshot.RECORD_FIELDS, and 'url'.  At most the
+  'limit' parameter (default 10, at most TYPEAHEAD_LIMIT) are returned.'''
+  try:
+    limit = min(int(request.GET.get('limit', 10)), TYPEAHEAD_LIMIT)
+  except ValueError:
+    limit = 10
+  results = search_snapshot.search(
+    orgStr, request.GET.get('query', ''), limit,
+    getattr(request.user, 'default_country', ''))
+  for result in results:
+    result['url'] = reverse('healthdb.views.patient_view',
+                            kwargs={'orgStr': orgStr,
+                                    'patientStr': result['short_string']})
+  return JSONResponse(results)
+
 @login_required
 @org_required
 def select_country(request, orgStr):
@@ -639,24 +720,113 @@ def select_country(request, orgStr):
 
   return HttpResponseRedirect(request.GET.get('next', '/'))
 
-# TODO(dan): Do per-org, or ditch this
-#@login_required
-#@org_required
-#def download_visits_csv(request):
-#  # NOTE: This will not scale to too many visits because
-#  # of the 30 second page limit.
-#
-#  # Read visits and patients in bulk
-#  logging.info("load visits")
-#  patient_cache, visits = models.Visit.get_all_visits(org)
-#
-#  # Print
-#  doc = models.Visit.export_csv_header() + "\n"
-#  for visit in visits:
-#    doc += visit.export_csv_line(patient_cache.get_patient(visit.parent_key())) + "\n"
-#  response = HttpResponse(doc, mimetype='text/csv')
-#  response['Content-Disposition'] = 'attachment; filename=visits.csv'
-#  return response
+@login_required
+@org_required
+def export_visits(request, orgStr):
+  """List the org's visit exports, or (POST) start a new one."""
+  org = request.user.organization
+  if request.method == 'POST':
+    export.start_export(org)
+    return HttpResponseRedirect(request.path)
+
+  return respond(request, 'export_visits.html',
+                 {'orgStr': orgStr,
+                  'exports': export.VisitExport.get_for_org(org).fetch(20)})
+
+@login_required
+@org_required
+def export_visits_download(request, orgStr, exportId):
+  """Download a finished visit export as a CSV file."""
+  the_export = export.VisitExport.get_by_id(int(exportId))
+  if (not the_export or not the_export.done
+      or the_export.organization != request.user.organization):
+    raise Http404
+
+  response = HttpResponse(mimetype='text/csv')
+  response['Content-Disposition'] = 'attachment; filename=visits.csv'
+  for data in the_export.get_shard_data():
+    response.write(data)
+  return response
+
+def export_visits_task(request):
+  """Task queue handler writing the next shard of a visit export."""
+  export.run_export_task(request.POST['export'], int(request.POST['shard']))
+  return HttpResponse('')
+
+def mapper_start(request):
+  """Start a mapper (see mapper.py) as tasks.
+
+  'mapper' names the Mapper subclass, e.g.
+  healthdb.management.commands.visitcalc.VisitCalcMapper.  The other
+  parameters are passed to it."""
+  params = {}
+  for key in request.REQUEST.keys():
+    if key != 'mapper':
+      params[key] = request.REQUEST[key]
+  try:
+    the_mapper = mapper.get_mapper(request.REQUEST.get('mapper', ''), params)
+  except (ImportError, AttributeError, ValueError), err:
+    return HttpResponse(str(err), mimetype='text/plain', status=400)
+  mapper.start_tasks(the_mapper)
+  return HttpResponse('Started %s' % the_mapper.get_name(),
+                      mimetype='text/plain')
+
+def mapper_split_task(request):
+  """Task queue handler splitting a mapper's entities into ranges."""
+  mapper.run_split_task(request.POST['mapper'], request.POST['params'])
+  return HttpResponse('')
+
+def mapper_task(request):
+  """Task queue handler mapping part of a key range."""
+  mapper.run_range_task(request.POST['mapper'], request.POST['params'],
+                        request.POST['start'], request.POST['end'],
+                        request.POST['cursor'])
+  return HttpResponse('')
+
+def search_snapshot_task(request):
+  """Task queue handler building an organization's search snapshot."""
+  search_snapshot.run_build_task(request.POST['org'])
+  return HttpResponse('')
+
+def datastore_profile(request):
+  """Datastore calls of recently profiled requests, see db_log.py."""
+  stats = db_log.get_recent_stats()
+  return respond(request, 'datastore_profile.html',
+                 {'requests': stats['requests'],
+                  'calls': stats['calls'],
+                  'repeated': stats['repeated'],
+                  'histogram_labels': db_log.histogram_labels(),
+                  'minutes': db_log.WINDOW_SECONDS * db_log.NUM_WINDOWS / 60})
+
+def request_profiles(request):
+  """Stored profiles of sampled requests, see profiler.py.  POST deletes them."""
+  if request.method == 'POST':
+    profiler.delete_reports()
+    return HttpResponseRedirect(request.path)
+
+  profiler.merge_samples()
+  return respond(request, 'request_profiles.html',
+                 {'reports': profiler.ProfileReport.all().order(
+                    '-total_seconds').fetch(100)})
+
+def request_profile_download(request):
+  """The merged profile of the views given by 'view' (default all).
+
+  With format=text, the top functions as pstats prints them, else the
+  stats in the format of pstats.Stats.dump_stats()."""
+  profiler.merge_samples()
+  view_names = request.GET.getlist('view')
+  if request.GET.get('format') == 'text':
+    return HttpResponse(profiler.get_combined_text(
+                          view_names, request.GET.get('sort', 'cumulative')),
+                        mimetype='text/plain')
+
+  data = profiler.get_combined_data(view_names)
+  if data is None:
+    raise Http404
+  response = HttpResponse(data, mimetype='application/octet-stream')
+  response['Content-Disposition'] = 'attachment; filename=requests.prof'
+  return response
 
 def calculator(request):
   visit = None
@@ -760,9 +930,10 @@ def report_undernutrition(request, orgStr, report_type, reports_form, report, re
   reportDetailWasting = []
         
   if showDetail:
-    reportDetailStunted = report.get_undernutrition_detail('stunted', zscore)
-    reportDetailUnderweight = report.get_undernutrition_detail('underweight', zscore) 
-    reportDetailWasting = report.get_undernutrition_detail('wasting', zscore)
+    reportDetails = report.get_undernutrition_details(zscore)
+    reportDetailStunted = reportDetails['stunted']
+    reportDetailUnderweight = reportDetails['underweight']
+    reportDetailWasting = reportDetails['wasting']
         
   return render_this(reportsForm, reportType, report, reportData, residence, showDetail, reportDetailStunted, reportDetailUnderweight, reportDetailWasting)
 
@@ -8,6 +8,7 @@ from common.appenginepatch.main import *
 # Local imports
 import db_log
 import db_cache
+from healthdb import profiler
 
 # Verify that we're running django 1.0 or later
 logging.info('django.__file__ = %r, django.VERSION = %r',
@@ -23,28 +24,28 @@ def log_exception(*args, **kwds):
 django.core.signals.got_request_exception.connect(log_exception)
 
 def our_profile_main():
-  db_log.clear_callmap()
-  db_log.clear_requestmap()
-
-  # From appenginepatch
-  profile_main()
-
-  db_log.log_callmap()
-
-# Turn on logging of profiling results
-#main = our_profile_main
-# No profiling.  real_main is from appenginepatch.
-main = real_main
-
-# Turn on per-request cache of datastore calls
+  # Store the profiles of a sample of requests, see healthdb/profiler.py.
+  # real_main is from appenginepatch.
+  profiler.profile_request(real_main)
+
+# Profile a sample of requests if settings.ENABLE_PROFILER
+if getattr(settings, 'ENABLE_PROFILER', False):
+  main = our_profile_main
+else:
+  # No profiling.
+  main = real_main
+
+# Turn on per-request cache of datastore entities.  It is only active
+# between the start and end of a request, see db_cache.DbCacheMiddleware.
 db_cache.patch_db_get()
 # assert there was no across-request caching
 assert 0 == db_cache.get_cache_size()
 
-# Turn on logging of datastore calls
-#db_log.patch_appengine()
+# Turn on profiling of datastore calls, for a sample of requests.
+# See db_log.DbProfileMiddleware.
+db_log.patch_appengine()
 
-# We have to be logging debug level to see messages from db_cache or db_log
+# We have to be logging debug level to see messages from db_cache
 #logging.getLogger().setLevel(logging.DEBUG)
 #logging.debug('Set logging level to DEBUG')
 
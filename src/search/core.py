@@ -1,6 +1,8 @@
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.db.models import signals
+from django.db.models import signals, get_model
+from django.utils import simplejson as json
+from google.appengine.api import users
 from google.appengine.ext import db
 try:
     from google.appengine.api.taskqueue import Task
@@ -14,6 +16,9 @@ import re
 import string
 import base64
 import cPickle as pickle
+import datetime
+import threading
+import urllib
 
 _PUNCTUATION_REGEX = re.compile(
     '[' + re.escape(string.punctuation.replace('-', '').replace(
@@ -35,6 +40,32 @@ def startswith(words, indexing, **kwargs):
                        for count in range(1, len(word)+1)])
     return result
 
+def capped_startswith(min_length=1, max_length=None):
+    """Returns a startswith indexer which only adds the prefixes of
+    min_length to max_length characters, plus each whole word outside
+    that range.  This keeps long words from adding dozens of values to the
+    index, and short prefixes (shared by most entities) from adding any.
+
+    In search mode a term longer than max_length is completed by its
+    max_length prefix, so it matches every word starting with that prefix
+    (the whole word is among them).  A term shorter than min_length only
+    matches a whole word."""
+    def indexer(words, indexing, **kwargs):
+        result = []
+        for word in words:
+            if not indexing:
+                result.append(word[:max_length].strip(u'-'))
+                continue
+            last = len(word)
+            if max_length:
+                last = min(last, max_length)
+            result.extend([word[:count].strip(u'-')
+                           for count in range(min_length, last+1)])
+            if len(word) < min_length or len(word) > last:
+                result.append(word)
+        return [word for word in result if word]
+    return indexer
+
 def porter_stemmer(words, language, **kwargs):
     """Porter-stemmer in various languages."""
     languages = [language,]
@@ -265,38 +296,77 @@ class SearchIndexProperty(SearchableListProperty):
                 raise ValueError('Invalid search index filter: %s %s' % (filter, value))
         return True
 
-    @transaction
-    def update_relation_index(self, parent_key, delete=False):
-        model = self._relation_index_model
-        
+    def get_relation_index_key(self, parent_key):
         # Generate key name (at most 250 chars)
         key_name = u'k' + unicode(parent_key.id_or_name())
         if len(key_name) > 250:
             key_name = key_name[:250]
-        
-        index = model.get_by_key_name(key_name, parent=parent_key)
-        
-        if not delete:
-            parent = self.model_class.get(parent_key)
-            values = None
-            if parent:
-                values = self.get_index_values(parent)
-        
+        return db.Key.from_path(self._relation_index_model.kind(), key_name,
+                                parent=parent_key)
+
+    def make_relation_index(self, parent_key, parent, index, delete=False):
+        """Returns the relation index entity for parent, updated from index
+        (the stored one, or None), or None if there should be none."""
+        values = None
+        if parent and not delete:
+            values = self.get_index_values(parent)
+
         # Remove index if it's not needed, anymore
         if delete or not self.should_index(values):
-            if index:
-                index.delete()
-            return
-        
+            return None
+
         # Update/create index
         if not index:
-            index = model(key_name=key_name, parent=parent_key, **values)
+            index = self._relation_index_model(
+                key_name=self.get_relation_index_key(parent_key).name(),
+                parent=parent_key, **values)
 
         # This guarantees that we also set virtual @properties
         for key, value in values.items():
             setattr(index, key, value)
+        return index
 
-        index.put()
+    @transaction
+    def update_relation_index(self, parent_key, delete=False):
+        index = db.get(self.get_relation_index_key(parent_key))
+        parent = None
+        if not delete:
+            parent = self.model_class.get(parent_key)
+        new_index = self.make_relation_index(parent_key, parent, index,
+                                             delete)
+        if new_index:
+            new_index.put()
+        elif index:
+            index.delete()
+
+    def update_relation_indexes(self, updates):
+        """Like update_relation_index() for a list of (parent key, delete),
+        with one batch get, put and delete.
+
+        Unlike update_relation_index() this is not in a transaction, so
+        two updates of the same parent at once could leave the older index.
+        Batches are coalesced (see start_batch()), which makes that rare."""
+        index_keys = [self.get_relation_index_key(parent_key)
+                      for parent_key, delete in updates]
+        parent_keys = [parent_key for parent_key, delete in updates
+                       if not delete]
+        entities = db.get(index_keys + parent_keys)
+        indexes = entities[:len(index_keys)]
+        parents = dict(zip(parent_keys, entities[len(index_keys):]))
+
+        to_put = []
+        to_delete = []
+        for (parent_key, delete), index in zip(updates, indexes):
+            new_index = self.make_relation_index(
+                parent_key, parents.get(parent_key), index, delete)
+            if new_index:
+                to_put.append(new_index)
+            elif index:
+                to_delete.append(index)
+        if to_put:
+            db.put(to_put)
+        if to_delete:
+            db.delete(to_delete)
 
     def create_index_model(self):
         attrs = dict(MODEL_NAME=self.model_class._meta.object_name,
@@ -487,6 +557,65 @@ class SearchIndexProperty(SearchableListProperty):
             indexer=self.indexer, language=language, keys_only=keys_only,
             previous_query = previous_query)
 
+    def matches(self, model_instance, query,
+                language=settings.LANGUAGE_CODE):
+        """Whether each word of query starts a word of the instance's
+        properties, for a startswith-like indexer.
+
+        search() finds a term longer than a capped indexer's max_length by
+        its prefix (see capped_startswith()), so use this to drop the
+        results that do not match the whole term."""
+        words = []
+        for property in self.properties:
+            values = getattr_by_path(model_instance, property, None)
+            if not values:
+                values = ()
+            elif not isinstance(values, (list, tuple)):
+                values = (values,)
+            for value in values:
+                words.extend(self.splitter(value, indexing=True,
+                                           language=language))
+        terms = set(self.splitter(query, indexing=False, language=language))
+        if len(terms) >= 4:
+            terms -= get_stop_words(language)
+        for term in terms:
+            for word in words:
+                if word.startswith(term):
+                    break
+            else:
+                return False
+        return True
+
+class IndexVersionProperty(db.IntegerProperty):
+    """The version of the code that built an entity's search indexes.
+
+    It is set to version whenever the entity is put, so a reindexer can skip
+    entities already built by the current splitters and indexers.  Not
+    indexed, by default."""
+    def __init__(self, version, indexed=False, **kwargs):
+        self.version = version
+        super(IndexVersionProperty, self).__init__(indexed=indexed, **kwargs)
+
+    def get_value_for_datastore(self, model_instance):
+        setattr(model_instance, self.name, self.version)
+        return self.version
+
+def update_index_values(model_instance):
+    """Recomputes the search index lists stored on model_instance, in
+    memory.  Returns whether any of them changed, i.e. whether it needs a
+    put().  (Relation and values indexes are not stored on the instance.)"""
+    changed = False
+    for property in model_instance.properties().values():
+        if not isinstance(property, SearchIndexProperty) or \
+                property.relation_index:
+            continue
+        old = sorted(set(getattr(model_instance, property.name) or []))
+        new = sorted(set(property.get_value_for_datastore(model_instance)))
+        setattr(model_instance, property.name, new)
+        if new != old:
+            changed = True
+    return changed
+
 # Automatically maintain the values and relation index via signals
 def post_init(sender, instance, **kwargs):
     # We have to store the previous value (before a put()), so we
@@ -503,25 +632,175 @@ def pre_save(sender, instance, **kwargs):
             # If we haven't been saved our old values don't exist, yet
             setattr(instance, '_old_of_' + property.name, None)
 
+# Index updates are queued as tasks, many to a task.  Between start_batch()
+# and flush_batch() (see search.middleware.BatchIndexUpdatesMiddleware) they
+# are collected, and updates of the same entity are coalesced.  Otherwise
+# each update is queued as it happens.
+
+# The task queue takes payloads up to 100KB, measured form-urlencoded
+MAX_TASK_BYTES = 90 * 1024
+
+_batch = threading.local()
+
+def start_batch():
+    """Collect index updates in this thread until flush_batch().
+
+    Calls may nest; updates are queued by the outermost flush_batch()."""
+    if getattr(_batch, 'depth', 0) == 0:
+        _batch.depth = 0
+        # (kind of update, model descriptor, property name, entity key)
+        #   -> update
+        _batch.updates = {}
+        _batch.order = []
+    _batch.depth += 1
+
+def reset_batch():
+    """Drop the batch of this thread, if any.  Returns the number of updates
+    dropped (left by a request that ended before flush_batch())."""
+    dropped = len(getattr(_batch, 'order', []))
+    _batch.depth = 0
+    _batch.updates = {}
+    _batch.order = []
+    return dropped
+
+def flush_batch():
+    """Queue the updates collected since start_batch()."""
+    if getattr(_batch, 'depth', 0) == 0:
+        return
+    _batch.depth -= 1
+    if _batch.depth > 0:
+        return
+    updates = [_batch.updates[key] for key in _batch.order]
+    _batch.updates = {}
+    _batch.order = []
+    queue_updates(updates)
+
+def _add_update(coalesce_key, update):
+    if getattr(_batch, 'depth', 0) == 0:
+        queue_updates([update])
+        return
+    if coalesce_key not in _batch.updates:
+        _batch.order.append(coalesce_key)
+    elif update[0] == 'values':
+        # Change from the first update's old values
+        update[3] = _batch.updates[coalesce_key][3]
+    _batch.updates[coalesce_key] = update
+
+def _encode_value(value):
+    """Encodes a property value for JSON."""
+    if isinstance(value, db.Key):
+        return {'key': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'datetime': [value.year, value.month, value.day, value.hour,
+                             value.minute, value.second, value.microsecond]}
+    if isinstance(value, datetime.date):
+        return {'date': [value.year, value.month, value.day]}
+    if isinstance(value, datetime.time):
+        return {'time': [value.hour, value.minute, value.second,
+                         value.microsecond]}
+    if isinstance(value, users.User):
+        return {'user': value.email()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(item) for item in value]
+    if value is None or isinstance(value, (basestring, bool, int, long,
+                                           float)):
+        return value
+    raise TypeError('Cannot queue an index update of %r' % (value,))
+
+def _decode_value(value):
+    if isinstance(value, list):
+        return [_decode_value(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    kind, value = value.items()[0]
+    if kind == 'key':
+        return db.Key(value)
+    if kind == 'datetime':
+        return datetime.datetime(*value)
+    if kind == 'date':
+        return datetime.date(*value)
+    if kind == 'time':
+        return datetime.time(*value)
+    if kind == 'user':
+        return users.User(value)
+    raise ValueError('Unknown value %r' % kind)
+
+def _encode_values(values):
+    if values is None:
+        return None
+    return dict([(name, _encode_value(value))
+                 for name, value in values.items()])
+
+def _decode_values(values):
+    if values is None:
+        return None
+    # Keyword names must be str
+    return dict([(str(name), _decode_value(value))
+                 for name, value in values.items()])
+
+def _encode_update(update):
+    if update[0] == 'relation':
+        kind, model_descriptor, property_name, parent_key, delete = update
+        update = [kind, model_descriptor, property_name, str(parent_key),
+                  delete]
+    else:
+        kind, model_descriptor, property_name, old_values, new_values = update
+        update = [kind, model_descriptor, property_name,
+                  _encode_values(old_values), _encode_values(new_values)]
+    return json.dumps(update, separators=(',', ':'))
+
+def queue_updates(updates):
+    """Queue tasks applying updates, as many to a task as fit."""
+    encoded = [_encode_update(update) for update in updates]
+    # The task body is form-urlencoded, which grows quotes, brackets etc.
+    sizes = [len(urllib.quote_plus(item)) for item in encoded]
+    while encoded:
+        size = len(urllib.urlencode({'updates': '[]'}))
+        count = 0
+        while count < len(encoded) and (
+                count == 0 or size + sizes[count] < MAX_TASK_BYTES):
+            # And an encoded comma
+            size += sizes[count] + 3
+            count += 1
+        Task(url=reverse('search.views.update_indexes'), method='POST',
+            params={'updates': '[%s]' % ','.join(encoded[:count])}
+            ).add(SearchIndexProperty.default_search_queue)
+        encoded = encoded[count:]
+        sizes = sizes[count:]
+
+def apply_updates(payload):
+    """Apply the index updates of a task queued by queue_updates(), the
+    relation index updates of each property in one batch."""
+    # (model descriptor, property name) -> [(parent key, delete)]
+    relation_updates = {}
+    for update in json.loads(payload):
+        kind, model_descriptor, property_name = update[:3]
+        if kind == 'relation':
+            relation_updates.setdefault(
+                (tuple(model_descriptor), property_name), []).append(
+                    (db.Key(update[3]), update[4]))
+        else:
+            property = getattr(get_model(*model_descriptor), property_name)
+            property.update_values_index(_decode_values(update[4]),
+                                         _decode_values(update[3]))
+    for (model_descriptor, property_name), updates in \
+            relation_updates.items():
+        property = getattr(get_model(*model_descriptor), property_name)
+        property.update_relation_indexes(updates)
+
 def push_update_values_index(model_descriptor, property_name, old_values,
-        new_values):
-    Task(url=reverse('search.views.update_values_index'),  method='POST',
-        params={
-            'property_name': property_name,
-            'model_descriptor': base64.b64encode(pickle.dumps(model_descriptor)),
-            'old_values': base64.b64encode(pickle.dumps(old_values)),
-            'new_values': base64.b64encode(pickle.dumps(new_values)),
-        }).add(SearchIndexProperty.default_search_queue)
+        new_values, entity_key=None):
+    _add_update(('values', tuple(model_descriptor), property_name,
+                 entity_key),
+                ['values', model_descriptor, property_name, old_values,
+                 new_values])
 
 def push_update_relation_index(model_descriptor, property_name, parent_key,
         delete):
-    Task(url=reverse('search.views.update_relation_index'),  method='POST',
-        params={
-            'property_name': property_name,
-            'model_descriptor': base64.b64encode(pickle.dumps(model_descriptor)),
-            'parent_key':base64.b64encode(pickle.dumps(parent_key)),
-            'delete':base64.b64encode(pickle.dumps(delete)),
-        }).add(SearchIndexProperty.default_search_queue)
+    _add_update(('relation', tuple(model_descriptor), property_name,
+                 parent_key),
+                ['relation', model_descriptor, property_name, parent_key,
+                 delete])
 
 def post(delete, sender, instance, **kwargs):
     for property in sender._meta.fields:
@@ -539,9 +818,13 @@ def post(delete, sender, instance, **kwargs):
                 if not delete:
                     values = property.get_index_values(instance)
                 if delete or not values == old_values:
+                    try:
+                        entity_key = instance.key()
+                    except db.NotSavedError:
+                        entity_key = id(instance)
                     push_update_values_index([sender._meta.app_label,
                         sender._meta.object_name], property.name, old_values,
-                            values)
+                            values, entity_key)
                 if delete:
                     setattr(instance, '_old_of_' + property.name, None)
                 else:
@@ -629,11 +912,19 @@ class RelationIndexQuery(QueryTraits):
         self.query = self.query.filter(*args, **kwargs)
 
     def __getitem__(self, index):
-        keys = [key.parent() for key in self.query[index]]
+        return self._get_parents(self.query[index])
+
+    def _get_parents(self, keys):
+        keys = [key.parent() for key in keys]
         if self.keys_only:
             return keys
         return [item for item in self.model.get(keys) if item]
 
+    def fetch_page(self, count, cursor=None):
+        # self.query is a ChainedQueries if chain_sort was given
+        keys, cursor = fetch_page(self.query, count, cursor)
+        return self._get_parents(keys), cursor
+
     def count(self, max=301):
         return self.query.count(max)
 
@@ -695,6 +986,46 @@ class ChainedQueries(QueryTraits):
             counter += query.count(max - counter)
         return counter
 
+    def fetch_page(self, count, cursor=None):
+        # Our cursor is the index of a query and a cursor of that query
+        index, query_cursor = 0, None
+        if cursor:
+            index, query_cursor = cursor.split(':', 1)
+            index = int(index)
+        result = []
+        while index < len(self.queries):
+            items, query_cursor = fetch_page(
+                self.queries[index].query, count - len(result),
+                query_cursor or None)
+            result.extend(items)
+            if query_cursor:
+                return result, '%d:%s' % (index, query_cursor)
+            index += 1
+        return result, None
+
+def _fetch_query_page(query, count, cursor=None):
+    if cursor:
+        query.with_cursor(cursor)
+    items = query.fetch(count)
+    if len(items) < count:
+        return items, None
+    return items, query.cursor()
+
+def fetch_page(results, count=10, cursor=None):
+    """Fetches count results, starting at cursor.
+
+    results is a query (e.g., from SearchIndexProperty.search()), a
+    RelationIndexQuery or ChainedQueries.  cursor is None for the first page,
+    or else the cursor returned for the page before.  Returns the results and
+    the cursor of the next page, which is None after the last page (though
+    that page may turn out to be empty).
+
+    Unlike slicing, each page is one bounded fetch (for ChainedQueries, one
+    per query the page spans), however deep it is."""
+    if hasattr(results, 'fetch_page'):
+        return results.fetch_page(count, cursor)
+    return _fetch_query_page(results, count, cursor)
+
 def make_paginated_filter(filters=(), order=(), bookmark=None,
                           descending=False, debug=False):
     # Get bookmark (marks last result entry which we can restart from).
@@ -0,0 +1,19 @@
+import logging
+
+from search.core import start_batch, flush_batch, reset_batch
+
+class BatchIndexUpdatesMiddleware(object):
+    """Queues the index updates of each request in as few tasks as
+    possible, see search.core.start_batch()."""
+    def process_request(self, request):
+        # A request that died (e.g. DeadlineExceededError) before
+        # process_response() leaves its batch in this thread
+        dropped = reset_batch()
+        if dropped:
+            logging.error('Dropped %d search index updates left by an '
+                          'earlier request' % dropped)
+        start_batch()
+
+    def process_response(self, request, response):
+        flush_batch()
+        return response
@@ -8,7 +8,7 @@ from ragendja.pyutils import equal_lists
 from ragendja.testutils import ModelTestCase
 from search.core import SearchIndexProperty, startswith, \
     porter_stemmer_non_stop, ChainedQueries, make_paginated_filter, \
-    paginated_query
+    paginated_query, fetch_page, start_batch, flush_batch
 from search.views import show_search_results, live_search_results
 import base64
 
@@ -100,6 +100,23 @@ class TestIndexed(ModelTestCase):
         self.assertEqual(len(Indexed.value_index.search('value2',
             filters=('check =', False, 'one =', 'blub'))), 1)
 
+    def test_batch(self):
+        start_batch()
+        items = [Indexed(one=u'batched%d' % i, value=u'batch%d' % i)
+                 for i in range(3)]
+        for item in items:
+            item.put()
+        items[0].one = u'batchedagain'
+        items[0].put()
+        flush_batch()
+        # One task, with one update per entity and index
+        stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        self.assertEqual(len(stub.GetTasks('default')), 1)
+        run_tasks()
+        self.assertEqual(len(Indexed.one_index.search('batched')), 3)
+        self.assertEqual(len(Indexed.one_index.search('batchedagain')), 1)
+        self.assertEqual(len(Indexed.values_index.search('batch0')), 1)
+
     def test_add_index(self):
         # Only one add_index entry should exist
         self.assertEqual(Indexed.add_index._values_index_model.all().count(), 1)
@@ -186,6 +203,34 @@ class ChainTest(TestCase):
         self.assertEqual(list(chained), self.values)
         self.assertEqual(len(chained), len(self.values))
 
+    def test_fetch_page(self):
+        chained = ChainedQueries((
+            X.all().filter('val =', 'bum bam bear'),
+            X.all().filter('val =', 'bear and bing'),
+            X.all().filter('val =', 'beach sand bear'),
+        ))
+        pages = []
+        items, cursor = fetch_page(chained, 2)
+        pages.append(items)
+        while cursor:
+            items, cursor = fetch_page(chained, 2, cursor)
+            pages.append(items)
+        self.assertEqual([len(items) for items in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []), self.values)
+
+    def test_fetch_page_relation_index(self):
+        results = X.index.search('bear', chain_sort=(('idx =', 1),
+                                                     ('idx =', 2)))
+        pages = []
+        items, cursor = fetch_page(results, 2)
+        pages.append(items)
+        while cursor:
+            items, cursor = fetch_page(results, 2, cursor)
+            pages.append(items)
+        self.assertEqual([len(items) for items in pages], [2, 1])
+        self.assertEqual([item.key().name() for item in sum(pages, [])],
+                         ['b1', 'c1', 'a1'])
+
     def test_search(self):
         url = reverse('search.tests.search_test')
         self.assertEqual(self.client.get(url, {'query': 'bear'}).content,
@@ -4,10 +4,12 @@ from django.core.paginator import Paginator, InvalidPage
 from django.db import models
 from django.http import Http404, HttpResponseRedirect, HttpResponse
 from django.template.defaultfilters import force_escape
+from django.utils.http import urlquote
 from django.utils.translation import ugettext_lazy as _
 from ragendja.template import JSONResponse, render_to_response
 from search.forms import SearchForm
-from search.core import paginated_query
+from search.core import paginated_query, fetch_page, apply_updates
+from google.appengine.ext import db
 import base64
 import cPickle as pickle
 
@@ -20,6 +22,17 @@ default_results_format = (
 
 default_title = _('Search')
 
+# Number of earlier pages whose cursors are kept in the page links of
+# cursor_paginated_object_list(), for the 'Previous' link
+CURSOR_HISTORY = 5
+
+def update_indexes(request):
+    """Applies a batch of index updates, see search.core.queue_updates()."""
+    if 'updates' in request.POST:
+        apply_updates(request.POST['updates'])
+    return HttpResponse()
+
+# The views below handle tasks queued (one per update) before batching
 def update_relation_index(request):
     if 'property_name' in request.POST and 'model_descriptor' in request.POST \
           and 'parent_key' in request.POST and 'delete' in request.POST:
@@ -64,7 +77,8 @@ def show_search_results(request, model, index, filters=(), chain_sort=(),
         force_results_count=True, results_count_format=default_results_format,
         search_form_class=SearchForm, paginate_by=10, template_name=None,
         template_object_name=None, extra_context={},
-        key_based_on_empty_query=False, key_based_order=()):
+        key_based_on_empty_query=False, key_based_order=(),
+        count_results=True):
     """
     Performs a search in model and prints the results.
     For further information see
@@ -93,7 +107,8 @@ def show_search_results(request, model, index, filters=(), chain_sort=(),
         template_name=template_name,
         template_object_name=template_object_name,
         key_based_on_empty_query=key_based_on_empty_query,
-        key_based_order=key_based_order)
+        key_based_order=key_based_order,
+        count_results=count_results)
 
 def show_search_results_from_results(results,
         request, model, index, filters=(), chain_sort=(),
@@ -102,9 +117,11 @@ def show_search_results_from_results(results,
         force_results_count=True, results_count_format=default_results_format,
         search_form_class=SearchForm, paginate_by=10, template_name=None,
         template_object_name=None, extra_context={},
-        key_based_on_empty_query=False, key_based_order=()):
+        key_based_on_empty_query=False, key_based_order=(),
+        count_results=True):
     """
-    Performs a search in model and prints the results.
+    Performs a search in model and prints the results, a page at a time
+    (see cursor_paginated_object_list()).
     For further information see
     search.core.SearchIndexProperty.search()
     """
@@ -137,10 +154,12 @@ def show_search_results_from_results(results,
                                                 model._meta.object_name.lower()),
                          'search/search.html')
     
-    return paginated_object_list(request, queryset=results, converter=converter,
-        paginate_by=paginate_by, template_name=template_name,
-        extra_context=data, template_object_name=template_object_name,
-        results_count_format=results_count_format, ignore_params=ignore_params)
+    return cursor_paginated_object_list(request, queryset=results,
+        converter=converter, paginate_by=paginate_by,
+        template_name=template_name, extra_context=data,
+        template_object_name=template_object_name,
+        results_count_format=results_count_format, ignore_params=ignore_params,
+        count_results=count_results)
 
 def _prepare_params(request, ignore_params=()):
     page = request.GET.get('page')
@@ -212,6 +231,84 @@ def paginated_object_list(request, queryset, converter=None, paginate_by=10,
             data[key] = value
     return render_to_response(request, template_name, data)
 
+def _decode_page(page):
+    '''Returns the estimated number of results and the cursors of this and
+    the earlier pages, from the page parameter of a cursor paginated list.
+
+    The first page has an empty cursor.  A page parameter that is not ours
+    (e.g., a page number) means the first page.'''
+    if not page or '|' not in page:
+        return None, ['']
+    hits, cursors = page.split('|', 1)
+    if hits:
+        hits = int(hits)
+    else:
+        hits = None
+    return hits, cursors.split(',')
+
+def _encode_page(hits, cursors):
+    if hits is None:
+        hits = ''
+    return urlquote('%s|%s' % (hits, ','.join(cursors[:CURSOR_HISTORY + 1])))
+
+def cursor_paginated_object_list(request, queryset, converter=None,
+        paginate_by=10, template_name=None, extra_context={},
+        template_object_name=None,
+        results_count_format=default_results_format, ignore_params=(),
+        count_results=True):
+    """
+    Like paginated_object_list(), but the page links carry datastore cursors
+    (see search.core.fetch_page()), so each page costs one bounded query
+    however deep it is.
+
+    The number of results is counted (up to 301) on the first page if
+    count_results is True, and carried in the page links.  Otherwise it is
+    only known when all results fit on the first page.
+    """
+    page, original_base_url, data = _prepare_params(request, ignore_params)
+    try:
+        hits, cursors = _decode_page(page)
+        items, next_cursor = fetch_page(queryset, paginate_by,
+                                        cursors[0] or None)
+    except (ValueError, db.Error):
+        raise Http404
+    if hits is None and not cursors[0]:
+        if not next_cursor:
+            hits = len(items)
+        elif count_results:
+            hits = queryset.count(301)
+
+    previous = None
+    if len(cursors) > 1:
+        previous = _encode_page(hits, cursors[1:])
+    next = None
+    if next_cursor:
+        next = _encode_page(hits, [next_cursor] + cursors)
+
+    data.update({
+        '%s_list' % template_object_name: items,
+        'template_object_name': template_object_name,
+        'force_results_count': hits is not None,
+        'results_count_format': results_count_format,
+        'search__converter': converter,
+        'hits': hits,
+        'results_per_page': paginate_by,
+        'has_previous': bool(previous),
+        'previous': previous,
+        'has_next': bool(next),
+        'next': next,
+        'page_range': (),
+        # Deeper than the cursors we keep, offer the first page instead
+        'show_first': bool(cursors[0]) and not previous,
+        'show_key_pagenav': True,
+    })
+    for key, value in extra_context.items():
+        if callable(value):
+            data[key] = value()
+        else:
+            data[key] = value
+    return render_to_response(request, template_name, data)
+
 def live_search_results(request, model, index, filters=(), chain_sort=(),
         limit=30, result_item_formatting=None, query_converter=None,
         converter=None, redirect=False):
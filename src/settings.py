@@ -57,9 +57,12 @@ else:
 
 FILE_UPLOAD_MAX_MEMORY_SIZE = 1048576  # 1 MB
 
-#ENABLE_PROFILER = True
+# Store cProfile stats of a sample of requests, see healthdb/profiler.py.
+# Off by default: a sampled request spends time storing its profile.
+ENABLE_PROFILER = False
 #ONLY_FORCED_PROFILE = True
-#PROFILE_PERCENTAGE = 25
+PROFILE_PERCENTAGE = 1
+# The following apply to appenginepatch's profile_main(), which logs them
 #SORT_PROFILE_RESULTS_BY = 'cumulative' # default is 'time'
 # Profile only datastore calls
 #PROFILE_PATTERN = 'ext.db..+\((?:get|get_by_key_name|fetch|count|put)\)'
@@ -83,6 +86,16 @@ LANGUAGES = (
   ('fr', 'Française'),
 )
 
+# Fraction of requests whose datastore calls are profiled, see db_log.py
+DB_PROFILE_SAMPLE_RATE = 0.1
+# Warn when a request repeats a datastore call shape more than this
+DB_PROFILE_REPEAT_THRESHOLD = 10
+
+# Lengths of the word prefixes in the patient search indexes, see
+# healthdb/search_util.py.  After changing them, run updatesearchindex.
+SEARCH_PREFIX_MIN_LENGTH = 2
+SEARCH_PREFIX_MAX_LENGTH = 8
+
 TEMPLATE_CONTEXT_PROCESSORS = (
   'django.core.context_processors.auth',
   'django.core.context_processors.media',
@@ -92,6 +105,12 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 )
 
 MIDDLEWARE_CLASSES = (
+  # Profiles datastore calls, see main.py
+  'db_log.DbProfileMiddleware',
+  # Per-request cache of datastore entities, see main.py
+  'db_cache.DbCacheMiddleware',
+  # Search index updates of a request in few tasks, see search/core.py
+  'search.middleware.BatchIndexUpdatesMiddleware',
   'ragendja.middleware.ErrorMiddleware',
   'django.contrib.sessions.middleware.SessionMiddleware',
   # i18n
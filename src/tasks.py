@@ -1,6 +1,5 @@
 """Background tasks. References to Django not permitted (yet).
 
-see http://code.google.com/appengine/articles/deferred.html
 see http://code.google.com/appengine/docs/python/taskqueue/
 """
 
@@ -9,32 +8,35 @@ import logging
 
 # Google imports
 from google.appengine.runtime.apiproxy_errors \
-  import OverQuotaError, DeadlineExceededError
+  import OverQuotaError, DeadlineExceededError, CapabilityDisabledError
 from google.appengine.api import mail
 
 # Django imports ARE NOT ALLOWED until path issues are fixed
 
+# Errors after which sending again later may succeed
+TRANSIENT_ERRORS = (OverQuotaError, DeadlineExceededError,
+                    CapabilityDisabledError)
+
 
 def deliver_email_task(emailMessage):
   """Invoke the send() method on the google EmailMessage, catch errors.
   
-  This method should be invoked asynchronously, through the "deferred" call.
-  Google claims that "it'll automatically retry in the event of timeouts 
-    and other transient errors".
+  This method is invoked asynchronously, by the mail queue's task handlers
+  (see mailer.send_mail).  Transient errors (TRANSIENT_ERRORS) are logged
+  and raised again, so the task fails and the queue retries it with backoff
+  (see queue.yaml).  Other errors, e.g. an invalid address, would fail
+  again, so they are logged and the email is dropped.
   
-  see http://code.google.com/appengine/articles/deferred.html
   see http://code.google.com/appengine/docs/python/taskqueue/
   """
   try:
     emailMessage.send()
     logging.info("Sending email succeeded (subject: %s, to: %s)" %
                  (emailMessage.subject, emailMessage.to))
-  except OverQuotaError:
-    logging.error("Sending email failed - OverQuotaError")
-    raise
-  except DeadlineExceededError:
-    logging.error("Sending email failed - DeadlineExceededError")
+  except TRANSIENT_ERRORS, err:
+    logging.error("Sending email failed - %s, will retry"
+                  % err.__class__.__name__)
     raise
   except Exception:
-    logging.error("Sending email failed")
-    raise
+    logging.exception("Sending email failed, dropping it (subject: %s, to: %s)"
+                      % (emailMessage.subject, emailMessage.to))
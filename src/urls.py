@@ -28,6 +28,11 @@ urlpatterns = auth_patterns + patterns('',
   url(r'^org-must-match$', simple_view,
       {'template': 'org_must_match.html'},   name='org-must-match'),
 
+  # Mail task queue handlers (see common/mailer.py), admin only in app.yaml.
+  # Before the healthdb urls, whose per-org patterns would match them.
+  (r'^tasks/send-mail$', 'mailer.send_mail_task'),
+  (r'^tasks/mail-digest$', 'mailer.send_digest_task'),
+
   # healthdb urls
   url(r'', include('healthdb.urls')),
   